@@ -5,29 +5,30 @@ from chat_wb.neo4j.neo4j import (
     get_relationship_types,
     get_label_and_relationship_type_sets,
 )
+from chat_wb.neo4j.schema import RELATION_CATALOG, load_relation_catalog
 
 
 # diskcacheのインスタンスを作成
 cache = Cache(directory="./cache")  # キャッシュファイルを保存するディレクトリを指定
 
 
-def fetch_labels() -> list[str]:
+async def fetch_labels() -> list[str]:
     # キャッシュからラベルを取得
     labels = cache.get("labels")
 
     if labels is None:
-        labels = get_node_labels()
+        labels = await get_node_labels()
         cache.set("labels", labels, expire=86400)  # 1日後に期限切れとなるようにTTLを設定
 
     return labels
 
 
-def fetch_node_names(label: str) -> list[str]:
+async def fetch_node_names(label: str) -> list[str]:
     # キャッシュからノード名を取得
     node_names = cache.get(f"node_names_{label}")
 
     if node_names is None:
-        node_names = get_node_names(label)
+        node_names = await get_node_names(label)
         cache.set(
             f"node_names_{label}", node_names, expire=86400
         )  # 1日後に期限切れとなるようにTTLを設定
@@ -35,39 +36,42 @@ def fetch_node_names(label: str) -> list[str]:
     return node_names
 
 
-def fetch_relationships() -> list[str]:
+def invalidate_node_names(labels: list[str]):
+    """ノードの統合、削除の後に、ラベルごとのノード名のキャッシュを削除する"""
+    for label in set(labels):
+        cache.delete(f"node_names_{label}")
+
+
+async def fetch_relationships() -> list[str]:
     # キャッシュからリレーションシップタイプを取得
     relationship_types = cache.get("relationships_types")
 
     if relationship_types is None:
-        relationship_types = get_relationship_types()
+        relationship_types = await get_relationship_types()
         cache.set("relationships_types", relationship_types, expire=86400)
 
     return relationship_types
 
 
-def fetch_label_and_relationship_type_sets() -> dict:
-    # キャッシュからラベルとリレーションシップタイプのセットを取得
-    label_and_relationship_type_sets = cache.get("label_and_relationship_type_sets")
+async def fetch_label_and_relationship_type_sets() -> dict:
+    # プロセス内のカタログから取得する（書き込み処理で更新されるため、diskcacheには保存しない）
+    label_and_relationship_type_sets = await get_label_and_relationship_type_sets()
+    # JSONで返すために、キーを文字列に変換
+    return {str(key): value for key, value in label_and_relationship_type_sets.items()}
 
-    if label_and_relationship_type_sets is None:
-        label_and_relationship_type_sets = get_label_and_relationship_type_sets()
-        # キャッシュに保存するために、キーを文字列に変換
-        str_key_dict = {str(key): value for key, value in label_and_relationship_type_sets.items()}
-        cache.set(
-            "label_and_relationship_type_sets",
-            str_key_dict,
-            expire=86400,
-        )
 
-    return label_and_relationship_type_sets
+# global変数の設定（非同期ドライバを使用するため、import時ではなく、アプリケーション起動時にload_cacheで読み込む）
+# ラベルリスト（他モジュールからimportされるため、再代入せずに中身を更新する）
+NODE_LABELS: list[str] = []
+RELATION_TYPES: list[str] = []
+RELATION_SETS = RELATION_CATALOG   # (始点ラベル, 終点ラベル) -> リレーションタイプ。書き込み処理で更新される。
 
 
-# global変数の設定（1日に1回（キャッシュのTTLが過ぎるたびに）読み込む（# 初回のデータ取得））
-# ラベルリスト
-NODE_LABELS = fetch_labels()
-RELATION_TYPES = fetch_relationships()
-RELATION_SETS = fetch_label_and_relationship_type_sets()
+async def load_cache():
+    """global変数を初回のデータで埋める。FastAPIのlifespanから呼び出す。"""
+    NODE_LABELS[:] = await fetch_labels()
+    RELATION_TYPES[:] = await fetch_relationships()
+    await load_relation_catalog()
 
 
 # # ノード名リスト　データベースを作るなら、要る。
@@ -78,4 +82,4 @@ RELATION_SETS = fetch_label_and_relationship_type_sets()
 
 # 　ノードに対して、特定のリレーションタイプを持つノードの名前をリストとして取得したい場合、
 #  以下の関数から、nameだけ取り出す。
-#  get_related_nodes_by_relation(label:str, name:str, relation_type:str) -> list[Node]:
\ No newline at end of file
+#  get_related_nodes_by_relation(label:str, name:str, relation_type:str) -> list[Node]:
@@ -0,0 +1,45 @@
+"""既存のデータを、現在のスキーマに合わせて移行する。
+
+    aliases:      Aliasを持たないEntityに、Aliasを作成する
+    latest:       LATEST（最新のMessageへのポインタ）を持たないTitleに、LATESTを作成する
+    contain_time: create_timeを持たない(Message)-[:CONTAIN]->(Entity)に、Messageのcreate_timeを設定する
+
+いずれもラベル、リレーションタイプ全体を走査するため、アプリケーションの起動時には実行しない。
+移行が済んでいるデータは対象にならないため、再実行しても結果は変わらない。
+
+実行例:
+    python -m chat_wb.jobs.backfill aliases latest contain_time
+"""
+import argparse
+import asyncio
+import logging
+from logging import getLogger
+from chat_wb.neo4j.driver import close_driver
+from chat_wb.neo4j.schema import ensure_schema, backfill_aliases, backfill_latest_messages, backfill_contain_time
+
+# ロガー設定
+logger = getLogger(__name__)
+
+BACKFILLS = {
+    "aliases": backfill_aliases,
+    "latest": backfill_latest_messages,
+    "contain_time": backfill_contain_time,
+}
+
+
+async def main(args: argparse.Namespace):
+    try:
+        # 走査に使うインデックスを、先に作成しておく
+        await ensure_schema()
+        for name in args.targets:
+            logger.info(f"Backfill {name} started.")
+            await BACKFILLS[name]()
+    finally:
+        await close_driver()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(funcName)s]: %(message)s")
+    parser = argparse.ArgumentParser(description="既存のデータを、現在のスキーマに合わせて移行する")
+    parser.add_argument("targets", nargs="+", choices=list(BACKFILLS), help="移行する対象")
+    asyncio.run(main(parser.parse_args()))
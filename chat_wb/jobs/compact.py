@@ -0,0 +1,97 @@
+"""Entityのプロパティの値の数を、上限（NEO4J_PROPERTY_VALUE_LIMIT）以下に減らす。
+
+書き込み時にも上限は適用されるが、上限を導入する前のノードや、統合（merge）で値が増えたノードは、このジョブで整理する。
+上限を超えたプロパティごとに、
+    recent:   新しく追加された値（リストの末尾）から、上限の数だけ残す
+    frequent: Messageからのリレーションシップ（CONTAIN）で言及された回数の多い値から、上限の数だけ残す
+のいずれかで残す値を選び、残りは(n)-[:ARCHIVED]->(:PropertyArchive {key, values})に移す。
+
+実行例:
+    python -m chat_wb.jobs.compact --policy frequent --limit 20 --dry-run
+"""
+import argparse
+import asyncio
+import logging
+from logging import getLogger
+import neo4j
+from chat_wb.neo4j.cypher import OVERSIZED_PROPERTIES, VALUE_FREQUENCIES, UNWIND_COMPACT_PROPERTIES
+from chat_wb.neo4j.driver import driver, close_driver, read_query, write_query
+from chat_wb.neo4j.profiler import stream_query
+from chat_wb.neo4j.schema import UNCAPPED_PROPERTIES
+import config
+
+# ロガー設定
+logger = getLogger(__name__)
+
+
+def select_archived(values: list, limit: int, frequencies: dict[str, int] | None = None) -> list:
+    """残す値をlimit個選び、PropertyArchiveに移す値を返す。
+    frequenciesがない場合は、新しい値（末尾）を残す。ある場合は、言及回数の多い値を残し、同数なら新しい値を残す。"""
+    if frequencies is None:
+        return values[:max(len(values) - limit, 0)]
+    ranked = sorted(range(len(values)), key=lambda i: (frequencies.get(str(values[i]), 0), i), reverse=True)
+    kept = set(ranked[:limit])
+    return [value for i, value in enumerate(values) if i not in kept]
+
+
+async def compact_batch(rows: list[dict], limit: int, policy: str, dry_run: bool) -> int:
+    """rows（node_id, key, values）を整理し、PropertyArchiveに移した値の数を返す"""
+    frequencies = {}
+    if policy == "frequent":
+        records = await read_query(
+            "compact_properties.frequencies",
+            VALUE_FREQUENCIES,
+            rows=[{"node_id": row["node_id"], "key": row["key"]} for row in rows],
+        )
+        for record in records:
+            frequencies[(record["node_id"], record["key"])] = dict(record["frequencies"])
+
+    compactions = []
+    for row in rows:
+        archive = select_archived(
+            row["values"], limit, frequencies.get((row["node_id"], row["key"]), {}) if policy == "frequent" else None
+        )
+        if archive:
+            compactions.append({"node_id": row["node_id"], "key": row["key"], "archive": archive})
+    if compactions and not dry_run:
+        await write_query("compact_properties", UNWIND_COMPACT_PROPERTIES, rows=compactions)
+    return sum(len(c["archive"]) for c in compactions)
+
+
+async def compact_properties(limit: int, policy: str = "recent", dry_run: bool = False, batch_size: int = 100) -> int:
+    # 読み取りを最後まで終えてから書き込む（読み取り中のノードを、同じジョブで更新しないため）
+    rows = []
+    async with driver.session(fetch_size=batch_size, default_access_mode=neo4j.READ_ACCESS) as session:
+        async for records in stream_query(
+            session,
+            "compact_properties.oversized",
+            OVERSIZED_PROPERTIES,
+            batch_size=batch_size,
+            property_value_limit=limit,
+            uncapped_properties=UNCAPPED_PROPERTIES,
+        ):
+            rows.extend({"node_id": r["node_id"], "key": r["key"], "values": r["values"]} for r in records)
+    logger.info(f"{len(rows)} properties exceed {limit} values.")
+
+    archived = 0
+    for i in range(0, len(rows), batch_size):
+        archived += await compact_batch(rows[i:i + batch_size], limit, policy, dry_run)
+    logger.info(f"{archived} values {'will be archived' if dry_run else 'archived'} from {len(rows)} properties.")
+    return archived
+
+
+async def main(args: argparse.Namespace):
+    try:
+        await compact_properties(args.limit, args.policy, args.dry_run, args.batch_size)
+    finally:
+        await close_driver()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(funcName)s]: %(message)s")
+    parser = argparse.ArgumentParser(description="Entityのプロパティの値の数を、上限以下に減らす")
+    parser.add_argument("--limit", type=int, default=config.NEO4J_PROPERTY_VALUE_LIMIT, help="プロパティごとに残す値の数")
+    parser.add_argument("--policy", choices=["recent", "frequent"], default="recent", help="残す値の選び方")
+    parser.add_argument("--batch-size", type=int, default=100, help="1トランザクションで整理するプロパティの数")
+    parser.add_argument("--dry-run", action="store_true", help="書き込みを行わず、移す値の数を出力する")
+    asyncio.run(main(parser.parse_args()))
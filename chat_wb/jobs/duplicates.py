@@ -0,0 +1,127 @@
+"""重複しているEntityの候補を、名前とプロパティのベクトルの類似度から検出する。
+
+「しゅお」と「しゅおちゃん」、ローマ字表記のように、remove_suffixでは同一視できない重複を対象とする。
+ラベルごとに、
+    1. Entityの名前、name_variation、主なプロパティを1つのテキストにして、ベクトル化する
+    2. 正規化したベクトルの行列積で、コサイン類似度をブロックごとに求める（メモリはblock_size × ノード数に比例する）
+    3. しきい値以上の組を、類似度の高い順に出力する
+出力は、1行1組のJSONLで、chat_wb.jobs.mergeの入力（target, duplicates）としてそのまま使える。
+targetは、リレーションシップの多い方とする。統合する前に、必ず内容を確認すること。
+
+実行例:
+    python -m chat_wb.jobs.duplicates candidates.jsonl --min-score 0.93
+    python -m chat_wb.jobs.merge candidates.jsonl --dry-run
+"""
+import argparse
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from logging import getLogger
+import numpy as np
+from chat_wb.models import remove_suffix
+from chat_wb.neo4j.driver import close_driver
+from chat_wb.neo4j.neo4j import stream_entity_profiles
+from openai_api.common import aget_embeddings
+
+# ロガー設定
+logger = getLogger(__name__)
+
+# ベクトル化のテキストに含めるプロパティの数、値の数
+MAX_PROPERTIES = 5
+MAX_VALUES = 3
+# 1リクエストでベクトル化するテキストの数
+EMBEDDING_BATCH_SIZE = 500
+
+
+def profile_text(profile: dict) -> str:
+    """Entityを、ベクトル化するテキストに変換する（名前を先頭にし、プロパティは一部のみ含める）"""
+    props = dict(profile["props"])
+    props.pop("name", None)
+    variations = props.pop("name_variation", None) or []
+    variations = variations if isinstance(variations, list) else [variations]
+    text = " / ".join(dict.fromkeys([profile["name"], *map(str, variations)]))
+    details = []
+    for key in sorted(props)[:MAX_PROPERTIES]:
+        values = props[key] if isinstance(props[key], list) else [props[key]]
+        details.append(f"{key}: {', '.join(map(str, values[:MAX_VALUES]))}")
+    if details:
+        text += " (" + "; ".join(details) + ")"
+    return f"{profile['label']}: {text}"
+
+
+async def embed_profiles(profiles: list[dict]) -> np.ndarray:
+    """ベクトル化し、行ごとに正規化した行列（float32）を返す"""
+    vectors = []
+    for i in range(0, len(profiles), EMBEDDING_BATCH_SIZE):
+        texts = [profile_text(profile) for profile in profiles[i:i + EMBEDDING_BATCH_SIZE]]
+        vectors.extend(await aget_embeddings(texts))
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def similar_pairs(matrix: np.ndarray, min_score: float, block_size: int = 1024) -> list[tuple[int, int, float]]:
+    """コサイン類似度がmin_score以上の組(i, j, score)を返す（i < j）。
+    行列全体ではなく、block_size行ずつ類似度を求める。"""
+    pairs = []
+    n = len(matrix)
+    for start in range(0, n, block_size):
+        block = matrix[start:start + block_size] @ matrix.T
+        # 対角成分と、下三角（同じ組の重複）を除く
+        rows, cols = np.nonzero(block >= min_score)
+        keep = cols > rows + start
+        for i, j in zip(rows[keep], cols[keep]):
+            pairs.append((start + int(i), int(j), float(block[i, j])))
+    return pairs
+
+
+def to_candidate(label: str, a: dict, b: dict, score: float) -> dict:
+    # リレーションシップの多い方（同数の場合は、名前の短い方）をtargetにする
+    target, duplicate = sorted([a, b], key=lambda p: (-p["degree"], len(p["name"]), p["id"]))
+    return {
+        "score": round(score, 4),
+        "same_stem": remove_suffix(a["name"]) == remove_suffix(b["name"]),
+        "target": {"label": label, "name": target["name"]},
+        "duplicates": [{"label": label, "name": duplicate["name"]}],
+    }
+
+
+async def find_candidates(min_score: float, labels: list[str] | None = None) -> list[dict]:
+    profiles_by_label = defaultdict(list)
+    async for profiles in stream_entity_profiles():
+        for profile in profiles:
+            if labels is None or profile["label"] in labels:
+                profiles_by_label[profile["label"]].append(profile)
+
+    candidates = []
+    for label, profiles in profiles_by_label.items():
+        if len(profiles) < 2:
+            continue
+        matrix = await embed_profiles(profiles)
+        pairs = similar_pairs(matrix, min_score)
+        candidates.extend(to_candidate(label, profiles[i], profiles[j], score) for i, j, score in pairs)
+        logger.info(f"{label}: {len(pairs)} candidates in {len(profiles)} nodes.")
+    candidates.sort(key=lambda c: c["score"], reverse=True)
+    return candidates
+
+
+async def main(args: argparse.Namespace):
+    try:
+        candidates = await find_candidates(args.min_score, args.label)
+    finally:
+        await close_driver()
+    with open(args.output, "w", encoding="utf-8") as f:
+        for candidate in candidates[:args.limit]:
+            f.write(json.dumps(candidate, ensure_ascii=False) + "\n")
+    logger.info(f"{min(len(candidates), args.limit or len(candidates))} candidates written to {args.output}.")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(funcName)s]: %(message)s")
+    parser = argparse.ArgumentParser(description="重複しているEntityの候補を検出する")
+    parser.add_argument("output", help="候補を書き込むJSONLファイルのパス")
+    parser.add_argument("--min-score", type=float, default=0.93, help="候補とするコサイン類似度の下限")
+    parser.add_argument("--label", action="append", default=None, help="対象のラベル（複数指定可。省略時はすべて）")
+    parser.add_argument("--limit", type=int, default=None, help="出力する候補の上限")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,192 @@
+"""過去の会話ログ（JSONL）を、Title, Message, Entityのグラフとして一括でインポートする。
+
+1行1メッセージのJSONLを先頭から順に読み、batch_size行ごとに、
+    1. Messageのベクトルを1リクエストでまとめて作成する
+    2. user_inputからのTriplets抽出を、同時実行数を制限して並行に行う
+    3. Tripletsをstore_triplets、MessageをUNWINDでまとめて保存する
+    4. 保存済みの行数をチェックポイントに書き込む
+を繰り返す。中断した場合、同じコマンドで再実行すると、チェックポイントの次の行から再開する。
+Messageには、入力の行ごとに一意なimport_key（<key_prefix>:<行番号>）を保存し、保存済みの行は作成しない。
+Messageの保存後、チェックポイントの書き込み前に中断した場合も、再開したバッチのMessageは重複しない。
+Messageは、Titleごとにcreate_timeの順で既存のMessageの間に繋ぐため、現在の会話より前のログもインポートできる。
+
+各行のキー:
+    title, user_input, ai_response（必須）
+    source, AI（省略時は、--user, --aiの値）
+    create_time（ISO 8601。省略時は、インポート時刻）
+
+実行例:
+    python -m chat_wb.jobs.importer archive.jsonl --batch-size 100 --concurrency 8
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from logging import getLogger
+from openai import AsyncOpenAI
+from chat_wb.models import Triplets
+from chat_wb.neo4j.driver import close_driver
+from chat_wb.neo4j.schema import ensure_schema
+from chat_wb.neo4j.memory import check_index, store_messages, message_embedding_text
+from chat_wb.neo4j.neo4j import store_triplets
+from chat_wb.neo4j.triplet import TripletsConverter
+from openai_api.common import aget_embeddings
+
+# ロガー設定
+logger = getLogger(__name__)
+
+
+# チェックポイント
+def load_checkpoint(path: str) -> dict:
+    if not os.path.exists(path):
+        return {"line": 0}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    """書き込み途中で中断しても壊れないよう、一時ファイルに書いてから置き換える"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+# 入力
+def read_batches(path: str, batch_size: int, start_line: int = 0):
+    """start_line行目の次から、(最後の行番号, (行番号, 行)のリスト)をbatch_size行ずつ返す。空行、不正な行は読み飛ばす。"""
+    batch = []
+    line_number = 0
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if line_number <= start_line or not line.strip():
+                continue
+            try:
+                batch.append((line_number, json.loads(line)))
+            except json.JSONDecodeError:
+                logger.error(f"Invalid JSON at line {line_number}. skipped.")
+                continue
+            if len(batch) >= batch_size:
+                yield line_number, batch
+                batch = []
+    if batch:
+        yield line_number, batch
+
+
+class MessageImporter:
+    """JSONLの会話ログを、バッチごとにNeo4jへ保存する"""
+
+    def __init__(
+        self,
+        user_name: str = "彩澄しゅお",
+        ai_name: str = "彩澄りりせ",
+        concurrency: int = 8,
+        extract: bool = True,
+        key_prefix: str = "",
+    ):
+        self.client = AsyncOpenAI()
+        self.user_name = user_name
+        self.ai_name = ai_name
+        self.semaphore = asyncio.Semaphore(concurrency)     # Triplets抽出の同時実行数
+        self.extract = extract
+        self.key_prefix = key_prefix    # import_keyの接頭辞（入力ファイルごとに一意な値）
+
+    async def extract_triplets(self, text: str) -> Triplets | None:
+        if not self.extract:
+            return None
+        async with self.semaphore:
+            converter = TripletsConverter(client=self.client, user_name=self.user_name, ai_name=self.ai_name, short_memory=[])
+            try:
+                return await converter.run_sequences(text)
+            except Exception as e:
+                # 1行の失敗でインポート全体を止めない（Messageは、Entityなしで保存する）
+                logger.error(f"Triplets extraction failed: {e}")
+                return None
+
+    async def import_batch(self, lines: list[tuple[int, dict]]) -> int:
+        now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        messages = []
+        for line_number, line in lines:
+            if not line.get("title") or not line.get("user_input") or line.get("ai_response") is None:
+                logger.error(f"Required keys are missing. skipped: {line}")
+                continue
+            messages.append({
+                "import_key": f"{self.key_prefix}:{line_number}",
+                "title": line["title"],
+                "source": line.get("source") or self.user_name,
+                "user_input": line["user_input"],
+                "AI": line.get("AI") or self.ai_name,
+                "ai_response": line["ai_response"],
+                "create_time": line.get("create_time") or now,
+            })
+        if not messages:
+            return 0
+
+        # ベクトル作成とTriplets抽出を並行して行う
+        texts = [message_embedding_text(m["source"], m["user_input"], m["AI"], m["ai_response"]) for m in messages]
+        vectors, *triplets_list = await asyncio.gather(
+            aget_embeddings(texts),
+            *[self.extract_triplets(m["user_input"]) for m in messages],
+        )
+
+        # Entityを先に保存してから、Messageからのリレーションを作成する
+        triplets = Triplets(
+            nodes=[node for t in triplets_list if t for node in t.nodes],
+            relationships=[relationship for t in triplets_list if t for relationship in t.relationships],
+        )
+        if triplets.nodes or triplets.relationships:
+            await store_triplets(triplets)
+
+        for m, vector, user_input_entity in zip(messages, vectors, triplets_list):
+            m["vector"] = vector
+            m["user_input_entity"] = user_input_entity
+        await store_messages(messages)
+        return len(messages)
+
+    async def run(self, path: str, checkpoint_path: str, batch_size: int = 100):
+        checkpoint = load_checkpoint(checkpoint_path)
+        if checkpoint["line"]:
+            logger.info(f"Resume from line {checkpoint['line'] + 1}.")
+
+        total = 0
+        for line_number, lines in read_batches(path, batch_size, checkpoint["line"]):
+            total += await self.import_batch(lines)
+            # バッチの保存が完了してから、チェックポイントを進める
+            checkpoint = {"line": line_number}
+            save_checkpoint(checkpoint_path, checkpoint)
+            logger.info(f"Imported {total} messages (line {line_number}).")
+        return total
+
+
+async def main(args: argparse.Namespace):
+    # FastAPIのlifespanと同じく、制約、インデックスを確認してから書き込む
+    await ensure_schema()
+    await check_index()
+    importer = MessageImporter(
+        user_name=args.user,
+        ai_name=args.ai,
+        concurrency=args.concurrency,
+        extract=not args.no_extract,
+        key_prefix=args.key_prefix or os.path.basename(args.path),
+    )
+    try:
+        total = await importer.run(args.path, args.checkpoint or f"{args.path}.checkpoint", args.batch_size)
+        logger.info(f"Import finished. {total} messages.")
+    finally:
+        await close_driver()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(funcName)s]: %(message)s")
+    parser = argparse.ArgumentParser(description="会話ログ（JSONL）をNeo4jにインポートする")
+    parser.add_argument("path", help="JSONLファイルのパス")
+    parser.add_argument("--checkpoint", default=None, help="チェックポイントファイルのパス（省略時は、<path>.checkpoint）")
+    parser.add_argument("--batch-size", type=int, default=100, help="1トランザクションで保存する行数")
+    parser.add_argument("--concurrency", type=int, default=8, help="Triplets抽出の同時実行数")
+    parser.add_argument("--user", default="彩澄しゅお", help="source省略時のユーザー名")
+    parser.add_argument("--ai", default="彩澄りりせ", help="AI省略時のAI名")
+    parser.add_argument("--key-prefix", default=None, help="import_keyの接頭辞（省略時は、ファイル名。同じ入力を別名で再実行する場合に指定する）")
+    parser.add_argument("--no-extract", action="store_true", help="Triplets抽出を行わず、Messageのみ保存する")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,64 @@
+"""重複Entityのグループを、まとめて統合する。
+
+入力は、1行1グループのJSONL:
+    {"target": {"label": "Person", "name": "彩澄りりせ"}, "duplicates": [{"label": "Person", "name": "りりせ"}]}
+グループごとに1つのトランザクションで、名前、プロパティ、リレーションシップを統合し、重複ノードを削除する。
+--dry-runでは書き込みを行わず、統合後の名前、プロパティと、移すリレーションシップの数を出力する。
+
+実行例:
+    python -m chat_wb.jobs.merge groups.jsonl --dry-run
+"""
+import argparse
+import asyncio
+import json
+import logging
+from logging import getLogger
+from pydantic import ValidationError
+from chat_wb.cache import invalidate_node_names
+from chat_wb.models import MergeGroup
+from chat_wb.neo4j.driver import close_driver
+from chat_wb.neo4j.neo4j import merge_node_group
+
+# ロガー設定
+logger = getLogger(__name__)
+
+
+def read_groups(path: str) -> list[MergeGroup]:
+    """JSONLからMergeGroupを読み込む。propertiesは省略できる。不正な行は読み飛ばす。"""
+    groups = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+                for node in [data.get("target") or {}, *data.get("duplicates", [])]:
+                    node.setdefault("properties", None)
+                groups.append(MergeGroup.model_validate(data))
+            except (json.JSONDecodeError, ValidationError, AttributeError) as e:
+                logger.error(f"Invalid group at line {line_number}. skipped. {e}")
+    return groups
+
+
+async def main(args: argparse.Namespace):
+    groups = read_groups(args.path)
+    merged = 0
+    try:
+        for group in groups:
+            result = await merge_node_group(group, args.dry_run)
+            print(json.dumps(result, ensure_ascii=False, default=str))
+            if result["status"]:
+                merged += result["merged"]
+    finally:
+        await close_driver()
+    if not args.dry_run:
+        invalidate_node_names([node.label for group in groups for node in [group.target, *group.duplicates]])
+    logger.info(f"{merged} nodes {'will be merged' if args.dry_run else 'merged'} in {len(groups)} groups.")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(funcName)s]: %(message)s")
+    parser = argparse.ArgumentParser(description="重複Entityのグループを統合する")
+    parser.add_argument("path", help="グループのJSONLファイルのパス")
+    parser.add_argument("--dry-run", action="store_true", help="書き込みを行わず、統合の見込みを出力する")
+    asyncio.run(main(parser.parse_args()))
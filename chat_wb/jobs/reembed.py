@@ -0,0 +1,144 @@
+"""Message, Titleのベクトルを、別のモデル、次元数で作り直す。
+
+現在のベクトル（EMBEDDING_PROPERTY）とインデックスは残したまま、新しいプロパティとベクトルインデックスを作成するため、
+作成中もアプリケーションは現在のインデックスで検索できる。
+
+手順:
+    1. build: 新しいインデックスを作成し、新しいプロパティを持たないMessage, Titleをベクトル化する
+       （中断した場合や、作成中に追加されたMessageは、再実行すると続きから処理する）
+    2. 環境変数EMBEDDING_MODEL, EMBEDDING_DIMENSIONS, EMBEDDING_PROPERTY, MESSAGE_VECTOR_INDEX, TITLE_VECTOR_INDEXを
+       新しい値に変更して、アプリケーションを再起動する。再起動の直前に、もう一度buildを実行する
+    3. drop: 古いプロパティとインデックスを削除する
+
+実行例:
+    python -m chat_wb.jobs.reembed build --model text-embedding-3-small --dimensions 512 --property embedding_v2 \\
+        --message-index Message_v2 --title-index Title_v2
+    python -m chat_wb.jobs.reembed drop --property embedding --message-index Message --title-index Title
+"""
+import argparse
+import asyncio
+import logging
+from logging import getLogger
+from chat_wb.neo4j.cypher import quote
+from chat_wb.neo4j.driver import driver, close_driver, read_query, write_query
+from chat_wb.neo4j.memory import create_vector_index, message_embedding_text
+from openai_api.common import aget_embeddings, embedding_dimensions, FIXED_DIMENSION_MODELS, MODEL_DIMENSIONS
+
+# ロガー設定
+logger = getLogger(__name__)
+
+# 新しいプロパティを持たないノードを、idの順に取得する
+PENDING_MESSAGES = """
+    MATCH (m:Message)
+    WHERE id(m) > $cursor AND m[$property] IS NULL
+    RETURN id(m) AS id, m.source AS source, m.user_input AS user_input, m.AI AS AI, m.ai_response AS ai_response
+    ORDER BY id(m)
+    LIMIT $limit
+    """
+
+PENDING_TITLES = """
+    MATCH (m:Title)
+    WHERE id(m) > $cursor AND m[$property] IS NULL AND m.title IS NOT NULL
+    RETURN id(m) AS id, m.title AS title
+    ORDER BY id(m)
+    LIMIT $limit
+    """
+
+UNWIND_SET_VECTORS = """
+    UNWIND $rows AS row
+    MATCH (m) WHERE id(m) = row.id
+    CALL db.create.setNodeVectorProperty(m, $property, row.vector)
+    RETURN count(m) AS count
+    """
+
+
+def resolve_dimensions(model: str, dimensions: int | None) -> int:
+    """ベクトルインデックスの次元数を、モデルが返すベクトルの次元数に合わせる。
+    次元数を指定できないモデル（ada-002）に、異なる次元数を指定した場合はエラーにする。"""
+    if model in FIXED_DIMENSION_MODELS and dimensions not in (None, MODEL_DIMENSIONS[model]):
+        raise ValueError(f"{model} does not support --dimensions {dimensions} (fixed at {MODEL_DIMENSIONS[model]}).")
+    resolved = embedding_dimensions(model, dimensions)
+    if resolved is None:
+        raise ValueError(f"--dimensions is required for {model}.")
+    return resolved
+
+
+def message_text(record) -> str:
+    return message_embedding_text(record["source"], record["user_input"], record["AI"], record["ai_response"])
+
+
+def title_text(record) -> str:
+    return record["title"]
+
+
+async def reembed(label: str, query: str, to_text, args: argparse.Namespace) -> int:
+    cursor = -1
+    total = 0
+    while True:
+        records = await read_query(f"reembed.{label}.pending", query, cursor=cursor, property=args.property, limit=args.batch_size)
+        if not records:
+            return total
+        vectors = await aget_embeddings([to_text(record) for record in records], args.model, args.dimensions)
+        await write_query(
+            f"reembed.{label}.set",
+            UNWIND_SET_VECTORS,
+            rows=[{"id": record["id"], "vector": vector} for record, vector in zip(records, vectors)],
+            property=args.property,
+        )
+        cursor = records[-1]["id"]
+        total += len(records)
+        logger.info(f"{label}: {total} nodes re-embedded.")
+
+
+async def build(args: argparse.Namespace):
+    await create_vector_index(args.title_index, "Title", args.property, args.dimensions)
+    await create_vector_index(args.message_index, "Message", args.property, args.dimensions)
+    titles = await reembed("Title", PENDING_TITLES, title_text, args)
+    messages = await reembed("Message", PENDING_MESSAGES, message_text, args)
+    logger.info(f"Re-embedding finished. titles: {titles}, messages: {messages}.")
+
+
+async def drop(args: argparse.Namespace):
+    async with driver.session() as session:
+        for index in [args.title_index, args.message_index]:
+            await session.run(f"DROP INDEX {quote(index)} IF EXISTS")
+        # CALL { } IN TRANSACTIONSは、auto-commitトランザクションでのみ実行できる。
+        result = await session.run(
+            f"""
+            MATCH (m)
+            WHERE (m:Message OR m:Title) AND m.{quote(args.property)} IS NOT NULL
+            CALL {{
+                WITH m
+                REMOVE m.{quote(args.property)}
+            }} IN TRANSACTIONS OF {int(args.batch_size)} ROWS
+            RETURN count(m) AS count
+            """
+        )
+        record = await result.single()
+    logger.info(f"Property {args.property} removed from {record['count'] if record else 0} nodes.")
+
+
+async def main(args: argparse.Namespace):
+    try:
+        await (build(args) if args.command == "build" else drop(args))
+    finally:
+        await close_driver()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(funcName)s]: %(message)s")
+    parser = argparse.ArgumentParser(description="Message, Titleのベクトルを、別のモデル、次元数で作り直す")
+    parser.add_argument("command", choices=["build", "drop"], help="build: 新しいベクトルを作成する, drop: 古いベクトルを削除する")
+    parser.add_argument("--property", required=True, help="ベクトルを保存する（dropでは、削除する）プロパティ")
+    parser.add_argument("--message-index", required=True, help="Messageのベクトルインデックス名")
+    parser.add_argument("--title-index", required=True, help="Titleのベクトルインデックス名")
+    parser.add_argument("--model", default="text-embedding-3-small", help="ベクトル化のモデル")
+    parser.add_argument("--dimensions", type=int, default=None, help="ベクトルの次元数（省略時は、モデルの既定の次元数）")
+    parser.add_argument("--batch-size", type=int, default=500, help="1リクエスト、1トランザクションで処理するノード数")
+    args = parser.parse_args()
+    if args.command == "build":
+        try:
+            args.dimensions = resolve_dimensions(args.model, args.dimensions)
+        except ValueError as e:
+            parser.error(str(e))
+    asyncio.run(main(args))
@@ -1,8 +1,3 @@
-from chat_wb.cache import (
-    fetch_labels,
-    fetch_relationships,
-)
-
 # code blockを要約するプロンプト
 CODE_SUMMARIZER_PROMPT = """
 Provide a summary of the code blocks and logs in a few sentences.
@@ -29,9 +24,6 @@ Output json format is here.
 """
 
 # fetch_label_and_relationship_type_sets
-
-NODE_LABELS = fetch_labels()
-RELATION_TYPES = fetch_relationships()
 RELATION_SETS = None  # fetch_label_and_relationship_type_sets()
 
 
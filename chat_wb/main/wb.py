@@ -13,8 +13,9 @@ from openai_api.models import ChatPrompt
 from chat_wb.voice.voicepeak import playVoicePeak
 from chat_wb.neo4j.triplet import TripletsConverter
 from chat_wb.neo4j.neo4j import get_node, get_node_relationships_between, get_node_relationships
-from chat_wb.neo4j.memory import query_messages, get_messages, get_message_entities
+from chat_wb.neo4j.memory import query_messages, hybrid_query_messages, get_messages, get_message_entities
 from chat_wb.models import Triplets, WebSocketInputData, ShortMemory, remove_suffix, MessageNode
+import config
 logger = getLogger(__name__)
 
 
@@ -91,11 +92,11 @@ class StreamChatClient():
 
         # load short_memory
         short_memory = []
-        messages = get_messages(self.title, n=self.short_memory_limit)
+        messages = await get_messages(self.title, n=self.short_memory_limit)
         if messages:
             node_ids = [message.id for message in messages]
             latest_message_id = node_ids[0]
-            short_memory = get_message_entities(node_ids)
+            short_memory = await get_message_entities(node_ids)
 
             self.latest_message_id = latest_message_id
         self.short_memory = ShortMemory(short_memory=short_memory, limit=self.short_memory_limit)
@@ -268,12 +269,22 @@ class StreamChatClient():
 # Get memory
     async def wb_get_memory(self, websocket: WebSocket | None = None):
         """①user_inputに関連するmessageをベクトル検索し、関連するnode, relationshipを取得する。
-        ②user_inputのentityを取得し、関連するnode, relationshipを取得する。"""
-
-        message_retrieved_memory, entity_retrieved_memory = await asyncio.gather(
-            self._retrieve_message_entity(self.user_input),
-            self._retrieve_entity(self.user_input)
-        )
+        ②user_inputのentityを取得し、関連するnode, relationshipを取得する。
+        ハイブリッド検索が有効な場合、①をベクトル検索と全文検索で行い、user_inputに含まれるEntity名が
+        全文検索で見つかれば、②のLLMによるentityの抽出を省略する。ハイブリッド検索は①②と並行して開始し、
+        ①②は、それぞれ結果が必要になった時点で待つ。"""
+        hybrid = None
+        if config.MESSAGE_HYBRID_SEARCH_ENABLED:
+            hybrid = asyncio.ensure_future(hybrid_query_messages(self.user_input, exclude_names=self.character_name_lsit))
+
+        try:
+            message_retrieved_memory, entity_retrieved_memory = await asyncio.gather(
+                self._retrieve_message_entity(self.user_input, hybrid=hybrid),
+                self._retrieve_entity(self.user_input, hybrid=hybrid)
+            )
+        finally:
+            if hybrid and not hybrid.done():
+                hybrid.cancel()
         logger.info(f"message_retrieved_memory: {len(message_retrieved_memory.nodes)} nodes, {len(message_retrieved_memory.relationships)} relationships" if message_retrieved_memory else "message_retrieved_memory: None")
         logger.info(f"entity_retrieved_memory: {len(entity_retrieved_memory.nodes)} nodes, {len(entity_retrieved_memory.relationships)} relationships" if entity_retrieved_memory else "entity_retrieved_memory: None")
 
@@ -297,12 +308,16 @@ class StreamChatClient():
                            "retrieved_memory":  self.retrieved_memory.model_dump_json()}   # related entity
                 await websocket.send_text(json.dumps(message))
 
-    async def _retrieve_message_entity(self, text: str, **kwargs):
-        """ベクトル検索したmessageから、深さn-1までのentityを抽出する。合計1秒程度。"""
+    async def _retrieve_message_entity(self, text: str, hybrid: asyncio.Future | None = None, **kwargs):
+        """ベクトル検索したmessageから、深さn-1までのentityを抽出する。合計1秒程度。
+        hybridを指定した場合は、検索せずに、ハイブリッド検索のmessageを使う。"""
         depth = self.short_memory_depth - 1 if self.short_memory_depth > 1 else 1
 
         # ベクトル検索したmessageを最大k個取得する
-        messages = await query_messages(query=text, **kwargs)
+        if hybrid is not None:
+            messages, _ = await hybrid
+        else:
+            messages = await query_messages(query=text, **kwargs)
 
         # Messageのuser_input_nameから、entity名を抽出する。
         entities = set()
@@ -318,12 +333,21 @@ class StreamChatClient():
         # entityから、深さn-1までのnode, relationshipを取得する。
         return await get_node_relationships(names=entities, depth=depth)
 
-    async def _retrieve_entity(self, text: str):
-        """user_inputから、深さnまでのentityを抽出する。合計3秒程度。"""
+    async def _retrieve_entity(self, text: str, hybrid: asyncio.Future | None = None):
+        """user_inputから、深さnまでのentityを抽出する。合計3秒程度。
+        hybridを指定した場合は、その全文検索で見つかったEntity名がENTITY_FULLTEXT_MIN_MATCHES以上あれば、
+        LLMによる抽出を行わずにそれを使う。"""
         depth = self.short_memory_depth if self.short_memory_depth > 1 else 1
 
+        entities = None
+        if hybrid is not None:
+            _, entities = await hybrid
+            logger.info(f"fulltext entities: {entities}")
+            if len(entities) < config.ENTITY_FULLTEXT_MIN_MATCHES:
+                entities = None
+
         # user_inputから、entityを抽出する。
-        user_input_entity = await TripletsConverter(short_memory=self.short_memory.short_memory).extract_entites(text)
+        user_input_entity = entities or await TripletsConverter(short_memory=self.short_memory.short_memory).extract_entites(text)
         if user_input_entity:
             entities = [remove_suffix(entity) for entity in user_input_entity]                      # entityの末尾に付与されるsuffixを削除する。
             entities = [entity for entity in entities if entity not in self.character_name_lsit]    # entitiesから、user, aiのnameを除外する。
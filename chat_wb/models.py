@@ -300,3 +300,10 @@ class NodeHistory(BaseModel):
     node: Node
     relationships: list[Relationships] = []
     messages: list[MessageNode] = []
+    next_cursor: str | None = None  # 次のページのカーソル（最後のページではNone）
+
+
+class MergeGroup(BaseModel):
+    """重複ノードのグループ。duplicatesを、targetに統合して削除する。"""
+    target: Node
+    duplicates: list[Node]
@@ -0,0 +1,800 @@
+import re
+from functools import lru_cache
+from chat_wb.neo4j.schema import SYNC_ALIASES, MESSAGE_FULLTEXT_INDEX, ALIAS_FULLTEXT_INDEX
+import config
+
+# Cypherクエリのテンプレート
+# 値はすべてパラメータとして渡し、クエリ文字列に埋め込むのはラベルとリレーションタイプのみとする。
+# ラベル、タイプごとにクエリ文字列を固定することで、サーバーのプランキャッシュがヒットするようにする。
+# 生成したクエリ文字列は、lru_cacheで使い回す。
+
+
+def quote(identifier: str) -> str:
+    """ラベル、リレーションタイプをバッククォートでエスケープする"""
+    return "`" + identifier.replace("`", "``") + "`"
+
+
+def fulltext_query(text: str) -> str:
+    """全文検索（Lucene）のクエリ構文として解釈されないよう、特殊文字をエスケープし、AND, OR, NOTを小文字にする"""
+    escaped = re.sub(r'([+\-!(){}\[\]^"~*?:\\/&|])', r"\\\1", text)
+    return re.sub(r"\b(AND|OR|NOT)\b", lambda m: m.group(1).lower(), escaped).strip()
+
+
+def _append_properties(source: str, carry: str = "") -> str:
+    """sourceのプロパティ（値は文字列のリスト）を、上書きせずにnのリストへ追加する句
+    追加した値はリストの末尾に移し（新しい順に残すため）、$property_value_limitを超えた古い値は、PropertyArchiveに移す。
+    追加後のリストは、WITHで一度だけ計算する。carryは、句の後でも使う変数（nの他にWITHで引き継ぐ）。"""
+    carried = f", {carry}" if carry else ""
+    return f"""
+    WITH n{carried}, apoc.map.fromPairs([key IN keys({source}) |
+        [key, apoc.coll.toSet(CASE
+            WHEN n[key] IS NULL THEN {source}[key]
+            ELSE [v IN apoc.coll.flatten([n[key]]) WHERE NOT v IN {source}[key]] + {source}[key]
+        END)]
+    ]) AS merged
+    {_cap_properties("merged")}
+    """
+
+
+def _cap_properties(values: str) -> str:
+    """valuesのマップ（値は古い順のリスト）をnに設定する句
+    $property_value_limitを超えた古い値（リストの先頭）は、PropertyArchiveに移す。$uncapped_propertiesのキーには、上限を適用しない。"""
+    return f"""
+    FOREACH (key IN [key IN keys({values})
+        WHERE NOT key IN $uncapped_properties AND size({values}[key]) > $property_value_limit] |
+        {_archive_values("n", "key", f"{values}[key][..size({values}[key]) - $property_value_limit]")}
+    )
+    SET n += apoc.map.fromPairs([key IN keys({values}) |
+        [key, CASE
+            WHEN key IN $uncapped_properties OR size({values}[key]) <= $property_value_limit THEN {values}[key]
+            ELSE {values}[key][size({values}[key]) - $property_value_limit..]
+        END]
+    ])
+    """
+
+
+def _archive_values(node: str, key: str, values: str) -> str:
+    """nodeのプロパティkeyから外した値valuesを、PropertyArchiveに追加する句"""
+    return f"""MERGE ({node})-[:ARCHIVED]->(archive:PropertyArchive {{key: {key}}})
+        SET archive.values = apoc.coll.toSet(coalesce(archive.values, []) + {values}),
+            archive.update_time = datetime()"""
+
+
+# Node
+# $node_idは、名前解決のキャッシュのid。Aliasが指すノードに含まれる場合はそのノードを、
+# 含まれない場合（他のワーカーで統合、削除され、idが再利用された場合）は、Aliasが指すノードを更新する。
+UPDATE_NODE = f"""
+    MATCH (:Alias {{label: $label, name: $name}})-[:ALIAS_OF]->(n)
+    WITH n
+    ORDER BY id(n) = $node_id DESC, id(n)
+    LIMIT 1
+    {_append_properties("$properties")}
+    WITH n
+    {SYNC_ALIASES}
+    RETURN id(n) AS node_id
+    """
+
+UNWIND_UPDATE_NODES = f"""
+    UNWIND $rows AS row
+    MATCH (:Alias {{label: $label, name: row.name}})-[:ALIAS_OF]->(n)
+    {_append_properties("row.properties", "row")}
+    WITH row, n
+    {SYNC_ALIASES}
+    RETURN collect(DISTINCT row.name) AS names
+    """
+
+
+@lru_cache(maxsize=256)
+def create_node_query(label: str) -> str:
+    return f"""
+    MERGE (n:{quote(label)} {{name: $name}})
+    ON CREATE SET n += $properties
+    WITH n
+    {SYNC_ALIASES}
+    RETURN id(n) as node_id
+    """
+
+
+@lru_cache(maxsize=256)
+def unwind_create_nodes_query(label: str) -> str:
+    return f"""
+    UNWIND $rows AS row
+    MERGE (n:{quote(label)} {{name: row.name}})
+    ON CREATE SET n += row.create_properties
+    WITH n
+    {SYNC_ALIASES}
+    """
+
+
+@lru_cache(maxsize=256)
+def delete_node_query(label: str) -> str:
+    # 他のノードを指していないAlias、ノードのPropertyArchiveも削除する
+    return f"""
+    MATCH (n:{quote(label)} {{name: $name}})
+    OPTIONAL MATCH (a:Alias)-[:ALIAS_OF]->(n)
+    WITH n, id(n) AS node_id, collect(a) AS aliases
+    CALL {{
+        WITH n
+        MATCH (n)-[:ARCHIVED]->(archive:PropertyArchive)
+        DETACH DELETE archive
+    }}
+    DETACH DELETE n
+    WITH collect(node_id) AS node_ids, apoc.coll.flatten(collect(aliases)) AS aliases
+    CALL {{
+        WITH aliases
+        UNWIND aliases AS a
+        WITH a WHERE NOT (a)-[:ALIAS_OF]->()
+        DELETE a
+    }}
+    RETURN size(node_ids) as deleted_count, node_ids
+    """
+
+
+@lru_cache(maxsize=256)
+def node_names_query(label: str) -> str:
+    return f"""
+    MATCH (n:{quote(label)})
+    RETURN n.name as name
+    """
+
+
+# Title、Message、Aliasを除くすべてのノード
+_ENTITY_NODE_FILTER = """
+    WHERE NOT n:Title AND NOT n:Message AND NOT n:Alias AND NOT n:PropertyArchive
+    """
+
+ALL_NODES = f"""
+    MATCH (n)
+    {_ENTITY_NODE_FILTER}
+    RETURN labels(n) as label, n.name as name
+    """
+
+
+# ページングは、Entityのラベルごとに、name_{label}インデックスを(name, id)の順にシークする。
+# カーソルは、前のページの最後の(name, id)。n.name >= $nameで範囲シークし、インデックスの順序のまま
+# limit件で打ち切るため（PartialTop）、1ページのコストはグラフ全体の大きさによらない。
+# nameを持たないノードは含まない。
+@lru_cache(maxsize=256)
+def nodes_page_query(label: str) -> str:
+    return f"""
+    MATCH (n:{quote(label)})
+    WHERE n.name >= $name
+        AND (n.name > $name OR id(n) > $node_id)
+    RETURN id(n) as id, labels(n) as label, n.name as name
+    ORDER BY n.name, id(n)
+    LIMIT $limit
+    """
+
+
+# 重複候補の検出用（名前、プロパティと、リレーションシップの数）
+ENTITY_PROFILES = f"""
+    MATCH (n)
+    {_ENTITY_NODE_FILTER}
+        AND n.name IS NOT NULL
+    RETURN id(n) as id, head(labels(n)) as label, n.name as name, properties(n) as props,
+        COUNT {{ (n)--() }} as degree
+    """
+
+# Property Compaction
+# 値の数が$property_value_limitを超えているプロパティ
+OVERSIZED_PROPERTIES = f"""
+    MATCH (n)
+    {_ENTITY_NODE_FILTER}
+    WITH n, [key IN keys(n) WHERE key <> 'name' AND NOT key IN $uncapped_properties
+        AND apoc.meta.cypher.type(n[key]) STARTS WITH 'LIST'
+        AND size(n[key]) > $property_value_limit] AS oversized
+    UNWIND oversized AS key
+    RETURN id(n) AS node_id, key, n[key] AS values
+    """
+
+# Messageからのリレーションシップ（CONTAIN）に記録された、プロパティの値ごとの言及回数
+VALUE_FREQUENCIES = """
+    UNWIND $rows AS row
+    MATCH (n) WHERE id(n) = row.node_id
+    CALL {
+        WITH n, row
+        MATCH (:Message)-[r:CONTAIN]->(n)
+        WHERE r[row.key] IS NOT NULL
+        UNWIND apoc.coll.flatten([r[row.key]]) AS value
+        WITH toString(value) AS value, count(*) AS frequency
+        RETURN collect([value, frequency]) AS frequencies
+    }
+    RETURN row.node_id AS node_id, row.key AS key, frequencies
+    """
+
+# プロパティからrow.archiveの値を外して、PropertyArchiveに移す（読み取り後に追加された値は残す）
+UNWIND_COMPACT_PROPERTIES = f"""
+    UNWIND $rows AS row
+    MATCH (n) WHERE id(n) = row.node_id
+    SET n += apoc.map.fromPairs([[row.key, [v IN n[row.key] WHERE NOT v IN row.archive]]])
+    WITH n, row
+    {_archive_values("n", "row.key", "row.archive")}
+    RETURN count(n) AS count
+    """
+
+
+# Relationship
+# リレーションシップの始点、終点ノードをAliasから名前解決する（ラベルがNoneの場合、ラベルを問わない）
+MATCH_RELATIONSHIP_NODES = """
+    MATCH (a1:Alias {name: $start_node})-[:ALIAS_OF]->(n1)
+    WHERE $start_node_label IS NULL OR a1.label = $start_node_label
+    MATCH (a2:Alias {name: $end_node})-[:ALIAS_OF]->(n2)
+    WHERE $end_node_label IS NULL OR a2.label = $end_node_label
+    """
+
+UPDATE_RELATIONSHIP = """
+    MATCH ()-[r]->()
+    WHERE id(r) = $relationship_id
+    SET r += $properties
+    """
+
+
+@lru_cache(maxsize=256)
+def match_relationship_query(relation_type: str) -> str:
+    return f"""
+    {MATCH_RELATIONSHIP_NODES}
+    MATCH (n1)-[r:{quote(relation_type)}]->(n2)
+    RETURN id(r) as relationship_id
+    """
+
+
+@lru_cache(maxsize=256)
+def create_relationship_query(relation_type: str) -> str:
+    return f"""
+    {MATCH_RELATIONSHIP_NODES}
+    MERGE (n1)-[r:{quote(relation_type)}]->(n2)
+    ON CREATE SET r += $properties
+    RETURN id(r) as relationship_id, head(labels(n1)) AS start_label, head(labels(n2)) AS end_label
+    """
+
+
+@lru_cache(maxsize=256)
+def unwind_merge_relationships_query(relation_type: str) -> str:
+    return f"""
+    UNWIND $rows AS row
+    MATCH (a1:Alias {{name: row.start_node}})-[:ALIAS_OF]->(n1)
+    WHERE $start_node_label IS NULL OR a1.label = $start_node_label
+    MATCH (a2:Alias {{name: row.end_node}})-[:ALIAS_OF]->(n2)
+    WHERE $end_node_label IS NULL OR a2.label = $end_node_label
+    MERGE (n1)-[r:{quote(relation_type)}]->(n2)
+    SET r += row.properties
+    RETURN count(r) AS count, collect(DISTINCT [head(labels(n1)), head(labels(n2))]) AS label_pairs
+    """
+
+
+# Title、Message、Alias、PropertyArchiveを除くすべてのリレーションシップ
+_ENTITY_RELATIONSHIP_FILTER = """
+    WHERE NOT n:Title AND NOT n:Message AND NOT n:Alias
+        AND NOT m:Title AND NOT m:Message AND NOT m:PropertyArchive
+    """
+
+ALL_RELATIONSHIPS = f"""
+    MATCH (n)-[r]->(m)
+    {_ENTITY_RELATIONSHIP_FILTER}
+    RETURN type(r) AS type, n.name as start_node, m.name as end_node
+    """
+
+
+# 始点ノードのラベルごとに、nodes_page_queryと同じく始点のnameでシークし、(始点のname, 始点のid, id(r))の順に取得する。
+@lru_cache(maxsize=256)
+def relationships_page_query(label: str) -> str:
+    return f"""
+    MATCH (n:{quote(label)})
+    WHERE n.name >= $name
+    MATCH (n)-[r]->(m)
+    WHERE NOT m:Title AND NOT m:Message AND NOT m:PropertyArchive
+        AND (n.name > $name OR id(n) > $node_id OR (id(n) = $node_id AND id(r) > $relationship_id))
+    RETURN id(n) as node_id, id(r) as id, type(r) AS type, n.name as start_node, m.name as end_node
+    ORDER BY n.name, id(n), id(r)
+    LIMIT $limit
+    """
+
+
+# Integration
+@lru_cache(maxsize=256)
+def integrate_node_names_query(label1: str, label2: str) -> str:
+    return f"""
+    MATCH (n1:{quote(label1)} {{name: $name1}}), (n2:{quote(label2)} {{name: $name2}})
+    SET n1.name_variation = CASE
+        WHEN n1.name_variation IS NULL THEN [n1.name, n2.name]
+        ELSE apoc.coll.toSet(n1.name_variation + [n1.name, n2.name])
+    END
+    WITH n1 AS n
+    {SYNC_ALIASES}
+    RETURN properties(n)
+    """
+
+
+@lru_cache(maxsize=256)
+def node_properties_query(label: str) -> str:
+    return f"""
+    MATCH (n:{quote(label)} {{name: $name}})
+    RETURN properties(n) AS props
+    """
+
+
+@lru_cache(maxsize=256)
+def set_node_properties_query(label: str) -> str:
+    return f"""
+    MATCH (n:{quote(label)} {{name: $name}})
+    SET n = $props
+    WITH n
+    {SYNC_ALIASES}
+    RETURN properties(n)
+    """
+
+
+@lru_cache(maxsize=256)
+def move_relationships_query(label1: str, label2: str, direction: str) -> str:
+    """node2のリレーションシップをnode1に移す。directionは"from"（node2開始点）または"to"（node2終点）。
+    Aliasは、integrate_node_namesで作成済みのため移さない。"""
+    pattern = "(n2)-[r]->(m)" if direction == "from" else "(n2)<-[r]-(m)"
+    return f"""
+    MATCH (n2:{quote(label2)} {{name: $name2}})
+    MATCH {pattern}
+    WHERE type(r) <> 'ALIAS_OF'
+    MATCH (n1:{quote(label1)} {{name: $name1}})
+    CALL apoc.refactor.{direction}(r, n1)
+    YIELD input, output
+    RETURN DISTINCT head(labels(startNode(output))) AS start_label, type(output) AS type,
+        head(labels(endNode(output))) AS end_label
+    """
+
+
+# 同じkeyのPropertyArchiveが複数ある場合（統合で、各ノードのPropertyArchiveが移された場合）、1つにまとめる（直前のWITHでnを渡す）
+FOLD_PROPERTY_ARCHIVES = """
+    CALL {
+        WITH n
+        MATCH (n)-[:ARCHIVED]->(archive:PropertyArchive)
+        WITH n, archive.key AS key, collect(archive) AS archives
+        WHERE size(archives) > 1
+        WITH head(archives) AS kept, tail(archives) AS extra, archives
+        SET kept.values = apoc.coll.toSet(apoc.coll.flatten([a IN archives | coalesce(a.values, [])])),
+            kept.update_time = datetime()
+        FOREACH (a IN extra | DETACH DELETE a)
+    }
+"""
+
+
+# Bulk Merge
+# targetと重複ノード（id指定）の統合後の名前、プロパティと、移すリレーションシップを求める。
+# プロパティの値は、すべてのノードの値を合わせ、重複を除いたリストにする（targetの値を末尾にし、上限を超えた場合はtargetの値を残す）。
+_MERGE_NODES_PLAN = """
+    MATCH (t) WHERE id(t) = $target_id
+    OPTIONAL MATCH (d) WHERE id(d) IN $duplicate_ids AND d <> t
+    WITH t, collect(d) AS dups
+    WITH t, dups, [t] + dups AS group_nodes, head(labels(t)) AS label, t.name AS name
+    WITH t, dups, label, name,
+        apoc.coll.toSet(apoc.coll.flatten([n IN group_nodes | [n.name] + coalesce(n.name_variation, [])])) AS names,
+        apoc.map.fromPairs([key IN apoc.coll.toSet(apoc.coll.flatten([n IN group_nodes | keys(n)]))
+            WHERE NOT key IN ['name', 'name_variation'] |
+            [key, apoc.coll.toSet(apoc.coll.flatten([n IN dups + [t] WHERE n[key] IS NOT NULL | n[key]]))]
+        ]) AS props
+    CALL {
+        WITH t, dups, label
+        UNWIND dups AS d
+        MATCH (d)-[r]-(m)
+        WHERE type(r) <> 'ALIAS_OF' AND NOT m IN dups AND m <> t
+        RETURN count(r) AS relationship_count,
+            collect(DISTINCT CASE WHEN startNode(r) = d
+                THEN [label, type(r), head(labels(m))]
+                ELSE [head(labels(m)), type(r), label]
+            END) AS label_triples
+    }
+"""
+
+_MERGE_NODES_RETURN = """
+    RETURN size(dups) AS merged, label, name, names, props, relationship_count, label_triples
+"""
+
+# 統合せずに、結果の見込みを返す（dry run）
+MERGE_NODES_PREVIEW = _MERGE_NODES_PLAN + _MERGE_NODES_RETURN
+
+# 重複ノードのAliasを外し、apoc.refactor.mergeNodesでリレーションシップを移して削除する。
+# mergeNodesはラベルも合わせるため、targetのラベル以外は外す。最後に、targetのAliasを作り直す。
+MERGE_NODES = f"""
+    {_MERGE_NODES_PLAN}
+    CALL {{
+        WITH dups
+        UNWIND dups AS d
+        MATCH (a:Alias)-[s:ALIAS_OF]->(d)
+        DELETE s
+        RETURN collect(DISTINCT a) AS aliases
+    }}
+    CALL {{
+        WITH aliases
+        UNWIND aliases AS a
+        WITH a WHERE NOT (a)-[:ALIAS_OF]->()
+        DELETE a
+    }}
+    CALL apoc.refactor.mergeNodes([t] + dups, {{properties: 'discard', mergeRels: true, produceSelfRel: false}})
+    YIELD node
+    CALL apoc.create.removeLabels(node, [l IN labels(node) WHERE l <> label])
+    YIELD node AS n
+    {FOLD_PROPERTY_ARCHIVES}
+    WITH n, dups, label, name, names, props, relationship_count, label_triples
+    {_cap_properties("props")}
+    SET n.name = name, n.name_variation = names
+    WITH n, dups, label, name, names, props, relationship_count, label_triples
+    {SYNC_ALIASES}
+    {_MERGE_NODES_RETURN}
+"""
+
+
+# Message
+# Messageは、MessageNodeに必要なプロパティとidのマップとして返す（ノードのまま返すと、ベクトルも転送される）。
+# ベクトルが必要な場合のみ、with_embeddingでembeddingに含める。
+@lru_cache(maxsize=8)
+def message_projection(variable: str = "m", with_embedding: bool = False) -> str:
+    embedding = f", embedding: {variable}.{quote(config.EMBEDDING_PROPERTY)}" if with_embedding else ""
+    return (
+        f"{variable} {{.source, .user_input, .user_input_entity, .AI, .ai_response, .create_time, "
+        f"id: id({variable}){embedding}}}"
+    )
+
+
+# (:Title)-[:LATEST]->(:Message)から、FOLLOWを辿って最新のMessageを取得する（可変長パターンの長さはパラメータ化できないため、nごとにテンプレートを作る）
+@lru_cache(maxsize=64)
+def recent_messages_query(n: int) -> str:
+    """最新のn件のMessageを、新しい順に返す"""
+    return f"""
+    MATCH (:Title {{title: $title}})-[:LATEST]->(latest:Message)
+    MATCH path = (latest)-[:FOLLOW*0..{max(int(n) - 1, 0)}]->(m:Message)
+    RETURN {message_projection("m")} AS m
+    ORDER BY length(path)
+    """
+
+
+# LATESTからFOLLOWを辿れないMessage（former_node_idなしで保存されたもの、途中で途切れたもの）も含めて、
+# Titleの最新のn件を、create_timeの降順に返す。recent_messages_queryの結果がn件に満たない場合に使う。
+RECENT_MESSAGES_BY_TIME = f"""
+    MATCH (:Title {{title: $title}})-[:CONTAIN]->(m:Message)
+    RETURN {message_projection("m")} AS m
+    ORDER BY m.create_time DESC, id(m) DESC
+    LIMIT $n
+    """
+
+
+# 最新のMessageから、FOLLOWをn件辿ったMessageと、そのEntityを返す。
+# by_timeの場合は、LATESTを持たないTitle（chat_wb.jobs.backfillの実行前）のため、create_timeが最新のMessageから辿る。
+@lru_cache(maxsize=64)
+def latest_messages_query(n: int, by_time: bool = False) -> str:
+    if by_time:
+        start = """MATCH (:Title {title: $title})-[:CONTAIN]->(m:Message)
+    WITH m
+    ORDER BY m.create_time DESC, id(m) DESC
+    LIMIT 1"""
+    else:
+        start = "MATCH (:Title {title: $title})-[:LATEST]->(m:Message)"
+    return f"""
+    {start}
+    MATCH path = (m)-[:FOLLOW*0..{int(n)}]->(m2:Message)
+    WITH collect(path) AS paths, collect(m2) AS messages
+
+    UNWIND paths AS p
+    UNWIND relationships(p) AS rel
+    WITH messages, paths, collect(DISTINCT rel) AS pathRelationships
+
+    UNWIND messages AS message
+    OPTIONAL MATCH (message)-[r:CONTAIN]->(n1)
+    OPTIONAL MATCH (n1)-[r2]->(n2)
+
+    WITH messages, pathRelationships, collect(DISTINCT n1) AS entity, collect(DISTINCT r) AS r, collect(DISTINCT r2) AS r2, collect(DISTINCT n2) AS entity2
+    WITH messages + entity + entity2 AS nodes, pathRelationships + r + r2 AS relationships
+    RETURN nodes, relationships
+    """
+
+
+# Messageから、user_input_entityの各Entityへのリレーション（CONTAIN）を作成する（直前のWITHで、Messageをb、linksを渡す）
+# linksの各要素は{label, name, properties}。名前解決のキャッシュは他のワーカーでの削除、統合を反映せず、
+# 削除されたノードのidは再利用されるため、同じトランザクション内でAliasから解決したノードに繋ぐ。
+# 繋いだノードのid（見つからなかった場合はnull）をlinkedとして返す。
+LINK_MESSAGE_ENTITIES = """
+    CALL {
+        WITH b, links
+        UNWIND links AS link
+        OPTIONAL MATCH (:Alias {label: link.label, name: link.name})-[:ALIAS_OF]->(d)
+        FOREACH (_ IN CASE WHEN d IS NULL THEN [] ELSE [1] END |
+            CREATE (b)-[r:CONTAIN]->(d)
+            SET r = link.properties, r.create_time = b.create_time
+        )
+        RETURN collect({label: link.label, name: link.name, node_id: id(d)}) AS linked
+    }
+"""
+
+
+# Titleの最新のMessageへのLATESTを付け替える（直前のWITHで、Titleをa、Messageをbとして渡す）
+SET_LATEST_MESSAGE = """
+    CALL {
+        WITH a, b
+        OPTIONAL MATCH (a)-[old:LATEST]->()
+        DELETE old
+        WITH DISTINCT a, b
+        CREATE (a)-[:LATEST]->(b)
+    }
+"""
+
+
+# Messageを作成し、Titleの最新のMessageとする。$former_node_idがあれば、FOLLOW, PRECEDESで繋ぐ。
+STORE_MESSAGE = f"""
+    MERGE (a:Title {{title: $title}})
+    ON CREATE SET a.create_time = datetime($create_time), a.update_time = datetime($create_time)
+    ON MATCH SET a.update_time = datetime($create_time)
+    CREATE (b:Message {{
+        create_time: datetime($create_time),
+        source: $source,
+        user_input: $user_input,
+        user_input_entity: $user_input_entity,
+        AI: $AI,
+        ai_response: $ai_response
+    }})
+    CREATE (a)-[:CONTAIN]->(b)
+    WITH a, b
+    {SET_LATEST_MESSAGE}
+    WITH b
+    CALL db.create.setNodeVectorProperty(b, '{config.EMBEDDING_PROPERTY}', $vector)
+    WITH b
+    OPTIONAL MATCH (c:Message) WHERE id(c) = $former_node_id
+    FOREACH (_ IN CASE WHEN c IS NULL THEN [] ELSE [1] END |
+        CREATE (b)-[:FOLLOW]->(c)
+        CREATE (c)-[:PRECEDES]->(b)
+    )
+    RETURN {message_projection("b")} AS b
+    """
+
+
+# (Message)-[r:CONTAIN]->(Entity)の履歴を、r.create_time（Messageのcreate_time）の降順にlimit件取得する。
+# 指定された条件だけをWHEREに含める（パラメータのNULL判定をクエリに含めると、範囲インデックスを使えないため）。
+# カーソルは、前のページの最後の(r.create_time, id(r))。create_timeが同じリレーションシップは、idの降順に並べる。
+# EntityのCONTAINの数（次数）が$index_degreeを超える場合は、contain_create_timeインデックスを降順にシークし、
+# Entityへのリレーションシップのみ残して、limit件で打ち切る（PartialTop。次数によらず、読むのは新しい側のみ）。
+# 次数が小さい場合は、インデックスより、EntityからCONTAINを展開して並べ替える方が安いため、展開する。
+# 2つのサブクエリは、どちらか一方のみ実行され、実行されない方は空のリストを返す。
+@lru_cache(maxsize=8)
+def node_history_query(since: bool = False, until: bool = False, cursor: bool = False) -> str:
+    conditions = ["r.create_time IS NOT NULL"]
+    if since:
+        conditions.append("r.create_time >= datetime($since)")
+    if until:
+        conditions.append("r.create_time < datetime($until)")
+    if cursor:
+        conditions.append(
+            "(r.create_time < datetime($before) OR (r.create_time = datetime($before) AND id(r) < $before_id))"
+        )
+    where = " AND ".join(conditions)
+    return f"""
+    MATCH (:Alias {{label: $label, name: $name}})-[:ALIAS_OF]->(n)
+    WITH collect(n) AS nodes, sum(COUNT {{ (n)<-[:CONTAIN]-() }}) AS degree
+    CALL {{
+        WITH nodes, degree
+        WITH nodes WHERE degree > $index_degree
+        MATCH (m:Message)-[r:CONTAIN]->(n)
+        USING INDEX r:CONTAIN(create_time)
+        WHERE {where} AND n IN nodes
+        WITH m, r
+        ORDER BY r.create_time DESC, id(r) DESC
+        LIMIT $limit
+        RETURN collect({{m: {message_projection("m")}, r: r}}) AS indexed
+    }}
+    CALL {{
+        WITH nodes, degree
+        WITH nodes WHERE degree <= $index_degree
+        UNWIND nodes AS n
+        MATCH (m:Message)-[r:CONTAIN]->(n)
+        WHERE {where}
+        WITH m, r
+        ORDER BY r.create_time DESC, id(r) DESC
+        LIMIT $limit
+        RETURN collect({{m: {message_projection("m")}, r: r}}) AS expanded
+    }}
+    RETURN nodes[0] AS n, indexed + expanded AS history
+    """
+
+
+# ベクトルインデックスから$candidates件を取得し、スコア、期間、Titleの条件を満たす上位$k件を返す。
+# 候補数（fetched）と最低スコア（min_score）も返し、候補を増やして再検索するかの判断に使う。
+QUERY_MESSAGE_CANDIDATES = f"""
+    CALL db.index.vector.queryNodes('{config.MESSAGE_VECTOR_INDEX}', $candidates, $vector)
+    YIELD node, score
+    WITH collect({{node: node, score: score}}) AS candidates
+    CALL {{
+        WITH candidates
+        UNWIND candidates AS candidate
+        WITH candidate.node AS node, candidate.score AS score
+        WHERE score > $threshold AND node.create_time > datetime() - duration({{days: $time_threshold}})
+            AND ($titles IS NULL OR EXISTS {{ MATCH (t:Title)-[:CONTAIN]->(node) WHERE t.title IN $titles }})
+        WITH node, score
+        LIMIT $k
+        RETURN collect({{node: {message_projection("node")}, score: score}}) AS hits
+    }}
+    RETURN size(candidates) AS fetched,
+        CASE WHEN size(candidates) > 0 THEN candidates[-1].score END AS min_score,
+        hits
+    """
+
+# ベクトル検索の結果（id）から、Messageを取得する
+@lru_cache(maxsize=2)
+def messages_by_ids_query(with_embedding: bool = False) -> str:
+    return f"""
+    MATCH (m:Message)
+    WHERE id(m) IN $ids
+    RETURN {message_projection("m", with_embedding)} AS m
+    """
+
+
+# Messageの検索条件（期間、Title）
+def _message_filter(variable: str) -> str:
+    return (
+        f"{variable}.create_time > datetime() - duration({{days: $time_threshold}}) "
+        f"AND ($titles IS NULL OR EXISTS {{ MATCH (t:Title)-[:CONTAIN]->({variable}) WHERE t.title IN $titles }})"
+    )
+
+
+# ハイブリッド検索
+# 次の3つの順位を、Reciprocal Rank Fusion（Σ 1 / ($rrf_k + 順位)）で統合し、上位$k件のMessageを返す。
+#   1. ベクトル検索（スコアが$threshold以上）。local_vectorの場合は、プロセス内のインデックスの結果（$vector_ids）
+#   2. Messageのuser_input, ai_responseの全文検索
+#   3. $textに含まれるEntity名（Aliasの全文検索の候補のうち、名前が$textの部分文字列であるもの）を含むMessage
+# 3のEntityの名前も返し、LLMによるEntityの抽出の代わりに使う。
+@lru_cache(maxsize=2)
+def hybrid_query_messages_query(local_vector: bool = False) -> str:
+    if local_vector:
+        vector_ranked = """
+        UNWIND $vector_ids AS message_id
+        MATCH (node:Message) WHERE id(node) = message_id
+        RETURN collect(node) AS vector_ranked"""
+    else:
+        vector_ranked = f"""
+        CALL db.index.vector.queryNodes('{config.MESSAGE_VECTOR_INDEX}', $candidates, $vector)
+        YIELD node, score
+        WHERE score > $threshold AND {_message_filter("node")}
+        WITH node
+        RETURN collect(node) AS vector_ranked"""
+    return f"""
+    CALL {{
+        CALL db.index.fulltext.queryNodes('{ALIAS_FULLTEXT_INDEX}', $text_query, {{limit: $alias_candidates}})
+        YIELD node AS a
+        WHERE size(a.name) > 1 AND $text CONTAINS a.name AND NOT a.name IN $exclude_names
+        MATCH (a)-[:ALIAS_OF]->(n)
+        RETURN collect(DISTINCT n) AS entity_nodes
+    }}
+    CALL {{{vector_ranked}
+    }}
+    CALL {{
+        CALL db.index.fulltext.queryNodes('{MESSAGE_FULLTEXT_INDEX}', $text_query, {{limit: $candidates}})
+        YIELD node
+        WITH node WHERE {_message_filter("node")}
+        RETURN collect(node) AS text_ranked
+    }}
+    CALL {{
+        WITH entity_nodes
+        UNWIND entity_nodes AS n
+        MATCH (node:Message)-[:CONTAIN]->(n)
+        WHERE {_message_filter("node")}
+        WITH node, count(DISTINCT n) AS matches
+        ORDER BY matches DESC, node.create_time DESC
+        LIMIT $candidates
+        RETURN collect(node) AS entity_ranked
+    }}
+    CALL {{
+        WITH vector_ranked, text_ranked, entity_ranked
+        UNWIND [vector_ranked, text_ranked, entity_ranked] AS ranked
+        UNWIND range(0, size(ranked) - 1) AS rank
+        WITH ranked[rank] AS node, 1.0 / ($rrf_k + rank + 1) AS score
+        WITH node, sum(score) AS score
+        ORDER BY score DESC
+        LIMIT $k
+        RETURN collect({{node: {message_projection("node")}, score: score}}) AS hits
+    }}
+    RETURN hits, [n IN entity_nodes | n.name] AS entities
+    """
+
+
+# Titleのtitleを返す。update_timeの範囲インデックスから、降順に取得する。
+# update_timeが同じTitleは、idの降順に並べる（カーソルは、前のページの最後の(update_time, id(a))）。
+TITLES = """
+    MATCH (a:Title)
+    WHERE a.update_time IS NOT NULL AND a.title IS NOT NULL
+    RETURN a.title as title, a.update_time as update_time, id(a) AS id
+    ORDER BY a.update_time DESC, id(a) DESC
+    """
+
+TITLES_PAGE = """
+    MATCH (a:Title)
+    WHERE a.update_time <= datetime($before) AND a.title IS NOT NULL
+        AND (a.update_time < datetime($before) OR id(a) < $before_id)
+    RETURN a.title as title, a.update_time as update_time, id(a) AS id
+    ORDER BY a.update_time DESC, id(a) DESC
+    LIMIT $limit
+    """
+
+
+# Import
+# 複数のMessageをUNWINDで作成する（Title -[CONTAIN]-> Message -[CONTAIN]-> Entity）
+UNWIND_CREATE_MESSAGES = f"""
+    UNWIND $rows AS row
+    MERGE (a:Title {{title: row.title}})
+    ON CREATE SET a.create_time = datetime(row.create_time), a.update_time = datetime(row.create_time)
+    ON MATCH SET a.update_time = CASE
+        WHEN a.update_time IS NULL OR a.update_time < datetime(row.create_time) THEN datetime(row.create_time)
+        ELSE a.update_time
+    END
+    CREATE (b:Message {{
+        create_time: datetime(row.create_time),
+        source: row.source,
+        user_input: row.user_input,
+        user_input_entity: row.user_input_entity,
+        AI: row.AI,
+        ai_response: row.ai_response,
+        import_key: row.import_key
+    }})
+    CREATE (a)-[:CONTAIN]->(b)
+    WITH row, b
+    CALL db.create.setNodeVectorProperty(b, '{config.EMBEDDING_PROPERTY}', row.vector)
+    WITH row, b, row.entity_links AS links
+    {LINK_MESSAGE_ENTITIES}
+    RETURN row.index AS index, id(b) AS message_id, b.create_time.epochMillis AS create_time, linked
+    """
+
+# インポート済みのMessage（import_keyは、入力の行ごとに一意な値）
+IMPORTED_MESSAGE_IDS = """
+    UNWIND $import_keys AS import_key
+    MATCH (m:Message {import_key: import_key})
+    RETURN import_key, id(m) AS message_id
+    """
+
+# 作成したMessageを、create_timeの順に繋ぐために、Titleごとの既存のMessageの(id, create_time)を返す。
+# 作成したMessageの期間（since <= create_time <= until。UNIX時間のミリ秒）内のMessageと、その直前、直後のMessage。
+MESSAGE_NEIGHBORS = """
+    UNWIND $windows AS w
+    MATCH (a:Title {title: w.title})
+    CALL {
+        WITH a, w
+        MATCH (a)-[:CONTAIN]->(m:Message)
+        WHERE datetime({epochMillis: w.since}) <= m.create_time <= datetime({epochMillis: w.until})
+            AND NOT id(m) IN $created_ids
+        RETURN m
+        UNION
+        WITH a, w
+        MATCH (a)-[:CONTAIN]->(m:Message)
+        WHERE m.create_time < datetime({epochMillis: w.since}) AND NOT id(m) IN $created_ids
+        WITH m ORDER BY m.create_time DESC, id(m) DESC LIMIT 1
+        RETURN m
+        UNION
+        WITH a, w
+        MATCH (a)-[:CONTAIN]->(m:Message)
+        WHERE m.create_time > datetime({epochMillis: w.until}) AND NOT id(m) IN $created_ids
+        WITH m ORDER BY m.create_time ASC, id(m) ASC LIMIT 1
+        RETURN m
+    }
+    RETURN w.title AS title, id(m) AS message_id, m.create_time.epochMillis AS create_time
+    """
+
+UNWIND_FOLLOW_MESSAGES = """
+    UNWIND $links AS link
+    MATCH (b:Message) WHERE id(b) = link.message_id
+    MATCH (c:Message) WHERE id(c) = link.former_node_id
+    CREATE (b)-[:FOLLOW]->(c)
+    CREATE (c)-[:PRECEDES]->(b)
+    """
+
+# 間にMessageを挟む、既存のMessageの組のFOLLOW, PRECEDESを外す
+UNWIND_UNFOLLOW_MESSAGES = """
+    UNWIND $links AS link
+    MATCH (b:Message) WHERE id(b) = link.message_id
+    MATCH (c:Message) WHERE id(c) = link.former_node_id
+    OPTIONAL MATCH (b)-[follow:FOLLOW]->(c)
+    OPTIONAL MATCH (c)-[precedes:PRECEDES]->(b)
+    DELETE follow, precedes
+    """
+
+# 現在のLATESTより新しい場合のみ、LATESTを移す（過去の会話ログのインポートで、最新の会話を上書きしない）
+UNWIND_SET_LATEST_MESSAGES = f"""
+    UNWIND $latest AS row
+    MATCH (a:Title {{title: row.title}})
+    MATCH (b:Message) WHERE id(b) = row.message_id
+    OPTIONAL MATCH (a)-[:LATEST]->(c:Message)
+    WITH a, b, c
+    WHERE c IS NULL OR c.create_time <= b.create_time
+    {SET_LATEST_MESSAGE}
+    """
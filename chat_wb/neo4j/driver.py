@@ -0,0 +1,76 @@
+from logging import getLogger
+from neo4j import AsyncGraphDatabase, AsyncDriver, Record
+from chat_wb.neo4j.profiler import run_query
+import config
+
+# ロガー設定
+logger = getLogger(__name__)
+
+
+# プロセス全体で共有するドライバ（コネクションプール）の初期化
+# 接続は最初のクエリ実行時に確立されるため、import時にイベントループは不要。
+driver: AsyncDriver = AsyncGraphDatabase.driver(
+    config.NEO4J_URI,
+    auth=(config.NEO4J_USERNAME, config.NEO4J_PASSWORD),
+    max_connection_pool_size=config.NEO4J_MAX_CONNECTION_POOL_SIZE,
+    connection_acquisition_timeout=config.NEO4J_CONNECTION_ACQUISITION_TIMEOUT,
+    max_connection_lifetime=config.NEO4J_MAX_CONNECTION_LIFETIME,
+    liveness_check_timeout=config.NEO4J_LIVENESS_CHECK_TIMEOUT,    # プールから取り出す際、一定時間idleだった接続を確認する
+    fetch_size=config.NEO4J_FETCH_SIZE,
+    max_transaction_retry_time=config.NEO4J_MAX_TRANSACTION_RETRY_TIME,
+)
+
+
+# マネージドトランザクション
+# execute_readはリーダー（リードレプリカ）、execute_writeはリーダーにルーティングされ、
+# 一時的なエラー（リーダーの切り替え、デッドロック等）はトランザクション関数ごと再試行される。
+# トランザクション関数は再試行されるため、関数の外の状態を変更しないこと。
+async def read_transaction(work, *args, **kwargs):
+    """work(tx, *args, **kwargs)を読み取りトランザクションで実行する"""
+    async with driver.session() as session:
+        return await session.execute_read(work, *args, **kwargs)
+
+
+async def write_transaction(work, *args, **kwargs):
+    """work(tx, *args, **kwargs)を書き込みトランザクションで実行する"""
+    async with driver.session() as session:
+        return await session.execute_write(work, *args, **kwargs)
+
+
+async def read_query(name: str, query: str, **params) -> list[Record]:
+    """1つのクエリを、読み取りトランザクションで実行する"""
+    return await read_transaction(_run_query, name, query, params)
+
+
+async def write_query(name: str, query: str, **params) -> list[Record]:
+    """1つのクエリを、書き込みトランザクションで実行する"""
+    return await write_transaction(_run_query, name, query, params)
+
+
+async def _run_query(tx, name: str, query: str, params: dict) -> list[Record]:
+    return await run_query(tx, name, query, **params)
+
+
+async def health_check() -> dict:
+    """Neo4jへの接続を確認し、サーバー情報とプール設定を返す。"""
+    try:
+        server_info = await driver.get_server_info()
+    except Exception as e:
+        logger.error(f"Neo4j health check failed: {e}")
+        return {"status": False, "message": str(e)}
+    return {
+        "status": True,
+        "address": str(server_info.address),
+        "agent": server_info.agent,
+        "protocol_version": ".".join(map(str, server_info.protocol_version)),
+        "max_connection_pool_size": config.NEO4J_MAX_CONNECTION_POOL_SIZE,
+        "connection_acquisition_timeout": config.NEO4J_CONNECTION_ACQUISITION_TIMEOUT,
+        "max_connection_lifetime": config.NEO4J_MAX_CONNECTION_LIFETIME,
+        "fetch_size": config.NEO4J_FETCH_SIZE,
+    }
+
+
+async def close_driver():
+    """アプリケーション終了時に、コネクションプールを閉じる。"""
+    await driver.close()
+    logger.info("Neo4j driver closed.")
@@ -0,0 +1,76 @@
+import time
+from collections import OrderedDict
+from logging import getLogger
+
+# ロガー設定
+logger = getLogger(__name__)
+
+
+class NodeIdCache:
+    """(label, name or name_variation) -> node_idのリストを保持する、プロセス内のLRUキャッシュ。
+    label=Noneのキーは、ラベルを問わない名前解決の結果を表す。
+    見つからなかった名前はキャッシュしない（作成されたノードを見逃さないため）。
+    他のワーカーでの更新は検知できないため、ttl秒で期限切れとする。"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[tuple[str | None, str], tuple[float, list[int]]] = OrderedDict()
+        self._keys_by_id: dict[int, set[tuple[str | None, str]]] = {}
+
+    def get(self, label: str | None, name: str) -> list[int] | None:
+        key = (label, name)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expire, node_ids = entry
+        if expire < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return node_ids
+
+    def set(self, label: str | None, name: str, node_ids: list[int]):
+        if not node_ids:
+            return
+        key = (label, name)
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, list(node_ids))
+        for node_id in node_ids:
+            self._keys_by_id.setdefault(node_id, set()).add(key)
+        # 上限を超えたら、古いものから削除
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate_name(self, name: str):
+        """ラベルを問わず、nameのキーと、そのキーが指すノードのキーをすべて削除する"""
+        node_ids = set()
+        for key in [key for key in self._entries if key[1] == name]:
+            node_ids.update(self._entries[key][1])
+            self._remove(key)
+        self.invalidate_ids(node_ids)
+
+    def invalidate_ids(self, node_ids):
+        """node_idを指すキーをすべて削除する（name_variationの変更、ノードの削除時）"""
+        for node_id in node_ids:
+            for key in list(self._keys_by_id.get(node_id, ())):
+                self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._keys_by_id.clear()
+
+    def _remove(self, key: tuple[str | None, str]):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for node_id in entry[1]:
+            keys = self._keys_by_id.get(node_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_id[node_id]
+
+
+# プロセス全体で共有するキャッシュ
+node_id_cache = NodeIdCache()
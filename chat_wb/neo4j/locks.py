@@ -0,0 +1,34 @@
+import asyncio
+import zlib
+from contextlib import asynccontextmanager
+import config
+
+
+class LockStripes:
+    """キーをハッシュで固定数のasyncio.Lockに割り当てる、プロセス内のロックストライピング。
+    同じEntityを同時に更新するターン同士を直列化し、Neo4j上でのロック待ち、デッドロックを避ける。
+    複数のキーを取る場合は、ストライプ番号の昇順に取得するため、ロックを取る処理同士でデッドロックしない。
+    再入不可のため、ロックを保持したまま、ロックを取る関数を呼び出さないこと。"""
+
+    def __init__(self, stripes: int = 64):
+        self._locks = [asyncio.Lock() for _ in range(stripes)]
+
+    def _index(self, key: str) -> int:
+        return zlib.crc32(key.encode("utf-8")) % len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, keys):
+        indices = sorted({self._index(key) for key in keys if key})
+        acquired = []
+        try:
+            for i in indices:
+                await self._locks[i].acquire()
+                acquired.append(i)
+            yield
+        finally:
+            for i in reversed(acquired):
+                self._locks[i].release()
+
+
+# Entityの名前をキーとする（ラベルが不明なリレーションシップの名前解決でも、同じストライプになるようにする）
+entity_locks = LockStripes(config.NEO4J_ENTITY_LOCK_STRIPES)
@@ -1,248 +1,359 @@
-from neo4j import GraphDatabase
-import os
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from logging import getLogger
-from functools import lru_cache
+from chat_wb.neo4j.driver import driver, read_query, write_query, write_transaction
+from chat_wb.neo4j.cypher import (
+    STORE_MESSAGE,
+    TITLES,
+    TITLES_PAGE,
+    RECENT_MESSAGES_BY_TIME,
+    UNWIND_CREATE_MESSAGES,
+    MESSAGE_NEIGHBORS,
+    IMPORTED_MESSAGE_IDS,
+    UNWIND_FOLLOW_MESSAGES,
+    UNWIND_UNFOLLOW_MESSAGES,
+    UNWIND_SET_LATEST_MESSAGES,
+    QUERY_MESSAGE_CANDIDATES,
+    node_history_query,
+    quote,
+    recent_messages_query,
+    fulltext_query,
+    hybrid_query_messages_query,
+    latest_messages_query,
+    LINK_MESSAGE_ENTITIES,
+    message_projection,
+    messages_by_ids_query,
+)
+from chat_wb.neo4j.id_cache import node_id_cache
+from chat_wb.neo4j.locks import entity_locks
+from chat_wb.neo4j.profiler import run_query
+from chat_wb.neo4j.schema import register_relation_types
+from chat_wb.neo4j.vector_index import message_vector_index, exact_scores
 from chat_wb.models import WebSocketInputData, Triplets, TempMemory, MessageNode, NodeHistory
 from chat_wb.neo4j.neo4j import convert_neo4j_node_to_model, convert_neo4j_relationship_to_model, convert_neo4j_message_to_model
-from openai_api.common import get_embedding
+from openai_api.common import aget_embedding, embedding_dimensions
+import config
 
 # ロガー設定
 logger = getLogger(__name__)
 
 
-# ドライバの初期化
-uri = os.environ["NEO4J_URI"]
-username = "neo4j"
-password = os.environ["NEO4J_PASSWORD"]
-driver = GraphDatabase.driver(uri, auth=(username, password))
-
-
 # Vector Index
-def show_index() -> list[str]:
+async def show_index() -> list[str]:
     """NEO4jのインデックスを確認して、インデックス名をリストで返す"""
-    with driver.session() as session:
-        results = session.run(
+    async with driver.session() as session:
+        results = await session.run(
             """
         SHOW INDEXES YIELD name, type, labelsOrTypes, properties, options
         WHERE type = 'VECTOR'"""
         )
         response = []
-        for result in results:
+        async for result in results:
             response.append(result["name"])
         return response
 
 
-@lru_cache
-def check_index() -> list[str]:
-    """NEO4jのインデックスを確認して、ない場合、インデックスを作成する。"""
-    indices = show_index()
-    if "Title" not in indices:
-        with driver.session() as session:
-            # ラベルの作成
-            session.run("""CREATE (:Title)""")
-            session.run("""CREATE (:Message)""")
-            # インデックスの作成
-            session.run(
-                """CALL db.index.vector.createNodeIndex(
-                    $label, $label, 'embedding', 1536, 'cosine')""",
-                label="Title",
-            )
-            session.run(
-                """CALL db.index.vector.createNodeIndex(
-                    $label, $label, 'embedding', 1536, 'cosine')""",
-                label="Message",
-            )
-        indices = show_index()
-        logger.info(f"Vector Index created: {indices}")
+async def check_index() -> list[str]:
+    """NEO4jのインデックスを確認して、ない場合、インデックスを作成する。アプリケーション起動時に一度実行する。
+    インデックス名、プロパティは、configのTITLE_VECTOR_INDEX, MESSAGE_VECTOR_INDEX, EMBEDDING_PROPERTY。
+    次元数は、EMBEDDING_MODELが返す次元数（ada-002は1536。それ以外は、EMBEDDING_DIMENSIONS）。"""
+    indices = await show_index()
+    created = []
+    for name, label in [(config.TITLE_VECTOR_INDEX, "Title"), (config.MESSAGE_VECTOR_INDEX, "Message")]:
+        if name not in indices:
+            await create_vector_index(name, label, config.EMBEDDING_PROPERTY, embedding_dimensions())
+            created.append(name)
+    if created:
+        indices = await show_index()
+        logger.info(f"Vector Index created: {created}")
     else:
         logger.info(f"Vector Index already exists: {indices}")
 
     return indices
 
 
-NEO4J_INDEX = check_index()
+async def create_vector_index(name: str, label: str, property: str, dimensions: int):
+    """ベクトルインデックスを作成する（既に存在する場合は何もしない）"""
+    index_config = {"`vector.dimensions`": dimensions, "`vector.similarity_function`": "'cosine'"}
+    if config.NEO4J_VECTOR_QUANTIZATION:
+        index_config["`vector.quantization.enabled`"] = "true"
+    options = ", ".join(f"{key}: {value}" for key, value in index_config.items())
+    async with driver.session() as session:
+        await session.run(
+            f"""
+            CREATE VECTOR INDEX {quote(name)} IF NOT EXISTS
+            FOR (n:{quote(label)}) ON (n.{quote(property)})
+            OPTIONS {{indexConfig: {{{options}}}}}
+            """
+        )
 
 
 # Get Titles, Messages
-def get_messages(title: str, n: int) -> list[MessageNode]:
+async def get_messages(title: str, n: int) -> list[MessageNode]:
     """タイトルを指定して、最新のn個のメッセージを取得する"""
-    with driver.session() as session:
-        result = session.run(
-            """
-            MATCH (n:Title {title: $title})-[:CONTAIN]->(m:Message)
-            WITH m
-            ORDER BY m.create_time DESC
-            LIMIT $n
-            RETURN m
-            """,
-            title=title,
-            n=n
-        )
-        messages = []
-        for record in result:
-            message = convert_neo4j_message_to_model(record["m"])
-            messages.append(message) if message else None
+    if n < 1:
+        return []
+    # LATESTからFOLLOWを辿る（会話全体をcreate_timeでソートしない）
+    records = await read_query("get_messages", recent_messages_query(n), title=title)
+    if len(records) < n:
+        # 繋がっていないMessageがある場合、会話がn件より短い場合は、create_timeの順に取得する
+        records = await read_query("get_messages.by_time", RECENT_MESSAGES_BY_TIME, title=title, n=n)
+    messages = []
+    for record in records:
+        message = convert_neo4j_message_to_model(record["m"])
+        messages.append(message) if message else None
     return messages
 
 
-def get_latest_messages(title: str, n: int) -> Triplets | None:
+async def get_latest_messages(title: str, n: int) -> Triplets | None:
     """タイトルを指定して、Cytoscape表示用のMessage、Entity リレーションシップを取得する
         Title -[CONTAIN]-> Message -[CONTAIN] -> Entity"""
     n = n - 1 if n > 1 else 1
-    with driver.session() as session:
-        result = session.run(
-            f"""
-            MATCH (:Title {{title: $title}})-[:CONTAIN]->(m:Message)
-            WITH m
-            ORDER BY m.create_time DESC
-            LIMIT 1
-            MATCH path = (m)-[:FOLLOW*0..{n}]->(m2:Message)
-            WITH collect(path) AS paths, collect(m2) AS messages
-
-            UNWIND paths AS p
-            UNWIND relationships(p) AS rel
-            WITH messages, paths, collect(DISTINCT rel) AS pathRelationships
-
-            UNWIND messages AS message
-            OPTIONAL MATCH (message)-[r:CONTAIN]->(n1)
-            OPTIONAL MATCH (n1)-[r2]->(n2)
-
-            WITH messages, pathRelationships, collect(DISTINCT n1) AS entity, collect(DISTINCT r) AS r, collect(DISTINCT r2) AS r2, collect(DISTINCT n2) AS entity2
-            WITH messages + entity + entity2 AS nodes, pathRelationships + r + r2 AS relationships
-            RETURN nodes, relationships
-            """,
-            title=title,
-            n=n
-        ).single()
-
-        nodes = set()
-        relationships = set()
-        if result:
-            for node in result["nodes"]:
-                nodes.add(convert_neo4j_node_to_model(node))
-            for relationship in result["relationships"]:
-                relationships.add(convert_neo4j_relationship_to_model(relationship))
-            return Triplets(nodes=nodes, relationships=relationships)
-
-
-def get_titles() -> list[str]:
-    """タイトルのリストを取得する"""
-    with driver.session() as session:
-        results = session.run(
-            """
-            MATCH (a:Title)
-            WHERE a.title IS NOT NULL
-            RETURN a.title as title"""
-        )
-
-        nodes = []
-        for record in results:
-            nodes.append(record["title"])
+    records = await read_query(
+        "get_latest_messages",
+        latest_messages_query(n),
+        title=title,
+    )
+    if not records:
+        # LATESTがない場合は、get_messagesと同じく、create_timeの順に取得する
+        records = await read_query("get_latest_messages.by_time", latest_messages_query(n, by_time=True), title=title)
+    record = records[0] if records else None
+
+    nodes = set()
+    relationships = set()
+    if record:
+        for node in record["nodes"]:
+            nodes.add(convert_neo4j_node_to_model(node))
+        for relationship in record["relationships"]:
+            relationships.add(convert_neo4j_relationship_to_model(relationship))
+        return Triplets(nodes=nodes, relationships=relationships)
+
+
+async def get_titles() -> list[str]:
+    """タイトルのリストを、更新が新しい順に取得する"""
+    records = await read_query("get_titles", TITLES)
+
+    nodes = []
+    for record in records:
+        nodes.append(record["title"])
     return nodes
 
 
-def get_message_entities(node_ids: list[int]) -> list[TempMemory]:
+async def get_titles_page(before: str | None = None, limit: int = 50) -> tuple[list[str], str | None]:
+    """beforeのカーソルより後（古い方）のタイトルを、新しい順にlimit件取得する。
+    次のページのカーソル（最後の"update_time（ISO 8601）|id"）を返し、最後のページではNoneを返す。"""
+    if before is None:
+        records = await read_query("get_titles_page", TITLES + "\n    LIMIT $limit", limit=limit)
+    else:
+        before_time, before_id = before.rsplit("|", 1)
+        records = await read_query("get_titles_page", TITLES_PAGE, before=before_time, before_id=int(before_id), limit=limit)
+    titles = [record["title"] for record in records]
+    next_cursor = f"{records[-1]['update_time'].iso_format()}|{records[-1]['id']}" if len(records) == limit else None
+    return titles, next_cursor
+
+
+async def get_message_entities(node_ids: list[int]) -> list[TempMemory]:
     """Messageから、Entity -> Entityのノード、閉じたリレーションシップを取得する"""
-    with driver.session() as session:
-        result = session.run(
-            """
-            UNWIND $node_ids AS node_id
-                MATCH (m:Message)-[:CONTAIN]->(n)
-                WHERE id(m) = node_id
+    records = await read_query(
+        "get_message_entities",
+        f"""
+        UNWIND $node_ids AS node_id
+            MATCH (m:Message)-[:CONTAIN]->(n)
+            WHERE id(m) = node_id
+
+        WITH m, collect(n) AS entity
+        UNWIND entity as n1
+        UNWIND entity as n2
+            MATCH (n1)-[r]->(n2)
+
+        WITH m, entity, collect(r) AS relationships
+        RETURN collect({{message: {message_projection("m")}, entity: entity, relationships: relationships}}) AS result
+        """,
+        node_ids=node_ids,
+    )
+
+    # TempMemory(MessageとTripletsの集合)に変換する。
+    temp_memories: list[TempMemory] = []
+    for record in records:
+        for item in record["result"]:
+            message = convert_neo4j_message_to_model(item["message"])
+            # 各Messageに対するEntityとRelationshipsをTripletsに格納する。
+            entity = [convert_neo4j_node_to_model(e) for e in item["entity"]]
+            relationships = [convert_neo4j_relationship_to_model(r) for r in item["relationships"]]
+            if entity or relationships:
+                triplets = Triplets(nodes=entity, relationships=relationships)
+            else:
+                triplets = None
+
+            # TempMemoryを作成する
+            temp_memory = TempMemory(
+                message=message,
+                triplets=triplets,
+            )
+            temp_memories.append(temp_memory)
+    return temp_memories
 
-            WITH m, collect(n) AS entity
-            UNWIND entity as n1
-            UNWIND entity as n2
-                MATCH (n1)-[r]->(n2)
 
-            WITH m, entity, collect(r) AS relationships
-            RETURN collect({message: m, entity: entity, relationships: relationships}) AS result
-            """,
-            node_ids=node_ids,
+# Query vector index
+async def query_messages(
+    query: str,
+    k: int = 3,
+    threshold: float = 0.9,
+    time_threshold: int = 365,
+    titles: list[str] | None = None,
+) -> list[MessageNode]:
+    """ベクトル検索(user_input -> user_input + ai_response)でMessageを検索する。
+    titlesを指定した場合、それらのTitleのMessageから検索する。"""
+    vector = await aget_embedding(query)
+    if config.MESSAGE_VECTOR_INDEX_ENABLED and message_vector_index.ready:
+        # プロセス内のインデックスで、Title、期間で絞り込んでからスコアを計算し、上位k件のみDBから取得する
+        since = datetime.now(timezone.utc) - timedelta(days=time_threshold)
+        if message_vector_index.quantized:
+            # 量子化したベクトルで多めに候補を選び、元のベクトルでスコアを計算し直す
+            hits = message_vector_index.search(
+                vector, k * config.MESSAGE_VECTOR_RERANK_FACTOR, threshold - message_vector_index.error, since, titles
+            )
+        else:
+            hits = message_vector_index.search(vector, k, threshold, since, titles)
+        # 再計算する場合のみ、元のベクトルを取得する
+        records = await read_query(
+            "query_messages.fetch",
+            messages_by_ids_query(with_embedding=message_vector_index.quantized),
+            ids=[message_id for message_id, _ in hits],
         )
-
-        # TempMemory(MessageとTripletsの集合)に変換する。
-        temp_memories: list[TempMemory] = []
-        for record in result:
-            for item in record["result"]:
-                message = convert_neo4j_message_to_model(item["message"])
-                # 各Messageに対するEntityとRelationshipsをTripletsに格納する。
-                entity = [convert_neo4j_node_to_model(e) for e in item["entity"]]
-                relationships = [convert_neo4j_relationship_to_model(r) for r in item["relationships"]]
-                if entity or relationships:
-                    triplets = Triplets(nodes=entity, relationships=relationships)
-                else:
-                    triplets = None
-
-                # TempMemoryを作成する
-                temp_memory = TempMemory(
-                    message=message,
-                    triplets=triplets,
-                )
-                temp_memories.append(temp_memory)
-        return temp_memories
+        nodes = {record["m"]["id"]: record["m"] for record in records}
+        if message_vector_index.quantized:
+            candidates = [node for node in nodes.values() if node["embedding"] is not None]
+            scores = exact_scores(vector, [node["embedding"] for node in candidates])
+            hits = sorted(
+                ((node["id"], score) for node, score in zip(candidates, scores) if score > threshold),
+                key=lambda hit: hit[1],
+                reverse=True,
+            )[:k]
+        results = [(nodes[message_id], score) for message_id, score in hits if message_id in nodes]
+    else:
+        results = await _query_message_candidates(vector, k, threshold, time_threshold, titles)
+
+    messages = []
+    for node, score in results:
+        message = convert_neo4j_message_to_model(node)
+        if message:
+            score = round(score, 6)
+            logger.info(f"score: {score} message: {message.user_input}")
+            messages.append(message) if message else None
+    return messages
 
 
-# Query vector index
-async def query_messages(query: str, k: int = 3, threshold: float = 0.9, time_threshold: int = 365) -> list[MessageNode]:
-    """ベクトル検索(user_input -> user_input + ai_response)でMessageを検索する。"""
-    vector = get_embedding(query)
-    # queryNodes内で時間指定を行うことができないので、広めに取得してから、フィルタリングする。
-    init_k = k * 10 if k * 10 < 100 else 100
-    with driver.session() as session:
-        result = session.run(
-            """
-            CALL db.index.vector.queryNodes('Message', $init_k, $vector)
-            YIELD node, score
-            WHERE score > $threshold AND node.create_time > datetime() - duration({days: $time_threshold})
-            WITH node, score
-            LIMIT $k
-            RETURN node, score
-            """,
-            init_k=init_k,
+async def _query_message_candidates(
+    vector: list[float], k: int, threshold: float, time_threshold: int, titles: list[str] | None
+) -> list[tuple]:
+    """queryNodes内では時間、Titleを指定できないため、候補を取得してからフィルタリングする。
+    k件が条件を満たすまで、候補数を増やして再検索する（上限はMESSAGE_SEARCH_CANDIDATE_BUDGET）。
+    候補の最低スコアがthreshold以下になった場合、それ以上増やしても条件を満たす候補はないため、打ち切る。"""
+    budget = max(config.MESSAGE_SEARCH_CANDIDATE_BUDGET, k)
+    candidates = min(max(k * 4, 10), budget)
+    while True:
+        records = await read_query(
+            "query_messages",
+            QUERY_MESSAGE_CANDIDATES,
+            candidates=candidates,
             k=k,
             vector=vector,
             threshold=threshold,
             time_threshold=time_threshold,
+            titles=titles,
         )
-
-        messages = []
-        for record in result:
-            message = convert_neo4j_message_to_model(record["node"])
-            if message:
-                score = round(record["score"], 6)
-                logger.info(f"score: {score} message: {message.user_input}")
-                messages.append(message) if message else None
-    return messages
+        record = records[0]
+        hits = record["hits"]
+        exhausted = record["fetched"] < candidates or (record["min_score"] is not None and record["min_score"] <= threshold)
+        if len(hits) >= k or exhausted or candidates >= budget:
+            break
+        candidates = min(candidates * 4, budget)
+    logger.debug(f"query_messages: {len(hits)} hits in {record['fetched']} candidates.")
+    return [(hit["node"], hit["score"]) for hit in hits]
+
+
+async def hybrid_query_messages(
+    query: str,
+    k: int = 3,
+    threshold: float = 0.9,
+    time_threshold: int = 365,
+    titles: list[str] | None = None,
+    exclude_names: list[str] | None = None,
+) -> tuple[list[MessageNode], list[str]]:
+    """ベクトル検索と、全文検索（Messageの本文、queryに含まれるEntity名）の順位をRRFで統合して、Messageを検索する。
+    queryに含まれるEntity名（exclude_namesを除く）も返す。全文検索のクエリが空の場合は、ベクトル検索のみ行う。"""
+    text_query = fulltext_query(query)
+    if not text_query:
+        return await query_messages(query, k, threshold, time_threshold, titles), []
+
+    vector = await aget_embedding(query)
+    candidates = max(k * 4, 10)
+    local_vector = config.MESSAGE_VECTOR_INDEX_ENABLED and message_vector_index.ready
+    vector_ids = []
+    if local_vector:
+        # 順位のみ使うため、量子化したベクトルのスコアで並べる
+        since = datetime.now(timezone.utc) - timedelta(days=time_threshold)
+        vector_ids = [
+            message_id
+            for message_id, _ in message_vector_index.search(vector, candidates, threshold - message_vector_index.error, since, titles)
+        ]
+    records = await read_query(
+        "hybrid_query_messages",
+        hybrid_query_messages_query(local_vector),
+        text=query,
+        text_query=text_query,
+        vector=vector,
+        vector_ids=vector_ids,
+        candidates=candidates,
+        alias_candidates=100,
+        k=k,
+        threshold=threshold,
+        time_threshold=time_threshold,
+        titles=titles,
+        exclude_names=exclude_names or [],
+        rrf_k=config.MESSAGE_RRF_K,
+    )
+    record = records[0]
+
+    messages = []
+    for hit in record["hits"]:
+        message = convert_neo4j_message_to_model(hit["node"])
+        if message:
+            logger.info(f"rrf score: {round(hit['score'], 6)} message: {message.user_input}")
+            messages.append(message)
+    entities = list(dict.fromkeys(name for name in record["entities"] if name))
+    return messages, entities
 
 
 # Store Title and Messages
 async def create_and_update_title(title: str, new_title: str | None = None):
     """Titleノードを作成、更新する"""
     # title名でベクトル作成
-    pa_vector = get_embedding(new_title) if new_title else get_embedding(title)
+    pa_vector = await aget_embedding(new_title if new_title else title)
     # 現在のUTC日時を取得し、ISO 8601形式の文字列に変換
     current_utc_datetime = datetime.utcnow()
     current_time = current_utc_datetime.isoformat() + "Z"
 
-    with driver.session() as session:
-        session.run(
-            """
-            MERGE (a:Title {title: $title})
-            ON CREATE SET a.create_time = datetime($create_time), a.update_time = datetime($create_time), a.title = $new_title
-            ON MATCH SET a.update_time = datetime($update_time), a.title = $new_title
-            WITH a
-            CALL db.create.setNodeVectorProperty(a, 'embedding', $vector)
-            """,
-            title=title,
-            new_title=new_title if new_title else title,
-            create_time=current_time,
-            update_time=current_time,
-            vector=pa_vector,
-        )
-        logger.info(f"Title Node created: {title}")
-        return True
+    await write_query(
+        "create_and_update_title",
+        """
+        MERGE (a:Title {title: $title})
+        ON CREATE SET a.create_time = datetime($create_time), a.update_time = datetime($create_time), a.title = $new_title
+        ON MATCH SET a.update_time = datetime($update_time), a.title = $new_title
+        WITH a
+        CALL db.create.setNodeVectorProperty(a, $embedding_property, $vector)
+        """,
+        embedding_property=config.EMBEDDING_PROPERTY,
+        title=title,
+        new_title=new_title if new_title else title,
+        create_time=current_time,
+        update_time=current_time,
+        vector=pa_vector,
+    )
+    if config.MESSAGE_VECTOR_INDEX_ENABLED and new_title:
+        message_vector_index.rename_title(title, new_title)
+    logger.info(f"Title Node created: {title}")
+    return True
 
 
 async def store_message(
@@ -250,129 +361,294 @@ async def store_message(
     ai_response: str,
     user_input_entity: Triplets | None = None,
 ) -> MessageNode:
+    """Title, Message, Entityへのリレーションを1トランザクションで保存する。途中で失敗した場合、何も保存されない。"""
     source = input_data.source
-    title = input_data.title
     user_input = input_data.user_input
     AI = input_data.AI
-    former_node_id = input_data.former_node_id
     current_utc_datetime = datetime.utcnow()
     create_time = current_utc_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
-    update_time = create_time
 
-    with driver.session() as session:
-        # 親ノードを更新する(update_timeを更新する)
-        result = session.run(
-            """
-            MERGE (a:Title {title: $title})
-            ON CREATE SET a.create_time = datetime($create_time), a.update_time = datetime($create_time)
-            ON MATCH SET a.update_time = datetime($update_time)
-            RETURN id(a) AS title_id
-            """,
-            title=title,
-            create_time=create_time,
-            update_time=update_time,
-        )
-        title_id = result.single()["title_id"]
-
-        # メッセージノードを作成
-        embed_message = f"{source}: {user_input}\n {AI}: {ai_response}"
-        vector = get_embedding(embed_message)  # user_input, ai_responseのセットを保存し、user_inputでqueryする想定
-        result = session.run(
-            """
-            CREATE (b:Message {
-                create_time: datetime($create_time),
-                source: $source,
-                user_input: $user_input,
-                user_input_entity: $user_input_entity,
-                AI: $AI,
-                ai_response: $ai_response
-            })
-            WITH b
-            CALL db.create.setNodeVectorProperty(b, 'embedding', $vector)
-            RETURN b
-            """,
-            create_time=create_time,
-            source=source,
-            user_input=user_input,
-            user_input_entity=user_input_entity.model_dump_json() if user_input_entity else None,
-            AI=AI,
-            ai_response=ai_response,
-            vector=vector,
-        )
-        message = result.single()["b"]
-        message = convert_neo4j_message_to_model(message)
-        logger.info(f"Message Node created. message_id: {message.id}")
-
-        # 親ノード(Title)からのリレーション(CONTAIN)を作成する
-        session.run(
-            "MATCH (a), (b) WHERE id(a) = $title_id AND id(b) = $new_node_id CREATE (a)-[:CONTAIN]->(b)",
-            title_id=title_id,
-            new_node_id=message.id,
-        )
+    # セッションを開く前に、ベクトルを作成する
+    embed_message = message_embedding_text(source, user_input, AI, ai_response)
+    vector = await aget_embedding(embed_message)  # user_input, ai_responseのセットを保存し、user_inputでqueryする想定
 
-        # 前のノード(Message)からのリレーション(FOLLOW)と(PRECEDES)を作成
-        if former_node_id is not None:
-            session.run(
-                """MATCH (b), (c)
-                        WHERE id(b) = $new_node_id AND id(c) = $former_node_id
-                        CREATE (b)-[:FOLLOW]->(c)
-                        CREATE (c)-[:PRECEDES]->(b)""",
-                new_node_id=message.id,
-                former_node_id=former_node_id,
-            )
+    entity_links = entity_link_rows(user_input_entity)
 
-        # Messageからuser_input_entityの各Nodeへのリレーションを作成し、更新対象となったpropertyを保存する。
-        if user_input_entity is not None:
-            for node in user_input_entity.nodes:
-                properties = node.properties if node.properties is not None else {}
-                result = session.run(
-                    f"""
-                        MATCH (b) WHERE id(b) = $new_node_id
-                        MATCH (d:{node.label})
-                        WHERE d.name = $name OR $name IN d.name_variation
-                        CREATE (b)-[r:CONTAIN]->(d)
-                        SET r = $props
-                        RETURN id(d) as rel_id
-                    """,
-                    name=node.name,
-                    new_node_id=message.id,
-                    props=properties,
-                )
-                rel_id = result.single().get("rel_id")
-                if rel_id is None:
-                    logger.error(f"Relationship not created. (:Message)-[:CONTAIN]->({node.name}:{node.label})")
+    # Entityへのリレーション作成時にEntityのロックを取るため、同じEntityを更新する処理と直列化する
+    entity_names = [node.name for node in user_input_entity.nodes] if user_input_entity else []
+    async with entity_locks.hold(entity_names):
+        message, linked = await write_transaction(
+            _store_message, input_data, ai_response, user_input_entity, entity_links, create_time, vector
+        )
+    entity_labels = check_entity_links(linked)
+    # 作成したリレーションシップのラベルの組をカタログに登録する
+    relation_types = [("Title", "CONTAIN", "Message")]
+    if input_data.former_node_id is not None:
+        relation_types += [("Message", "FOLLOW", "Message"), ("Message", "PRECEDES", "Message")]
+    relation_types += [("Message", "CONTAIN", label) for label in entity_labels]
+    register_relation_types(relation_types)
+    # コミット後に、プロセス内のベクトルインデックスへ追加する
+    if config.MESSAGE_VECTOR_INDEX_ENABLED and message_vector_index.ready:
+        message_vector_index.add(message.id, input_data.title, message.create_time, vector)
+    logger.info(f"Message Node created. message_id: {message.id}")
     return message
 
 
-async def pursue_node_update_history(label: str, name: str) -> NodeHistory | None:
-    """指定したentityから、node <- [:CONTAIN] - MessageのMessageリストを取得する
-    さらに、リレーションシップのプロパティは、その時のノードのプロパティを含むので、
-    フィルタリングすることで、ノードの更新履歴を取得することができる。"""
-    with driver.session() as session:
-        result = session.run(
+async def _store_message(
+    tx,
+    input_data: WebSocketInputData,
+    ai_response: str,
+    user_input_entity: Triplets | None,
+    entity_links: list[dict],
+    create_time: str,
+    vector: list[float],
+) -> MessageNode:
+    # 親ノード(Title)を更新(update_timeを更新)し、メッセージノードと、親ノードからのリレーション(CONTAIN)を作成する。
+    # Titleの最新のMessage(LATEST)を、作成したメッセージノードに付け替える。
+    # 前のノード(Message)が指定されている場合、リレーション(FOLLOW)と(PRECEDES)を作成する。
+    records = await run_query(
+        tx,
+        "store_message",
+        STORE_MESSAGE,
+        title=input_data.title,
+        create_time=create_time,
+        source=input_data.source,
+        user_input=input_data.user_input,
+        user_input_entity=user_input_entity.model_dump_json() if user_input_entity else None,
+        AI=input_data.AI,
+        ai_response=ai_response,
+        vector=vector,
+        former_node_id=input_data.former_node_id,
+    )
+    message = convert_neo4j_message_to_model(records[0]["b"])
+
+    # Messageからuser_input_entityの各Nodeへのリレーションを作成し、更新対象となったpropertyを保存する。
+    linked = []
+    if entity_links:
+        records = await run_query(
+            tx,
+            "store_message.entity_links",
             f"""
-            MATCH (m:Message)-[r]->(n:{label})
-            WHERE $name IN n.name_variation OR n.name = $name
-            RETURN m, r, n
+            MATCH (b) WHERE id(b) = $new_node_id
+            WITH b, $entity_links AS links
+            {LINK_MESSAGE_ENTITIES}
+            RETURN linked
             """,
-            name=name,
+            new_node_id=message.id,
+            entity_links=entity_links,
+        )
+        linked = records[0]["linked"]
+    return message, linked
+
+
+def entity_link_rows(user_input_entity: Triplets | None) -> list[dict]:
+    """user_input_entityの各Nodeへのリレーションの作成に渡す、{label, name, properties}のリスト"""
+    if user_input_entity is None:
+        return []
+    return [
+        {"label": node.label, "name": node.name, "properties": node.properties if node.properties is not None else {}}
+        for node in user_input_entity.nodes
+    ]
+
+
+def check_entity_links(linked: list[dict]) -> set[str]:
+    """コミット後に、トランザクション内でAliasから解決したnode_idを名前解決のキャッシュに反映し、
+    繋げなかったEntityをログに出力する。繋いだEntityのラベルを返す。"""
+    node_ids: dict[tuple[str, str], list[int]] = {}
+    for link in linked:
+        ids = node_ids.setdefault((link["label"], link["name"]), [])
+        if link["node_id"] is not None and link["node_id"] not in ids:
+            ids.append(link["node_id"])
+    labels = set()
+    for (label, name), ids in node_ids.items():
+        if ids:
+            node_id_cache.set(label, name, ids)
+            labels.add(label)
+        else:
+            logger.error(f"Relationship not created. (:Message)-[:CONTAIN]->({name}:{label})")
+    return labels
+
+
+def message_embedding_text(source: str, user_input: str, AI: str, ai_response: str) -> str:
+    """Messageのベクトル化に使うテキスト"""
+    return f"{source}: {user_input}\n {AI}: {ai_response}"
+
+
+# Bulk Import
+async def store_messages(messages: list[dict]) -> list[int]:
+    """インポート用。複数のMessageを、UNWINDで1トランザクションで保存し、Messageのidを入力順に返す。
+    messagesの各要素は、title, source, user_input, AI, ai_response, create_time（ISO 8601）,
+    user_input_entity（Triplets | None）, vector, import_key を持つ。
+    import_key（入力ファイルと行番号など、入力の行ごとに一意な値）が同じMessageが既にある場合は作成せず、そのidを返す。
+    コミット後、チェックポイントの保存前に中断して、同じバッチを再実行しても、Messageは重複しない。
+    作成したMessageは、Titleごとにcreate_timeの順で、既存のMessageの間にFOLLOW, PRECEDESで繋ぐ。
+    LATESTは、作成したMessageがTitleの最新の場合のみ移す（過去の会話ログをインポートしても、最新の会話は変わらない）。"""
+    rows = []
+    for index, m in enumerate(messages):
+        rows.append({
+            "index": index,
+            "import_key": m["import_key"],
+            "title": m["title"],
+            "create_time": m["create_time"],
+            "source": m["source"],
+            "user_input": m["user_input"],
+            "user_input_entity": m["user_input_entity"].model_dump_json() if m["user_input_entity"] else None,
+            "AI": m["AI"],
+            "ai_response": m["ai_response"],
+            "vector": m["vector"],
+            "entity_links": entity_link_rows(m["user_input_entity"]),
+        })
+
+    message_ids, created, linked = await write_transaction(_store_messages, rows)
+    relation_types = {("Title", "CONTAIN", "Message"), ("Message", "FOLLOW", "Message"), ("Message", "PRECEDES", "Message")}
+    relation_types.update(("Message", "CONTAIN", label) for label in check_entity_links(linked))
+    register_relation_types(relation_types)
+    if len(created) < len(rows):
+        logger.info(f"{len(rows) - len(created)} messages already imported. skipped.")
+    if config.MESSAGE_VECTOR_INDEX_ENABLED and message_vector_index.ready and created:
+        created_rows = [rows[index] for index in created]
+        message_vector_index.add_many(
+            [message_ids[index] for index in created],
+            [row["title"] for row in created_rows],
+            [datetime.fromisoformat(row["create_time"]) for row in created_rows],
+            [row["vector"] for row in created_rows],
+        )
+    return message_ids
+
+
+async def _store_messages(tx, rows: list[dict]) -> tuple[list[int], list[int], list[dict]]:
+    """Messageのidと、新たに作成した行のindexを返す"""
+    # インポート済みの行は作成しない
+    records = await run_query(tx, "store_messages.imported", IMPORTED_MESSAGE_IDS, import_keys=[row["import_key"] for row in rows])
+    imported = {record["import_key"]: record["message_id"] for record in records}
+    message_ids = [imported.get(row["import_key"]) for row in rows]
+    new_rows = [row for row in rows if row["import_key"] not in imported]
+    created = [row["index"] for row in new_rows]
+    if not new_rows:
+        return message_ids, created, []
+
+    linked = []
+    new_by_title: dict[str, list[tuple[int, int, int]]] = {}    # title -> [(create_time, index, message_id)]
+    records = await run_query(tx, "store_messages", UNWIND_CREATE_MESSAGES, rows=new_rows)
+    for record in records:
+        message_ids[record["index"]] = record["message_id"]
+        linked.extend(record["linked"])
+        title = rows[record["index"]]["title"]
+        new_by_title.setdefault(title, []).append((record["create_time"], record["index"], record["message_id"]))
+
+    # 作成したMessageの期間内と、その前後の既存のMessageを取得し、create_timeの順に繋ぎ直す
+    windows = [
+        {"title": title, "since": min(m[0] for m in new), "until": max(m[0] for m in new)}
+        for title, new in new_by_title.items()
+    ]
+    records = await run_query(
+        tx,
+        "store_messages.neighbors",
+        MESSAGE_NEIGHBORS,
+        windows=windows,
+        created_ids=[message_ids[index] for index in created],
+    )
+    existing_by_title: dict[str, list[tuple[int, int]]] = {}
+    for record in records:
+        existing_by_title.setdefault(record["title"], []).append((record["create_time"], record["message_id"]))
+
+    links, unlinks, latest = [], [], []
+    for title, new in new_by_title.items():
+        title_links, title_unlinks, latest_id = chain_by_time(existing_by_title.get(title, []), new)
+        links.extend(title_links)
+        unlinks.extend(title_unlinks)
+        if latest_id is not None:
+            latest.append({"title": title, "message_id": latest_id})
+    if unlinks:
+        await run_query(tx, "store_messages.unfollow", UNWIND_UNFOLLOW_MESSAGES, links=unlinks)
+    if links:
+        await run_query(tx, "store_messages.follow", UNWIND_FOLLOW_MESSAGES, links=links)
+    if latest:
+        await run_query(tx, "store_messages.latest_pointer", UNWIND_SET_LATEST_MESSAGES, latest=latest)
+    return message_ids, created, linked
+
+
+def chain_by_time(
+    existing: list[tuple[int, int]], new: list[tuple[int, int, int]]
+) -> tuple[list[dict], list[dict], int | None]:
+    """既存のMessageの(create_time, id)と、作成したMessageの(create_time, 入力順, id)を、create_timeの順に並べる。
+    繋ぐ組、外す組（間に作成したMessageを挟む、既存のMessageの組）と、最新が作成したMessageの場合はそのidを返す。
+    create_timeが同じ場合は、既存のMessageを前に、作成したMessageは入力順に並べる。"""
+    merged = sorted(
+        [(create_time, 0, message_id, message_id) for create_time, message_id in existing]
+        + [(create_time, 1, index, message_id) for create_time, index, message_id in new]
+    )
+    links = [
+        {"message_id": message[3], "former_node_id": former[3]}
+        for former, message in zip(merged, merged[1:])
+        if former[1] or message[1]
+    ]
+    unlinks = []
+    former_existing = None
+    inserted = False
+    for item in merged:
+        if item[1]:
+            inserted = True
+            continue
+        if former_existing is not None and inserted:
+            unlinks.append({"message_id": item[3], "former_node_id": former_existing})
+        former_existing = item[3]
+        inserted = False
+    latest = merged[-1][3] if merged and merged[-1][1] else None
+    return links, unlinks, latest
+
+
+async def pursue_node_update_history(
+    label: str,
+    name: str,
+    limit: int = 50,
+    since: str | None = None,
+    until: str | None = None,
+    cursor: str | None = None,
+) -> NodeHistory | None:
+    """指定したentityから、node <- [:CONTAIN] - MessageのMessageリストを、新しい順にlimit件取得する
+    さらに、リレーションシップのプロパティは、その時のノードのプロパティを含むので、
+    フィルタリングすることで、ノードの更新履歴を取得することができる。
+    since, untilは、ISO 8601の期間（since <= create_time < until）。
+    次のページは、返却したNodeHistory.next_cursorをcursorに指定して取得する。"""
+    params = {}
+    if since:
+        params["since"] = since
+    if until:
+        params["until"] = until
+    if cursor:
+        params["before"], before_id = cursor.rsplit("|", 1)
+        params["before_id"] = int(before_id)
+    records = await read_query(
+        "pursue_node_update_history",
+        node_history_query(since=bool(since), until=bool(until), cursor=bool(cursor)),
+        label=label,
+        name=name,
+        limit=limit,
+        index_degree=config.NODE_HISTORY_INDEX_DEGREE,
+        **params,
+    )
+    if not records or records[0]["n"] is None:
+        return None
+
+    node = convert_neo4j_node_to_model(records[0]["n"])
+    if node is None:
+        return None
+    history = records[0]["history"]
+    messages = []
+    relationships = []
+    for item in history:
+        # Message Node
+        message = convert_neo4j_message_to_model(item["m"])
+        messages.append(message) if message else None
+        # Relationship
+        relationship = convert_neo4j_relationship_to_model(
+            item["r"], start_node_name=message.user_input if message else None, start_node_label="Message"
         )
+        relationships.append(relationship) if relationship else None
 
-        node = None
-        messages = []
-        relationships = []
-        for record in result:
-            # Initial Node
-            if node is None:
-                node = convert_neo4j_node_to_model(record["n"])
-
-            if node is not None:
-                # Message Node
-                message = convert_neo4j_message_to_model(record["m"])
-                messages.append(message) if message else None
-                # Relationship
-                relationship = convert_neo4j_relationship_to_model(record["r"])
-                relationships.append(relationship) if relationship else None
-
-    if node is not None:
-        return NodeHistory(node=node, messages=messages, relationships=relationships)
+    next_cursor = None
+    if len(history) == limit:
+        last = history[-1]["r"]
+        next_cursor = f"{last['create_time'].iso_format()}|{last.id}"
+    return NodeHistory(node=node, messages=messages, relationships=relationships, next_cursor=next_cursor)
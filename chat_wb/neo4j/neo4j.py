@@ -1,19 +1,51 @@
+import json
+from collections.abc import AsyncIterator
 from logging import getLogger
 import neo4j
-import os
 from pydantic import ValidationError
-from chat_wb.models import Node, Relationships, Triplets, MessageNode
-from neo4j import GraphDatabase
+from chat_wb.neo4j.driver import driver, read_query, write_query, read_transaction, write_transaction
+from chat_wb.neo4j.schema import (
+    ALIAS_LABEL,
+    ARCHIVE_LABEL,
+    NON_ENTITY_LABELS,
+    UNCAPPED_PROPERTIES,
+    INTERNAL_RELATIONSHIP_TYPES,
+    RELATION_CATALOG,
+    load_relation_catalog,
+    register_relation_types,
+)
+from chat_wb.neo4j.cypher import (
+    UPDATE_NODE,
+    UNWIND_UPDATE_NODES,
+    UPDATE_RELATIONSHIP,
+    ALL_NODES,
+    ALL_RELATIONSHIPS,
+    ENTITY_PROFILES,
+    create_node_query,
+    unwind_create_nodes_query,
+    nodes_page_query,
+    relationships_page_query,
+    delete_node_query,
+    node_names_query,
+    match_relationship_query,
+    create_relationship_query,
+    unwind_merge_relationships_query,
+    integrate_node_names_query,
+    node_properties_query,
+    set_node_properties_query,
+    move_relationships_query,
+    MERGE_NODES,
+    MERGE_NODES_PREVIEW,
+)
+from chat_wb.neo4j.id_cache import node_id_cache
+from chat_wb.neo4j.locks import entity_locks
+from chat_wb.neo4j.profiler import run_query, stream_query
+from chat_wb.models import Node, Relationships, Triplets, MessageNode, MergeGroup
+import config
 
 # ロガー設定
 logger = getLogger(__name__)
 
-# ドライバの初期化
-uri = os.environ["NEO4J_URI"]
-username = "neo4j"
-password = os.environ["NEO4J_PASSWORD"]
-driver = GraphDatabase.driver(uri, auth=(username, password))
-
 
 # Neo4j型の変換
 def convert_neo4j_node_to_model(node: neo4j.graph.Node) -> Node | None:
@@ -40,8 +72,14 @@ def convert_neo4j_node_to_model(node: neo4j.graph.Node) -> Node | None:
         return None
 
 
-def convert_neo4j_relationship_to_model(relationship: neo4j.graph.Relationship) -> Relationships:
-    start_node_name = (
+def convert_neo4j_relationship_to_model(
+    relationship: neo4j.graph.Relationship,
+    start_node_name: str | None = None,
+    start_node_label: str | None = None,
+) -> Relationships:
+    """開始ノードをマップで返したクエリでは、リレーションシップの開始ノードにプロパティ、ラベルがないため、
+    start_node_name, start_node_labelで指定する"""
+    start_node_name = start_node_name or (
         relationship.start_node.get("name")
         or relationship.start_node.get("user_input")
         or relationship.start_node.get("title")
@@ -52,23 +90,29 @@ def convert_neo4j_relationship_to_model(relationship: neo4j.graph.Relationship)
         or relationship.end_node.get("title")
     )
     if start_node_name and end_node_name:
-        properties = dict(relationship)
+        # create_time等のneo4jの時刻型は、datetimeに変換する
+        properties = {k: v.to_native() if hasattr(v, "to_native") else v for k, v in relationship.items()}
         return Relationships(
             type=relationship.type,
             start_node=start_node_name,
             end_node=end_node_name,
             properties=properties if properties else None,
-            start_node_label=next(iter(relationship.start_node.labels), None),
+            start_node_label=start_node_label or next(iter(relationship.start_node.labels), None),
             end_node_label=next(iter(relationship.end_node.labels), None),
         )
 
 
-def convert_neo4j_message_to_model(node: neo4j.graph.Node) -> MessageNode | None:
-    properties = dict(node)
+def convert_neo4j_message_to_model(message: neo4j.graph.Node | dict) -> MessageNode | None:
+    """Messageのノード、またはmessage_projectionのマップ（idを含む）を、MessageNodeに変換する"""
+    if isinstance(message, neo4j.graph.Node):
+        properties = dict(message)
+        properties["id"] = message.id
+    else:
+        properties = message
     try:
         user_input_entity = properties.get("user_input_entity", None)
         return MessageNode(
-            id=node.id,
+            id=properties["id"],
             source=properties["source"],
             user_input=properties["user_input"],
             AI=properties["AI"],
@@ -81,145 +125,281 @@ def convert_neo4j_message_to_model(node: neo4j.graph.Node) -> MessageNode | None
         return None
 
 
+# 名前解決
+# (label, name)をnode_idのリストに変換する。キャッシュにないものだけを、Aliasからまとめて検索する。
+async def resolve_node_ids(keys: list[tuple[str | None, str]]) -> dict[tuple[str | None, str], list[int]]:
+    """labelがNoneの場合、ラベルを問わずに名前解決する。見つからないキーは結果に含まれない。"""
+    resolved = {}
+    misses = []
+    for label, name in dict.fromkeys(keys):
+        node_ids = node_id_cache.get(label, name)
+        if node_ids is not None:
+            resolved[(label, name)] = node_ids
+        else:
+            misses.append({"label": label, "name": name})
+
+    if misses:
+        records = await read_query(
+            "resolve_node_ids",
+            """
+            UNWIND $keys AS key
+            MATCH (a:Alias {name: key.name})-[:ALIAS_OF]->(n)
+            WHERE key.label IS NULL OR a.label = key.label
+            RETURN key.label AS label, key.name AS name, collect(DISTINCT id(n)) AS node_ids
+            """,
+            keys=misses,
+        )
+        for record in records:
+            key = (record["label"], record["name"])
+            resolved[key] = record["node_ids"]
+            node_id_cache.set(*key, record["node_ids"])
+    return resolved
+
+
+def invalidate_node_cache(name: str, properties: dict | None = None, node_ids: list[int] | None = None):
+    """ノードの作成、更新、統合、削除の後に、名前解決のキャッシュを無効化する"""
+    node_id_cache.invalidate_name(name)
+    name_variation = (properties or {}).get("name_variation") or []
+    for variation in name_variation if isinstance(name_variation, list) else [name_variation]:
+        node_id_cache.invalidate_name(variation)
+    if node_ids:
+        node_id_cache.invalidate_ids(node_ids)
+
+
 # ノードの更新
 # property要素について、上書きせずに、値を追加する関数。node_idを返す。
-def create_update_node(node: Node):
+async def create_update_node(node: Node):
     label = node.label
     name = node.name
     properties = node.properties
 
-    with driver.session() as session:
-        result = session.run(
-            f"""
-            MATCH (n:{label})
-            WHERE n.name = $name OR $name IN n.name_variation
-            RETURN id(n) as node_id
-            """,
-            name=name,
-        ).single()
-        node_id = result.get("node_id") if result else None
+    # 同じEntityを同時に作成、更新するターンを直列化する（名前解決から書き込みまで）
+    async with entity_locks.hold([name]):
+        # Aliasから名前解決する（name, name_variationのいずれにも一致する）
+        node_ids = (await resolve_node_ids([(label, name)])).get((label, name))
+        node_id = node_ids[0] if node_ids else None
 
         # 既存のノードが存在し、新規プロパティがある場合、プロパティを更新する。（キーが重複する場合は追加）
-        # プロパティはstrまたはlistのみをサポートする。（フロントから、JSONを介すため、文字列として要素が送られるため）
-        if node_id:
-            if properties:
-                logger.info(f"properties: {properties}")
-                set_clause = ", ".join([
-                    f"""n.{property_name} =
-                        CASE
-                            WHEN n.{property_name} IS NULL
-                            THEN ['{property_value}']
-                            ELSE apoc.coll.toSet(n.{property_name} + ['{property_value}'])
-                        END"""
-                    for property_name, property_value in properties.items()
-                ])
-                update_query = f"""
-                MATCH (n)
-                WHERE id(n) = $node_id
-                SET {set_clause}
-                """
-                session.run(update_query, node_id=node_id)
-                # idが複数の場合、このクエリは実行されず、スルーされる。
-
+        # プロパティは文字列のリストとして追加する。（フロントから、JSONを介すため、文字列として要素が送られるため）
+        if node_id and properties:
+            logger.info(f"properties: {properties}")
+            # キャッシュのidは、他のワーカーでの統合、削除により古くなっている場合がある（idは再利用される）。
+            # 同じクエリ内でAliasから名前解決し直し、キャッシュのidが含まれなければ、解決したノードを更新する。
+            records = await write_query(
+                "update_node",
+                UPDATE_NODE,
+                label=label,
+                name=name,
+                node_id=node_id,
+                properties=_to_list_properties(properties),
+                **PROPERTY_LIMIT_PARAMS,
+            )
+            updated_id = records[0]["node_id"] if records else None
+            if updated_id != node_id:
+                logger.warning(f"Cached node id {node_id} of {{{label}:{name}}} is stale. resolved: {updated_id}")
+            if updated_id is not None:
                 message = f"Node {{{label}:{name}}} already exists. Property updated."
                 logger.info(message)
-                return {"status": "success", "message": message, "node_id": node_id}
+                invalidate_node_cache(name, properties, [*node_ids, updated_id])
+                return {"status": "success", "message": message, "node_id": updated_id}
+            # ノードが削除されていた場合は、作成する
+            node_id = None
 
         # ノードが存在しない場合、新しいノードを作成。
-        else:
-            # プロパティにnameを追加し、リストとして初期化
-            properties = properties or {}
-            properties["name"] = name
-            merge_query = f"""
-            MERGE (n:{label} {{name: $name}})
-            ON CREATE SET {', '.join([f'n.{k} = ${k}' for k in properties.keys()])}
-            RETURN id(n) as node_id
-            """
-            result = session.run(merge_query, **properties)
-            node_id = result.single().get("node_id")
+        if not node_id:
+            create_properties = {k: v for k, v in (properties or {}).items() if k != "name"}
+            records = await write_query("create_node", create_node_query(label), name=name, properties=create_properties)
+            node_id = records[0].get("node_id") if records else None
             if node_id:
                 logger.info(f"Node {{{label}:{name}}} created.")
             else:
                 logger.error(f"Node {{{label}:{name}}} creation failed.")
+        invalidate_node_cache(name, properties, node_ids)
 
 
 # optionのリレーションシップを作成する
-def create_update_relationship(relationships: Relationships):
+async def create_update_relationship(relationships: Relationships):
     start_node = relationships.start_node
     end_node = relationships.end_node
     relation_type = relationships.type
     properties = relationships.properties
 
-    # ノードラベルがNoneの場合にクエリから省略する
-    start_node_label = f":{relationships.start_node_label}" if relationships.start_node_label is not None else ""
-    end_node_label = f":{relationships.end_node_label}" if relationships.end_node_label is not None else ""
-
-    with driver.session() as session:
-        # name_variationを考慮して、ノードを検索した後に、リレーションシップを検索する。
-        result = session.run(
-            f"""
-            MATCH (n1{start_node_label}), (n2{end_node_label})
-            WHERE (n1.name = $start_node OR $start_node IN n1.name_variation)
-                AND (n2.name = $end_node OR $end_node IN n2.name_variation)
-            MATCH (n1)-[r:{relation_type}]->(n2)
-            RETURN id(r) as relationship_id
-            """,
-            start_node=start_node,
-            end_node=end_node,
-        ).single()
-        relationship_id = result.get("relationship_id") if result else None
-
-        # 既存のリレーションシップが存在し、新規プロパティがある場合、内容を更新
-        if relationship_id:
-            if properties:
-                session.run(
-                    """
-                    MATCH ()-[r]->()
-                    WHERE id(r) = $relationship_id
-                    SET r += $properties
-                    """,
-                    properties=properties,
-                    relationship_id=relationship_id,
-                )  # idが複数の場合、このクエリは実行されず、スルーされる。
-                logger.info(f"""Relationship {{Node1:{start_node}}}-{{{relation_type}}}
-                                ->{{Node2:{end_node}}} already exists. Property updated:{{'properties':{properties}}}""")
-
-        # リレーションシップが存在しない場合、新しいリレーションシップを作成
-        else:
-            properties = properties or {}
-            result = session.run(
-                f"""
-                MATCH (n1{start_node_label}), (n2{end_node_label})
-                WHERE (n1.name = $start_node OR $start_node IN n1.name_variation)
-                    AND (n2.name = $end_node OR $end_node IN n2.name_variation)
-                MERGE (n1)-[r:{relation_type}]->(n2)
-                ON CREATE SET r += $properties
-                RETURN id(r) as relationship_id
-                """,
-                start_node=start_node,
-                end_node=end_node,
+    # 検索と作成（更新）を1つのトランザクションで行う
+    async with entity_locks.hold([start_node, end_node]):
+        relationship_id, created = await write_transaction(_create_update_relationship, relationships)
+
+    if created:
+        register_relation_types([created])
+        logger.info(f"Relationship {{Node1:{start_node}}}-{{{relation_type}}}->{{Node2:{end_node}}} created.")
+    elif relationship_id is None:
+        logger.error(f"Relationship {{Node1:{start_node}}}-{{{relation_type}}}->{{Node2:{end_node}}} creation failed.")
+    elif properties:
+        logger.info(f"""Relationship {{Node1:{start_node}}}-{{{relation_type}}}
+                        ->{{Node2:{end_node}}} already exists. Property updated:{{'properties':{properties}}}""")
+
+
+async def _create_update_relationship(tx, relationships: Relationships) -> tuple[int | None, tuple[str, str, str] | None]:
+    """リレーションシップのidと、作成した場合は(始点ラベル, タイプ, 終点ラベル)を返す"""
+    relation_type = relationships.type
+    properties = relationships.properties
+    # ノードラベルがNoneの場合は、ラベルを問わずに名前解決する
+    names = {
+        "start_node": relationships.start_node,
+        "end_node": relationships.end_node,
+        "start_node_label": relationships.start_node_label,
+        "end_node_label": relationships.end_node_label,
+    }
+
+    # Aliasから名前解決した後に、リレーションシップを検索する。
+    records = await run_query(tx, "match_relationship", match_relationship_query(relation_type), **names)
+    relationship_id = records[0].get("relationship_id") if records else None
+
+    # 既存のリレーションシップが存在し、新規プロパティがある場合、内容を更新
+    if relationship_id:
+        if properties:
+            await run_query(
+                tx,
+                "update_relationship",
+                UPDATE_RELATIONSHIP,
                 properties=properties,
-            ).single()
-            relationship_id = result.get("relationship_id") if result else None
-            if relationship_id:
-                logger.info(f"Relationship {{Node1:{start_node}}}-{{{relation_type}}}->{{Node2:{end_node}}} created.")
-            else:
-                logger.error(f"Relationship {{Node1:{start_node}}}-{{{relation_type}}}->{{Node2:{end_node}}} creation failed.")
+                relationship_id=relationship_id,
+            )  # idが複数の場合、このクエリは実行されず、スルーされる。
+        return relationship_id, None
+
+    # リレーションシップが存在しない場合、新しいリレーションシップを作成
+    records = await run_query(
+        tx,
+        "create_relationship",
+        create_relationship_query(relation_type),
+        properties=properties or {},
+        **names,
+    )
+    if not records:
+        return None, None
+    return records[0]["relationship_id"], (records[0]["start_label"], relation_type, records[0]["end_label"])
+
+
+# Tripletsの一括保存
+# ノード、リレーションシップをラベル（タイプ）ごとにまとめ、UNWINDで1トランザクション内に保存する。
+async def store_triplets(triplets: Triplets):
+    """Tripletsのノード、リレーションシップを1トランザクションで作成、更新する。
+    既存ノードのプロパティは、create_update_nodeと同様に、上書きせずにリストへ値を追加する。"""
+    names = [node.name for node in triplets.nodes]
+    names += [name for r in triplets.relationships for name in (r.start_node, r.end_node)]
+    async with entity_locks.hold(names):
+        relation_types = await write_transaction(_store_triplets, triplets)
+        for node in triplets.nodes:
+            invalidate_node_cache(node.name, node.properties)
+    register_relation_types(relation_types)
+    logger.info(f"Triplets stored. nodes: {len(triplets.nodes)}, relationships: {len(triplets.relationships)}")
+
+
+async def _store_triplets(tx, triplets: Triplets) -> list[tuple[str, str, str]]:
+    """保存したリレーションシップの(始点ラベル, タイプ, 終点ラベル)を返す（コミット後にカタログへ登録する）"""
+    # ラベルごとにノードをまとめる（作成時のラベルはパラメータ化できないため）
+    nodes_by_label: dict[str, list[dict]] = {}
+    for node in triplets.nodes:
+        nodes_by_label.setdefault(node.label, []).append({
+            "name": node.name,
+            "properties": _to_list_properties(node.properties),
+            "create_properties": {k: v for k, v in (node.properties or {}).items() if k != "name"},
+        })
+
+    for label, rows in nodes_by_label.items():
+        # 同じ名前の行は1行にまとめる（MERGEのON CREATE SETは、最初の行のプロパティしか設定しないため）
+        rows = _group_node_rows(rows)
+        # 既存のノードのプロパティに値を追加する
+        records = await run_query(
+            tx, "store_triplets.update_nodes", UNWIND_UPDATE_NODES, label=label, rows=rows, **PROPERTY_LIMIT_PARAMS
+        )
+        existing_names = set(records[0]["names"]) if records else set()
+
+        # 存在しないノードを作成する
+        new_rows = [row for row in rows if row["name"] not in existing_names]
+        if new_rows:
+            await run_query(tx, "store_triplets.create_nodes", unwind_create_nodes_query(label), rows=new_rows)
+        logger.info(f"Label {label}: {len(existing_names)} nodes updated, {len(new_rows)} nodes created.")
+
+    # タイプ、始点ラベル、終点ラベルごとにリレーションシップをまとめる
+    relationships_by_type: dict[tuple[str, str | None, str | None], list[dict]] = {}
+    for relationship in triplets.relationships:
+        key = (relationship.type, relationship.start_node_label, relationship.end_node_label)
+        relationships_by_type.setdefault(key, []).append({
+            "start_node": relationship.start_node,
+            "end_node": relationship.end_node,
+            "properties": relationship.properties or {},
+        })
+
+    relation_types = []
+    for (relation_type, start_label, end_label), rows in relationships_by_type.items():
+        # ノードラベルがNoneの場合は、ラベルを問わずに名前解決する
+        records = await run_query(
+            tx,
+            "store_triplets.merge_relationships",
+            unwind_merge_relationships_query(relation_type),
+            start_node_label=start_label,
+            end_node_label=end_label,
+            rows=rows,
+        )
+        logger.info(f"Relationship {relation_type}: {records[0]['count'] if records else 0} of {len(rows)} stored.")
+        if records:
+            relation_types.extend((pair[0], relation_type, pair[1]) for pair in records[0]["label_pairs"])
+    return relation_types
+
+
+# プロパティの値の数の上限（UPDATE_NODE, UNWIND_UPDATE_NODESに渡す）
+PROPERTY_LIMIT_PARAMS = {
+    "property_value_limit": config.NEO4J_PROPERTY_VALUE_LIMIT,
+    "uncapped_properties": UNCAPPED_PROPERTIES,
+}
+
+
+def _group_node_rows(rows: list[dict]) -> list[dict]:
+    """同じ名前のノードの行を、最初の位置の1行にまとめる。
+    プロパティのリストは、UNWIND_UPDATE_NODESで順に追加した場合と同じく、後の行で追加した値を末尾に移す。
+    作成時のプロパティは、行ごとの値が同じキーはそのまま、異なるキーはまとめたリストにする。"""
+    grouped: dict[str, list[dict]] = {}
+    for row in rows:
+        grouped.setdefault(row["name"], []).append(row)
+    merged_rows = []
+    for name, group in grouped.items():
+        if len(group) == 1:
+            merged_rows.append(group[0])
+            continue
+        properties: dict[str, list[str]] = {}
+        for row in group:
+            for key, values in row["properties"].items():
+                properties[key] = [v for v in properties.get(key, []) if v not in values] + list(dict.fromkeys(values))
+        create_properties = {}
+        for row in group:
+            for key, value in row["create_properties"].items():
+                if key not in create_properties:
+                    create_properties[key] = value
+                elif create_properties[key] != value and key in properties:
+                    create_properties[key] = properties[key]
+        merged_rows.append({"name": name, "properties": properties, "create_properties": create_properties})
+    return merged_rows
+
+
+def _to_list_properties(properties: dict | None) -> dict[str, list[str]]:
+    """プロパティの値を文字列のリストに変換する（nameはプロパティとして追加しない）"""
+    list_properties = {}
+    for key, value in (properties or {}).items():
+        if key == "name" or value is None:
+            continue
+        values = value if isinstance(value, list) else [value]
+        list_properties[key] = [str(v) for v in values]
+    return list_properties
 
 
 # ノードを削除する
-def delete_node(label: str = None, name: str = None):
-    with driver.session() as session:
+async def delete_node(label: str = None, name: str = None):
+    async with entity_locks.hold([name]):
         # ラベルと名前でノードを削除する
-        result = session.run(
-            f"""
-            MATCH (n:{label} {{name: $name}})
-            DETACH DELETE n
-            RETURN count(n) as deleted_count
-            """,
-            name=name,
-        )
-        deleted_count = result.single().get("deleted_count")
+        records = await write_query("delete_node", delete_node_query(label), name=name)
+        record = records[0]
+        deleted_count = record.get("deleted_count")
+        invalidate_node_cache(name, node_ids=record.get("node_ids"))
     if deleted_count > 0:
         message = f"Node {{{label}:{name}}} deleted."
         logger.info(message)
@@ -231,18 +411,18 @@ def delete_node(label: str = None, name: str = None):
 
 
 # IDをもとにリレーションシップを削除する
-def delete_relationship(relationship_id: int):
-    with driver.session() as session:
-        result = session.run(
-            """
-            MATCH ()-[r]->() WHERE id(r) = $relationship_id
-            DELETE r
-            RETURN count(r) as deleted_count
-        """,
-            relationship_id=relationship_id,
-        )
+async def delete_relationship(relationship_id: int):
+    records = await write_query(
+        "delete_relationship",
+        """
+        MATCH ()-[r]->() WHERE id(r) = $relationship_id
+        DELETE r
+        RETURN count(r) as deleted_count
+    """,
+        relationship_id=relationship_id,
+    )
 
-        deleted_count = result.single().get("deleted_count")
+    deleted_count = records[0].get("deleted_count")
 
     if deleted_count > 0:
         return logger.info(message=f"Relationship_id {{{relationship_id}}} deleted.")
@@ -253,213 +433,335 @@ def delete_relationship(relationship_id: int):
 # ----------------------------------------------------------------
 # Use in Cache
 # Neo4jのノードラベルをすべて取ってくる関数
-def get_node_labels() -> list[str]:
+async def get_node_labels() -> list[str]:
     labels = []
 
-    with driver.session() as session:
-        result = session.run("CALL db.labels()")
-        for record in result:
+    records = await read_query("get_node_labels", "CALL db.labels()")
+    for record in records:
+        if record["label"] not in (ALIAS_LABEL, ARCHIVE_LABEL):
             labels.append(record["label"])
 
     return labels
 
 
 # Neo4jのリレーションタイプをすべて取ってくる関数
-def get_relationship_types() -> list[str]:
+async def get_relationship_types() -> list[str]:
     relationship_types = []
 
-    with driver.session() as session:
-        result = session.run("CALL db.relationshipTypes()")
-        for record in result:
+    records = await read_query("get_relationship_types", "CALL db.relationshipTypes()")
+    for record in records:
+        if record["relationshipType"] not in INTERNAL_RELATIONSHIP_TYPES:
             relationship_types.append(record["relationshipType"])
 
     return relationship_types
 
 
 # ノードラベルとリレーションタイプのセットを取得する関数
-def get_label_and_relationship_type_sets() -> dict | None:
-    result_set = set()
-
-    with driver.session() as session:
-        result = session.run(
-            """
-            MATCH (n)-[r]->(m)
-            RETURN labels(n) AS NodeLabels, type(r) AS RelationshipType, labels(m) AS ConnectedNodeLabels
-        """
-        )
-        for record in result:
-            node_labels = tuple(record["NodeLabels"])
-            relationship_type = record["RelationshipType"]
-            connected_node_labels = tuple(record["ConnectedNodeLabels"])
-
-            # タプルをセットに追加
-            result_set.add((node_labels, relationship_type, connected_node_labels))
-
-    if result_set is None:
-        return None
-    # dictに変換
-    relation_dict = {}
-    for result in result_set:  # resultsはあなたのクエリの出力リストを指します。
-        node_label1, relationship_type, node_label2 = (
-            result[0][0],
-            result[1],
-            result[2][0],
-        )
-        key = (node_label1, node_label2)  # タプルをキーとして使用
-
-        # 辞書にリレーションタイプを追加、既に存在する場合はスキップ
-        if key not in relation_dict:
-            relation_dict[key] = relationship_type
-
-    return relation_dict
+async def get_label_and_relationship_type_sets() -> dict | None:
+    """(始点ラベル, 終点ラベル) -> リレーションタイプの辞書を返す。
+    全リレーションシップを走査せず、db.schema.visualization()から作成したカタログを使用する。"""
+    if not RELATION_CATALOG:
+        await load_relation_catalog()
+    return dict(RELATION_CATALOG)
 
 
 # ノードリスト
 # 特定のラベルのノードの名前をリストとして取得する
-def get_node_names(label: str) -> list[str]:
+async def get_node_names(label: str) -> list[str]:
     names = []
 
-    with driver.session() as session:
-        result = session.run(
-            f"""
-            MATCH (n:{label})
-            RETURN n.name as name
-            """)
-        for record in result:
-            names.append(record["name"])
+    records = await read_query("get_node_names", node_names_query(label))
+    for record in records:
+        names.append(record["name"])
 
     return names
 
 
 # Title、Messageを除くすべてのノードのラベルと名前を取得する
-def get_all_nodes() -> list[Node]:
+async def get_all_nodes() -> list[Node]:
     nodes = []
 
-    with driver.session() as session:
-        result = session.run(
-            """
-            MATCH (n)
-            WHERE NOT 'Title' IN labels(n)
-                AND NOT 'Message' IN labels(n)
-            RETURN labels(n) as label, n.name as name
-            """)
-        for record in result:
-            node = Node(label=record["label"][0], name=record["name"], properties=None)
-            nodes.append(node)
+    records = await read_query("get_all_nodes", ALL_NODES)
+    for record in records:
+        nodes.append(_record_to_node(record))
     return nodes
 
 
 # Title、Messageを除くすべてのリレーションシップのタイプと、始点ノード・終点ノードの名前を取得する
-def get_all_relationships() -> list[str]:
+async def get_all_relationships() -> list[str]:
     relationships = []
 
-    with driver.session() as session:
-        result = session.run(
-            """
-            MATCH (n)-[r]->(m)
-            WHERE NOT 'Title' IN labels(n)
-                AND NOT 'Message' IN labels(n)
-                AND NOT 'Title' IN labels(m)
-                AND NOT 'Message' IN labels(m)
-            RETURN type(r) AS type, n.name as start_node, m.name as end_node
-            """
-        )
-        for record in result:
-            relationship = Relationships(type=record["type"], start_node=record["start_node"], end_node=record["end_node"],
-                                         properties=None, start_node_label=None, end_node_label=None)
-            relationships.append(relationship)
+    records = await read_query("get_all_relationships", ALL_RELATIONSHIPS)
+    for record in records:
+        relationships.append(_record_to_relationship(record))
 
     return relationships
 
 
+# ページング、ストリーミング
+# グラフ全体を一度にメモリへ載せないよう、カーソルで分割して取得する。
+EXPORT_PAGE_SIZE = 1000
+
+
+async def get_entity_labels() -> list[str]:
+    """Entityのラベルを、名前の順に取得する（ページングの順序）"""
+    records = await read_query("get_entity_labels", "CALL db.labels()")
+    return sorted(record["label"] for record in records if record["label"] not in NON_ENTITY_LABELS)
+
+
+async def _read_pages(query_name: str, page_query, cursor: str | None, limit: int, keys: list[str], position):
+    """ラベルごとのページを、limit件になるまで順に読む。position(record)は、レコードの[name, keysの値...]。
+    カーソルは、[ラベル, 前のページの最後のレコードのposition...]のJSON。最後のページでは、次のカーソルにNoneを返す。"""
+    labels = await get_entity_labels()
+    start = [""] + [-1] * len(keys)
+    if cursor:
+        label, *start = json.loads(cursor)
+        labels = [label] + [other for other in labels if other > label]
+    records = []
+    for label in labels:
+        name, *values = start
+        page = await read_query(
+            query_name, page_query(label), name=name, limit=limit - len(records), **dict(zip(keys, values))
+        )
+        records.extend(page)
+        if len(records) == limit:
+            return records, json.dumps([label, *position(page[-1])], ensure_ascii=False)
+        start = [""] + [-1] * len(keys)
+    return records, None
+
+
+async def get_nodes_page(cursor: str | None = None, limit: int = EXPORT_PAGE_SIZE) -> tuple[list[Node], str | None]:
+    """ラベル、名前の順にlimit件のノードを取得する。次のページのカーソルを返し、最後のページではNoneを返す。"""
+    records, next_cursor = await _read_pages(
+        "get_nodes_page", nodes_page_query, cursor, limit, ["node_id"], lambda record: [record["name"], record["id"]]
+    )
+    return [_record_to_node(record) for record in records], next_cursor
+
+
+async def get_relationships_page(
+    cursor: str | None = None, limit: int = EXPORT_PAGE_SIZE
+) -> tuple[list[Relationships], str | None]:
+    """始点ノードのラベル、名前の順にlimit件のリレーションシップを取得する。
+    次のページのカーソルを返し、最後のページではNoneを返す。"""
+    records, next_cursor = await _read_pages(
+        "get_relationships_page",
+        relationships_page_query,
+        cursor,
+        limit,
+        ["node_id", "relationship_id"],
+        lambda record: [record["start_node"], record["node_id"], record["id"]],
+    )
+    return [_record_to_relationship(record) for record in records], next_cursor
+
+
+# ストリーミングは、途中まで送信した結果を再試行できないため、マネージドトランザクションを使わない（読み取りとしてルーティングする）
+async def stream_all_nodes(batch_size: int = EXPORT_PAGE_SIZE) -> AsyncIterator[list[Node]]:
+    """ドライバから受け取ったbatch_size件ごとに、ノードのリストをyieldする。"""
+    async with driver.session(fetch_size=batch_size, default_access_mode=neo4j.READ_ACCESS) as session:
+        async for records in stream_query(session, "stream_all_nodes", ALL_NODES, batch_size=batch_size):
+            yield [_record_to_node(record) for record in records]
+
+
+async def stream_all_relationships(batch_size: int = EXPORT_PAGE_SIZE) -> AsyncIterator[list[Relationships]]:
+    """ドライバから受け取ったbatch_size件ごとに、リレーションシップのリストをyieldする。"""
+    async with driver.session(fetch_size=batch_size, default_access_mode=neo4j.READ_ACCESS) as session:
+        async for records in stream_query(session, "stream_all_relationships", ALL_RELATIONSHIPS, batch_size=batch_size):
+            yield [_record_to_relationship(record) for record in records]
+
+
+async def stream_entity_profiles(batch_size: int = EXPORT_PAGE_SIZE) -> AsyncIterator[list[dict]]:
+    """Entityのid, label, name, プロパティ, リレーションシップの数を、batch_size件ごとにyieldする。"""
+    async with driver.session(fetch_size=batch_size, default_access_mode=neo4j.READ_ACCESS) as session:
+        async for records in stream_query(session, "stream_entity_profiles", ENTITY_PROFILES, batch_size=batch_size):
+            yield [record.data() for record in records]
+
+
+def _record_to_node(record: neo4j.Record) -> Node:
+    return Node(label=record["label"][0], name=record["name"], properties=None)
+
+
+def _record_to_relationship(record: neo4j.Record) -> Relationships:
+    return Relationships(type=record["type"], start_node=record["start_node"], end_node=record["end_node"],
+                         properties=None, start_node_label=None, end_node_label=None)
+
+
 async def get_node(label: str, name: str) -> list[Node] | None:
     "Title, Messageを除く、指定したラベルのノードを取得する。"
-    with driver.session() as session:
-        result = session.run(
-            f"""
-            MATCH (n:{label})
-            WHERE $name IN n.name_variation OR n.name = $name
+    node_ids = node_id_cache.get(label, name)
+    # キャッシュにあれば、idで取得する。なければ、Aliasから名前解決し、キャッシュに保存する。
+    if node_ids is not None:
+        records = await read_query(
+            "get_node.by_id",
+            """
+            MATCH (n)
+            WHERE id(n) IN $node_ids
+            RETURN n
+            """,
+            node_ids=node_ids,
+        )
+    else:
+        records = await read_query(
+            "get_node.by_alias",
+            """
+            MATCH (:Alias {label: $label, name: $name})-[:ALIAS_OF]->(n)
             RETURN n
             """,
+            label=label,
             name=name,
         )
 
-        nodes = []
-        for record in result:
-            node = convert_neo4j_node_to_model(record["n"])
-            nodes.append(node)
-        return nodes if nodes else None
-
-
-# ノードが増えてレスポンスが遅くなるようなら、一つのnameを受け取るクエリの非同期処理を検討する。
-async def get_node_relationships(names: list[str], depth: int = 1) -> Triplets | None:
-    """複数nameを受け取り、指定した深さまでの双方向リレーションシップを取得する（Message,Titleを除く）。"""
-    with driver.session() as session:
-        result = session.run(
-            f"""
-            MATCH (start)
-            WHERE start.name IN $names
-                OR ANY(name_variation IN start.name_variation WHERE name_variation IN $names)
-
-            WITH collect(start) as starts
-            UNWIND starts as start
-                OPTIONAL MATCH path = (start)-[r*1..{depth}]-(end)
-                WHERE NONE(node IN nodes(path) WHERE 'Message' IN labels(node) OR 'Title' IN labels(node))
-
-            UNWIND r as rel
-            RETURN starts,
-                collect(distinct startNode(rel)) as start_nodes,
-                collect(distinct endNode(rel)) as end_nodes,
-                collect(distinct rel) as rels
+    nodes = []
+    found_ids = []
+    for record in records:
+        node = convert_neo4j_node_to_model(record["n"])
+        nodes.append(node)
+        found_ids.append(record["n"].id)
+
+    if node_ids is None:
+        node_id_cache.set(label, name, found_ids)
+    elif len(found_ids) < len(node_ids):
+        # 他のワーカーで削除された場合、キャッシュを破棄して、名前解決からやり直す
+        node_id_cache.invalidate_ids(node_ids)
+        return await get_node(label, name)
+    return nodes if nodes else None
+
+
+# 近傍探索の上限
+# ハブ（userやAIのPersonノード）の周りでパスが爆発しないよう、1ホップごとのfan-outと、全体のノード数、リレーションシップ数を制限する。
+NEIGHBOR_FANOUT = 25            # 1ノードあたり、1ホップで展開するリレーションシップの上限
+NEIGHBOR_MAX_NODES = 200        # 探索全体のノード数の上限
+NEIGHBOR_MAX_RELATIONSHIPS = 300    # 探索全体のリレーションシップ数の上限
+HUB_DEGREE = 100                # これを超える次数のノードは、展開はするが、次のホップの起点にしない
+
+
+async def get_node_relationships(
+    names: list[str],
+    depth: int = 1,
+    fanout: int = NEIGHBOR_FANOUT,
+    max_nodes: int = NEIGHBOR_MAX_NODES,
+    max_relationships: int = NEIGHBOR_MAX_RELATIONSHIPS,
+    hub_degree: int = HUB_DEGREE,
+) -> Triplets | None:
+    """複数nameを受け取り、指定した深さまでの双方向リレーションシップを取得する（Message,Title,Aliasを除く）。
+    1ホップずつ幅優先で展開し、同じリレーションシップは一度だけ辿る。Message,Title,Aliasは展開時に除外する。"""
+    resolved = await resolve_node_ids([(None, name) for name in names])
+    start_ids = list({node_id for node_ids in resolved.values() for node_id in node_ids})
+    if not start_ids:
+        return None
+
+    # 探索全体を1つの読み取りトランザクションで行う（各ホップが同じスナップショットを見る）
+    nodes, relationships = await read_transaction(
+        _get_node_relationships, start_ids, depth, fanout, max_nodes, max_relationships, hub_degree
+    )
+
+    triplets = Triplets(nodes=list(nodes.values()), relationships=list(relationships.values()))
+    logger.info(f"get_node_relationships: {len(triplets.nodes)} nodes, {len(triplets.relationships)} relationships")
+    return triplets if triplets.nodes or triplets.relationships else None
+
+
+async def _get_node_relationships(
+    tx, start_ids: list[int], depth: int, fanout: int, max_nodes: int, max_relationships: int, hub_degree: int
+) -> tuple[dict[int, Node], dict[int, Relationships]]:
+    nodes: dict[int, Node] = {}
+    relationships: dict[int, Relationships] = {}
+    # クエリ探索の最初のノードの情報
+    records = await run_query(
+        tx,
+        "get_node_relationships.start",
+        """
+        MATCH (n)
+        WHERE id(n) IN $start_ids
+        RETURN n
+        """,
+        start_ids=start_ids,
+    )
+    for record in records:
+        node = convert_neo4j_node_to_model(record["n"])
+        if node:
+            nodes[record["n"].id] = node
+
+    frontier = list(nodes.keys())
+    for _ in range(depth):
+        remaining = min(max_nodes - len(nodes), max_relationships - len(relationships))
+        if not frontier or remaining <= 0:
+            break
+        records = await run_query(
+            tx,
+            "get_node_relationships.hop",
+            """
+            UNWIND $frontier AS node_id
+            MATCH (n) WHERE id(n) = node_id
+            CALL {
+                WITH n
+                MATCH (n)-[r]-(m)
+                WHERE NOT m:Message AND NOT m:Title AND NOT m:Alias AND NOT m:PropertyArchive
+                    AND NOT id(r) IN $visited
+                RETURN r, m
+                ORDER BY id(r) DESC
+                LIMIT $fanout
+            }
+            RETURN n, r, m, COUNT { (m)--() } AS degree
+            LIMIT $remaining
             """,
-            names=names,
-            depth=depth,
+            frontier=frontier,
+            visited=list(relationships.keys()),
+            fanout=fanout,
+            remaining=remaining,
         )
-        record = result.single()
-        nodes = set()
-        if record:
-            # クエリ探索の最初のノードの情報
-            initial_nodes = [convert_neo4j_node_to_model(node) for node in record["starts"]]
-            # relationshipsのstart_node, end_node, relsをモデルに変換
-            start_nodes = [convert_neo4j_node_to_model(node) for node in record["start_nodes"]]
-            end_nodes = [convert_neo4j_node_to_model(node) for node in record["end_nodes"]]
-            relationships = [convert_neo4j_relationship_to_model(relationship) for relationship in record["rels"]]
-            # ノードを統合
-            nodes = set(initial_nodes + start_nodes + end_nodes)
-            triplets = Triplets(nodes=nodes, relationships=relationships)
-            return triplets if triplets.nodes or triplets.relationships else None
+        next_frontier = []
+        for record in records:
+            relationship_id = record["r"].id
+            if relationship_id in relationships:
+                continue
+            relationship = convert_neo4j_relationship_to_model(record["r"])
+            if relationship is None:
+                continue
+            relationships[relationship_id] = relationship
+
+            node_id = record["m"].id
+            if node_id not in nodes:
+                node = convert_neo4j_node_to_model(record["m"])
+                if node:
+                    nodes[node_id] = node
+                    # ハブは展開済みのリレーションシップのみ返し、その先は辿らない
+                    if record["degree"] <= hub_degree:
+                        next_frontier.append(node_id)
+        frontier = next_frontier
+    return nodes, relationships
 
 
 # ノードとノードの間にあるすべての双方向のリレーションとプロパティ（content）を得る。
 async def get_node_relationships_between(
     label1: str, label2: str, name1: str, name2: str
 ) -> list[Relationships] | None:
-    with driver.session() as session:
-        result = session.run(
-            f"""
-            MATCH (a:{label1})-[r]-(b:{label2})
-            WHERE $name1 IN a.name_variation OR a.name = $name1
-                AND $name2 IN b.name_variation OR b.name = $name2
-            RETURN  type(r) as relationship_type,
-                startNode(r).name as start_node_name,
-                endNode(r).name as end_node_name,
-                r.properties as properties""",
-            name1=name1,
-            name2=name2,
+    records = await read_query(
+        "get_node_relationships_between",
+        """
+        MATCH (:Alias {label: $label1, name: $name1})-[:ALIAS_OF]->(a)
+        MATCH (:Alias {label: $label2, name: $name2})-[:ALIAS_OF]->(b)
+        MATCH (a)-[r]-(b)
+        RETURN  type(r) as relationship_type,
+            startNode(r).name as start_node_name,
+            endNode(r).name as end_node_name,
+            r.properties as properties""",
+        label1=label1,
+        label2=label2,
+        name1=name1,
+        name2=name2,
+    )
+    relationships = []
+    for record in records:
+        relation = Relationships(
+            type=record["relationship_type"],
+            start_node=record["start_node_name"],
+            end_node=record["end_node_name"],
+            properties=record["properties"],
+            start_node_label=label1,
+            end_node_label=label2,
         )
-        relationships = []
-        for record in result:
-            relation = Relationships(
-                type=record["relationship_type"],
-                start_node=record["start_node_name"],
-                end_node=record["end_node_name"],
-                properties=record["properties"],
-                start_node_label=label1,
-                end_node_label=label2,
-            )
-            relationships.append(relation)
-        logger.debug(f"relationships: {relationships}")
-        return relationships if relationships else None
+        relationships.append(relation)
+    logger.debug(f"relationships: {relationships}")
+    return relationships if relationships else None
 
 
 # ----------------------------------------------------------------
@@ -468,96 +770,140 @@ async def integrate_nodes(node1: Node, node2: Node):
     """ノード2つを選択して、名前、プロパティ、リレーションシップを統合する。確実に確認してから削除すべきなので、削除は別に行う。"""
     message = f"Node {{{node1.label}:{node1.name}}} and {{{node2.label}:{node2.name}}} integrated."
     logger.info(message)
-    integrate_node_names(node1, node2)
-    integrate_node_properties(node1, node2)
-    integrate_relationships(node1, node2)
+    async with entity_locks.hold([node1.name, node2.name]):
+        await integrate_node_names(node1, node2)
+        await integrate_node_properties(node1, node2)
+        await integrate_relationships(node1, node2)
+        invalidate_node_cache(node1.name)
+        invalidate_node_cache(node2.name)
     return {"status": True, "message": message}
 
 
+# 重複ノードの一括統合
+async def merge_nodes(groups: list[MergeGroup], dry_run: bool = False) -> list[dict]:
+    """グループごとに、名前、プロパティ、リレーションシップの統合と重複ノードの削除を、1つのトランザクションで行う。
+    dry_runの場合、書き込みを行わずに、統合後の名前、プロパティと、移すリレーションシップの数を返す。"""
+    results = []
+    for group in groups:
+        results.append(await merge_node_group(group, dry_run))
+    return results
+
+
+async def merge_node_group(group: MergeGroup, dry_run: bool = False) -> dict:
+    target = group.target
+    keys = [(target.label, target.name)] + [(node.label, node.name) for node in group.duplicates]
+    async with entity_locks.hold([name for _, name in keys]):
+        resolved = await resolve_node_ids(keys)
+        target_ids = resolved.get(keys[0])
+        if not target_ids:
+            message = f"Node {{{target.label}:{target.name}}} not found."
+            logger.info(message)
+            return {"status": False, "message": message}
+        # targetと同名のノードが複数ある場合、最も古いノードに統合する
+        target_id = min(target_ids)
+        duplicate_ids = sorted({node_id for key in keys for node_id in resolved.get(key, [])} - {target_id})
+        missing = [f"{label}:{name}" for label, name in keys[1:] if (label, name) not in resolved]
+        if not duplicate_ids:
+            message = f"No duplicates of {{{target.label}:{target.name}}} found."
+            logger.info(message)
+            return {"status": False, "message": message, "missing": missing}
+
+        if dry_run:
+            records = await read_query(
+                "merge_nodes.preview", MERGE_NODES_PREVIEW, target_id=target_id, duplicate_ids=duplicate_ids
+            )
+        else:
+            records = await write_query(
+                "merge_nodes", MERGE_NODES, target_id=target_id, duplicate_ids=duplicate_ids, **PROPERTY_LIMIT_PARAMS
+            )
+            # 重複ノードの名前、別名は、すべてtargetに解決されるようになる
+            node_id_cache.invalidate_ids(duplicate_ids + [target_id])
+            for name in {name for _, name in keys}.union(records[0]["names"] if records else []):
+                invalidate_node_cache(name)
+            if records:
+                register_relation_types(tuple(triple) for triple in records[0]["label_triples"])
+    if not records:
+        message = f"Node {{{target.label}:{target.name}}} not found."
+        logger.info(message)
+        return {"status": False, "message": message}
+
+    record = records[0]
+    message = f"{record['merged']} nodes {'will be merged' if dry_run else 'merged'} into {{{target.label}:{target.name}}}."
+    logger.info(message)
+    return {
+        "status": True,
+        "dry_run": dry_run,
+        "message": message,
+        "merged": record["merged"],
+        "names": record["names"],
+        "properties": record["props"],
+        "relationships": record["relationship_count"],
+        "missing": missing,
+    }
+
+
 # Use neo4j apoc plugin (neo4j aura db pre-installed)
-def integrate_node_names(node1: Node, node2: Node):
-    with driver.session() as session:
-        result = session.run(
-            f"""
-            MATCH (n1:{node1.label} {{name: $name1}}), (n2:{node2.label} {{name: $name2}})
-            SET n1.name_variation = CASE
-                WHEN n1.name_variation IS NULL THEN [n1.name, n2.name]
-                ELSE apoc.coll.toSet(n1.name_variation + [n1.name, n2.name])
-            END
-            RETURN properties(n1)
-            """,
-            name1=node1.name,
-            name2=node2.name,
-        )
-        logger.info(result.single()[0])
+async def integrate_node_names(node1: Node, node2: Node):
+    records = await write_query(
+        "integrate_node_names",
+        integrate_node_names_query(node1.label, node2.label),
+        name1=node1.name,
+        name2=node2.name,
+    )
+    logger.info(records[0][0])
 
 
-def integrate_node_properties(node1: Node, node2: Node):
-    with driver.session() as session:
-        # n1のプロパティを取得
-        result1 = session.run(
-            f"""
-            MATCH (n1:{node1.label} {{name: $name1}})
-            RETURN properties(n1) AS props1
-            """,
-            name1=node1.name,
-        )
-        props1 = result1.single()["props1"]
+async def integrate_node_properties(node1: Node, node2: Node):
+    # 読み取りから書き込みまでを1つのトランザクションで行う（間に他の更新が入らないようにする）
+    properties = await write_transaction(_integrate_node_properties, node1, node2)
+    logger.info(properties)
 
-        # n2のプロパティを取得
-        result2 = session.run(
-            f"""
-            MATCH (n2:{node2.label} {{name: $name2}})
-            RETURN properties(n2) AS props2
-            """,
-            name2=node2.name,
-        )
-        props2 = result2.single()["props2"]
-
-        # 同じキーの値をリストに統合し、重複を避ける
-        for key in set(props1.keys()).intersection(props2.keys()):
-            if key != "name":  # 'name'プロパティをスキップ
-                # props1[key]とprops2[key]がリストでない場合、それらを一要素のリストに変換
-                props1_values = props1[key] if isinstance(props1[key], list) else [props1[key]]
-                props2_values = props2[key] if isinstance(props2[key], list) else [props2[key]]
-                props1[key] = list(set(props1_values + props2_values))
-
-        # 統合したプロパティをn1にセット
-        result = session.run(
-            f"""
-            MATCH (n1:{node1.label} {{name: $name1}})
-            SET n1 = $props
-            RETURN properties(n1)
-            """,
-            name1=node1.name,
-            props=props1,
-        )
-        logger.info(result.single()[0])
-
-
-def integrate_relationships(node1: Node, node2: Node):
-    with driver.session() as session:
-        # node2開始点のリレーションシップをnode1に移す
-        session.run(
-            f"""
-            MATCH (n2:{node2.label} {{name: $name2}})-[r]->(m)
-            MATCH (n1:{node1.label} {{name: $name1}})
-            CALL apoc.refactor.from(r, n1)
-            YIELD input, output
-            RETURN input, output;
-            """,
-            name1=node1.name,
-            name2=node2.name,
-        )
-        # node2終点のリレーションシップをnode1に移す
-        session.run(
-            f"""
-            MATCH (n2:{node2.label} {{name: $name2}})<-[r]-(m)
-            MATCH (n1:{node1.label} {{name: $name1}})
-            CALL apoc.refactor.to(r, n1)
-            YIELD input, output
-            RETURN input, output;
-            """,
-            name1=node1.name,
-            name2=node2.name,
-        )
+
+async def _integrate_node_properties(tx, node1: Node, node2: Node) -> dict:
+    # n1のプロパティを取得
+    records1 = await run_query(tx, "integrate_node_properties.get", node_properties_query(node1.label), name=node1.name)
+    props1 = records1[0]["props"]
+
+    # n2のプロパティを取得
+    records2 = await run_query(tx, "integrate_node_properties.get", node_properties_query(node2.label), name=node2.name)
+    props2 = records2[0]["props"]
+
+    # 同じキーの値をリストに統合し、重複を避ける
+    for key in set(props1.keys()).intersection(props2.keys()):
+        if key != "name":  # 'name'プロパティをスキップ
+            # props1[key]とprops2[key]がリストでない場合、それらを一要素のリストに変換
+            props1_values = props1[key] if isinstance(props1[key], list) else [props1[key]]
+            props2_values = props2[key] if isinstance(props2[key], list) else [props2[key]]
+            props1[key] = list(set(props1_values + props2_values))
+
+    # 統合したプロパティをn1にセット
+    records = await run_query(
+        tx, "integrate_node_properties.set", set_node_properties_query(node1.label), name=node1.name, props=props1
+    )
+    return records[0][0]
+
+
+async def integrate_relationships(node1: Node, node2: Node):
+    moved = await write_transaction(_integrate_relationships, node1, node2)
+    # 移したリレーションシップのラベルの組をカタログに登録する
+    register_relation_types((record["start_label"], record["type"], record["end_label"]) for record in moved)
+
+
+async def _integrate_relationships(tx, node1: Node, node2: Node) -> list[neo4j.Record]:
+    # node2開始点のリレーションシップをnode1に移す
+    moved_from = await run_query(
+        tx,
+        "integrate_relationships",
+        move_relationships_query(node1.label, node2.label, "from"),
+        name1=node1.name,
+        name2=node2.name,
+    )
+    # node2終点のリレーションシップをnode1に移す
+    moved_to = await run_query(
+        tx,
+        "integrate_relationships",
+        move_relationships_query(node1.label, node2.label, "to"),
+        name1=node1.name,
+        name2=node2.name,
+    )
+    return moved_from + moved_to
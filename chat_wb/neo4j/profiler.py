@@ -0,0 +1,197 @@
+import time
+from collections.abc import AsyncIterator
+from logging import getLogger
+from neo4j import Record
+from neo4j.graph import Node, Relationship, Path
+
+# ロガー設定
+logger = getLogger(__name__)
+
+
+# クエリ名ごとの計測
+# 実行時間（ms）のヒストグラムは、固定のバケット境界で集計する（上限のみ保持し、最後のバケットは上限なし）。
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# 返却バイト数は、先頭のSIZE_SAMPLE_RECORDS件の平均から推定する（全件を走査すると、計測対象の処理より重くなるため）
+SIZE_SAMPLE_RECORDS = 3
+
+
+class QueryStats:
+    """1つのクエリ名に対する、実行時間、返却行数、推定バイト数、PROFILEのdb hitsの累計"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.profiled = 0
+        self.db_hits = 0
+        self.last_db_hits: int | None = None
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, elapsed_ms: float, rows: int, size: int, db_hits: int | None = None):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.rows += rows
+        self.bytes += size
+        self.buckets[_bucket_index(elapsed_ms)] += 1
+        if db_hits is not None:
+            self.profiled += 1
+            self.db_hits += db_hits
+            self.last_db_hits = db_hits
+
+    def percentile(self, q: float) -> float | None:
+        """ヒストグラムから、q分位点が含まれるバケットの上限を返す（最後のバケットはmax_ms）"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.buckets):
+            cumulative += n
+            if cumulative >= rank:
+                return float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else None,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "rows": self.rows,
+            "mean_rows": round(self.rows / self.count, 1) if self.count else None,
+            "bytes": self.bytes,
+            "mean_bytes": round(self.bytes / self.count) if self.count else None,
+            "profiled": self.profiled,
+            "mean_db_hits": round(self.db_hits / self.profiled) if self.profiled else None,
+            "last_db_hits": self.last_db_hits,
+            "histogram": {
+                **{f"le_{b}": n for b, n in zip(LATENCY_BUCKETS_MS, self.buckets)},
+                "inf": self.buckets[-1],
+            },
+        }
+
+
+_stats: dict[str, QueryStats] = {}
+# PROFILEを付けて実行するクエリ名（"*"はすべて）
+_profile_names: set[str] = set()
+
+
+def _bucket_index(elapsed_ms: float) -> int:
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if elapsed_ms <= bound:
+            return i
+    return len(LATENCY_BUCKETS_MS)
+
+
+def _estimate_size(value) -> int:
+    """返却値のおおよそのバイト数（ワイヤ上のサイズではなく、比較用の目安）"""
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 8
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (Node, Relationship)):
+        return 8 + _estimate_size(dict(value.items()))
+    if isinstance(value, Path):
+        return sum(_estimate_size(n) for n in value.nodes) + sum(_estimate_size(r) for r in value.relationships)
+    if isinstance(value, dict):
+        return sum(_estimate_size(k) + _estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_estimate_size(v) for v in value)
+    return len(str(value))
+
+
+def _estimate_records_size(records: list[Record]) -> int:
+    """先頭の数件の推定バイト数から、全件の推定バイト数を求める"""
+    sample = records[:SIZE_SAMPLE_RECORDS]
+    if not sample:
+        return 0
+    return sum(_estimate_size(record.values()) for record in sample) * len(records) // len(sample)
+
+
+def _total_db_hits(plan: dict | None) -> int:
+    """PROFILEの実行計画から、全オペレータのdb hitsを合計する"""
+    if not plan:
+        return 0
+    return plan.get("dbHits", 0) + sum(_total_db_hits(child) for child in plan.get("children", []))
+
+
+def is_profiled(name: str) -> bool:
+    return "*" in _profile_names or name in _profile_names
+
+
+async def run_query(runner, name: str, query: str, **params) -> list[Record]:
+    """session.run, tx.runの代わりに使用する。結果をすべて取得してRecordのリストを返し、nameごとに計測する。
+    runnerは、AsyncSessionまたはAsyncManagedTransaction。
+    PROFILEが有効なnameは、クエリにPROFILEを付けて実行し、db hitsを記録する。"""
+    profile = is_profiled(name)
+    start = time.perf_counter()
+    try:
+        result = await runner.run(f"PROFILE {query}" if profile else query, **params)
+        records = [record async for record in result]
+        summary = await result.consume()
+    except Exception:
+        _stats.setdefault(name, QueryStats()).errors += 1
+        raise
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    db_hits = _total_db_hits(summary.profile) if profile else None
+    size = _estimate_records_size(records)
+    _stats.setdefault(name, QueryStats()).observe(elapsed_ms, len(records), size, db_hits)
+    if db_hits is not None:
+        logger.info(f"PROFILE {name}: {elapsed_ms:.1f}ms, rows={len(records)}, db_hits={db_hits}")
+    return records
+
+
+async def stream_query(runner, name: str, query: str, batch_size: int = 1000, **params) -> AsyncIterator[list[Record]]:
+    """結果をbatch_size件ずつ取得して、Recordのリストをyieldする。全件をメモリに載せない出力用。
+    計測は、最後まで読み切った場合のみ記録する（PROFILEは行わない）。"""
+    start = time.perf_counter()
+    rows = 0
+    size = 0
+    try:
+        result = await runner.run(query, **params)
+        while True:
+            records = await result.fetch(batch_size)
+            if not records:
+                break
+            rows += len(records)
+            size += _estimate_records_size(records)
+            yield records
+        await result.consume()
+    except Exception:
+        _stats.setdefault(name, QueryStats()).errors += 1
+        raise
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    _stats.setdefault(name, QueryStats()).observe(elapsed_ms, rows, size)
+
+
+# 計測結果の取得、設定
+def get_query_stats() -> dict:
+    return {
+        "profile": sorted(_profile_names),
+        "queries": {name: stats.to_dict() for name, stats in sorted(_stats.items())},
+    }
+
+
+def set_profile(names: list[str], enabled: bool = True) -> list[str]:
+    """nameのPROFILEを切り替える。"*"はすべてのクエリ。"""
+    if enabled:
+        _profile_names.update(names)
+    else:
+        _profile_names.difference_update(names)
+    return sorted(_profile_names)
+
+
+def reset_query_stats():
+    _stats.clear()
@@ -0,0 +1,212 @@
+from logging import getLogger
+from chat_wb.neo4j.driver import driver, read_query
+import config
+
+# ロガー設定
+logger = getLogger(__name__)
+
+
+# Alias
+# Entityの名前解決には、(:Alias {label, name})-[:ALIAS_OF]->(n) を使用する。
+# n.name, n.name_variationの各要素に対して、同じラベルのAliasノードを1つずつ作成する。
+# 同名のノードが複数存在する場合、1つのAliasから複数のALIAS_OFが伸びる。
+# (label, name)の複合ユニーク制約により、名前解決はインデックスシークになる。
+ALIAS_LABEL = "Alias"
+ALIAS_TYPE = "ALIAS_OF"
+
+# 全文検索インデックス
+# Messageのuser_input, ai_responseと、Aliasのname（Entityの名前、別名）を、ベクトル検索と組み合わせて検索する。
+MESSAGE_FULLTEXT_INDEX = "message_text"
+ALIAS_FULLTEXT_INDEX = "alias_name_text"
+
+# Property Archive
+# Entityのプロパティの値は、NEO4J_PROPERTY_VALUE_LIMIT個まで保持し、古い値は(n)-[:ARCHIVED]->(:PropertyArchive {key, values})に移す。
+# ノードのペイロードとプロンプトの大きさが、会話の長さに比例して増えないようにする。
+ARCHIVE_LABEL = "PropertyArchive"
+ARCHIVE_TYPE = "ARCHIVED"
+# 上限を適用しないプロパティ（Aliasの作成に使うため）
+UNCAPPED_PROPERTIES = ["name_variation"]
+
+# Entityとして扱わないラベル（Entityの一覧や探索から除外する）
+NON_ENTITY_LABELS = ["Title", "Message", ALIAS_LABEL, ARCHIVE_LABEL]
+
+# Title
+# (:Title)-[:LATEST]->(:Message) は、Titleの最新のMessageを指す。store_messageで付け替える。
+# 最新n件のMessageは、LATESTからFOLLOWを辿って取得する（会話の長さによらず、nに比例する）。
+LATEST_TYPE = "LATEST"
+# 会話やEntityの関係として扱わないリレーションタイプ
+INTERNAL_RELATIONSHIP_TYPES = [ALIAS_TYPE, LATEST_TYPE, ARCHIVE_TYPE]
+
+# ノードnのname, name_variationに対応するAliasを作成する（直前のWITHでnを渡す）
+# name_variationの置き換えや改名、ラベルの変更で使われなくなった名前のALIAS_OFは外し、他のノードを指さなくなったAliasは削除する。
+SYNC_ALIASES = """
+    CALL {
+        WITH n
+        WITH n, [alias_name IN [n.name] + coalesce(n.name_variation, []) WHERE alias_name IS NOT NULL] AS alias_names
+        CALL {
+            WITH n, alias_names
+            MATCH (a:Alias)-[s:ALIAS_OF]->(n)
+            WHERE NOT a.name IN alias_names OR a.label <> head(labels(n))
+            DELETE s
+            WITH a
+            WHERE NOT (a)-[:ALIAS_OF]->()
+            DELETE a
+        }
+        UNWIND alias_names AS alias_name
+        MERGE (a:Alias {label: head(labels(n)), name: alias_name})
+        MERGE (a)-[:ALIAS_OF]->(n)
+    }
+"""
+
+# ラベルの組とリレーションタイプのカタログ
+# (始点ラベル, 終点ラベル) -> リレーションタイプ（最初に登録されたもの）
+# 起動時にdb.schema.visualization()から作成し（スキーマの大きさに比例し、リレーションシップ数によらない）、
+# 以降は、リレーションシップを作成する書き込み処理から差分を登録する。
+RELATION_CATALOG: dict[tuple[str, str], str] = {}
+
+
+def register_relation_types(triples) -> int:
+    """(始点ラベル, リレーションタイプ, 終点ラベル)をカタログに登録し、新規に登録した数を返す"""
+    added = 0
+    for start_label, relation_type, end_label in triples:
+        if not start_label or not end_label or start_label == ALIAS_LABEL or relation_type in INTERNAL_RELATIONSHIP_TYPES:
+            continue
+        if (start_label, end_label) not in RELATION_CATALOG:
+            RELATION_CATALOG[(start_label, end_label)] = relation_type
+            added += 1
+    if added:
+        logger.info(f"Relation catalog: {added} label pairs added.")
+    return added
+
+
+async def load_relation_catalog() -> dict[tuple[str, str], str]:
+    """db.schema.visualization()からカタログを作り直す。
+    countストアから作られるため、実在しないラベルの組が含まれる場合がある（プロンプトのヒント用途では許容する）。"""
+    records = await read_query(
+        "load_relation_catalog",
+        "CALL db.schema.visualization() YIELD relationships RETURN relationships",
+    )
+    triples = [
+        (next(iter(r.start_node.labels), None), r.type, next(iter(r.end_node.labels), None))
+        for record in records
+        for r in record["relationships"]
+    ]
+    RELATION_CATALOG.clear()
+    register_relation_types(triples)
+    return RELATION_CATALOG
+
+
+async def ensure_schema():
+    """制約、インデックスを作成する。アプリケーション起動時に一度実行する。"""
+    async with driver.session() as session:
+        # Aliasの名前解決用（ラベル指定あり、ラベル指定なし）
+        await session.run(
+            """
+            CREATE CONSTRAINT alias_label_name IF NOT EXISTS
+            FOR (a:Alias) REQUIRE (a.label, a.name) IS UNIQUE
+            """
+        )
+        await session.run("CREATE INDEX alias_name IF NOT EXISTS FOR (a:Alias) ON (a.name)")
+        # インポートしたMessageの重複防止用（インポートの入力の行ごとに一意な値）
+        await session.run(
+            """
+            CREATE CONSTRAINT message_import_key IF NOT EXISTS
+            FOR (m:Message) REQUIRE m.import_key IS UNIQUE
+            """
+        )
+        # Titleの検索用
+        await session.run("CREATE INDEX title_title IF NOT EXISTS FOR (a:Title) ON (a.title)")
+        # Titleの一覧（update_timeの降順）、Messageの時間順の取得、期間指定用
+        await session.run("CREATE INDEX title_update_time IF NOT EXISTS FOR (a:Title) ON (a.update_time)")
+        await session.run("CREATE INDEX message_create_time IF NOT EXISTS FOR (m:Message) ON (m.create_time)")
+        # Entityの更新履歴（Messageのcreate_timeを複製した、CONTAINのcreate_time）の期間指定、降順の取得用
+        await session.run("CREATE INDEX contain_create_time IF NOT EXISTS FOR ()-[r:CONTAIN]-() ON (r.create_time)")
+        # Messageの本文、Entityの名前の全文検索用
+        fulltext_options = f"OPTIONS {{indexConfig: {{`fulltext.analyzer`: '{config.NEO4J_FULLTEXT_ANALYZER}'}}}}"
+        await session.run(
+            f"""
+            CREATE FULLTEXT INDEX {MESSAGE_FULLTEXT_INDEX} IF NOT EXISTS
+            FOR (m:Message) ON EACH [m.user_input, m.ai_response]
+            {fulltext_options}
+            """
+        )
+        await session.run(
+            f"""
+            CREATE FULLTEXT INDEX {ALIAS_FULLTEXT_INDEX} IF NOT EXISTS
+            FOR (a:Alias) ON EACH [a.name]
+            {fulltext_options}
+            """
+        )
+
+        # 既存のEntityラベルに対して、MERGE (n:Label {name: $name})用のインデックスを作成する
+        result = await session.run("CALL db.labels()")
+        labels = [record["label"] async for record in result]
+        for label in labels:
+            if label in NON_ENTITY_LABELS:
+                continue
+            await session.run(f"CREATE INDEX `name_{label}` IF NOT EXISTS FOR (n:`{label}`) ON (n.name)")
+    logger.info("Neo4j schema ensured.")
+
+
+# 既存データの移行
+# いずれもラベル、リレーションタイプ全体を走査するため、起動時には実行しない。移行時に、chat_wb.jobs.backfillで一度実行する。
+async def backfill_aliases():
+    """Aliasを持たない既存のEntityに対して、Aliasを作成する。"""
+    async with driver.session() as session:
+        # CALL { } IN TRANSACTIONSは、auto-commitトランザクションでのみ実行できる。
+        result = await session.run(
+            f"""
+            MATCH (n)
+            WHERE NOT n:Title AND NOT n:Message AND NOT n:Alias AND NOT n:PropertyArchive
+                AND n.name IS NOT NULL
+                AND NOT EXISTS {{ (n)<-[:ALIAS_OF]-(:Alias) }}
+            CALL {{
+                WITH n
+                {SYNC_ALIASES}
+            }} IN TRANSACTIONS OF 1000 ROWS
+            RETURN count(n) AS count
+            """
+        )
+        record = await result.single()
+    logger.info(f"Aliases backfilled: {record['count'] if record else 0} nodes.")
+
+
+async def backfill_latest_messages():
+    """LATESTを持たないTitleに対して、create_timeが最新のMessageへのLATESTを作成する。"""
+    async with driver.session() as session:
+        result = await session.run(
+            """
+            MATCH (t:Title)
+            WHERE NOT EXISTS { (t)-[:LATEST]->(:Message) }
+            CALL {
+                WITH t
+                MATCH (t)-[:CONTAIN]->(m:Message)
+                WITH t, m
+                ORDER BY m.create_time DESC
+                LIMIT 1
+                CREATE (t)-[:LATEST]->(m)
+                RETURN count(m) AS created
+            } IN TRANSACTIONS OF 1000 ROWS
+            RETURN sum(created) AS count
+            """
+        )
+        record = await result.single()
+    logger.info(f"Latest message pointers backfilled: {record['count'] if record else 0} titles.")
+
+
+async def backfill_contain_time():
+    """create_timeを持たない(Message)-[:CONTAIN]->(Entity)に、Messageのcreate_timeを設定する。"""
+    async with driver.session() as session:
+        result = await session.run(
+            """
+            MATCH (m:Message)-[r:CONTAIN]->()
+            WHERE r.create_time IS NULL AND m.create_time IS NOT NULL
+            CALL {
+                WITH m, r
+                SET r.create_time = m.create_time
+            } IN TRANSACTIONS OF 10000 ROWS
+            RETURN count(r) AS count
+            """
+        )
+        record = await result.single()
+    logger.info(f"CONTAIN create_time backfilled: {record['count'] if record else 0} relationships.")
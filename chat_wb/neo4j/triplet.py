@@ -12,7 +12,7 @@ from chat_wb.main.prompt import (
     EXTRACT_ENTITY_PROMPT,
     TEXT_TRIAGER_PROMPT,
 )
-from chat_wb.neo4j.neo4j import create_update_node, create_update_relationship
+from chat_wb.neo4j.neo4j import store_triplets
 from openai_api.models import ChatPrompt
 from utils.common import atimer
 
@@ -183,9 +183,5 @@ class TripletsConverter():
 
     @staticmethod
     async def store_memory_from_triplet(triplets: Triplets):
-        """user_input_entityに基づいて、Neo4jにノード、リレーションシップを保存"""
-        for node in triplets.nodes:
-            create_update_node(node)
-        if triplets.relationships:
-            for relation in triplets.relationships:
-                create_update_relationship(relation)
+        """user_input_entityに基づいて、Neo4jにノード、リレーションシップを1トランザクションで保存"""
+        await store_triplets(triplets)
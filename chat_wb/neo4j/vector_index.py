@@ -0,0 +1,352 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from logging import getLogger
+import neo4j
+import numpy as np
+from chat_wb.neo4j.driver import driver
+from chat_wb.neo4j.profiler import stream_query
+import config
+
+# ロガー設定
+logger = getLogger(__name__)
+
+
+# Messageのベクトルの、プロセス内のインデックス
+# Messageのベクトルを、正規化したfloat32の行列としてメモリに保持し、NumPyの行列積でスコアを求める。
+# 行は、(Title, create_timeの期間)ごとのパーティションに登録し、Titleや期間を指定した検索では、
+# 該当するパーティションの行のみスコアを計算する（会話ごと、最近のみの検索は、全体の件数によらない）。
+# 起動時にNeo4jから読み込み（load）、以降はstore_message, store_messagesの書き込み後に追加（add）する。
+# 他のプロセス（ワーカー、ジョブ）の書き込みは、create_timeで定期的に読み込み（catch_up）、
+# create_timeが過去の書き込み（インポート）や、Messageの削除は、定期的な読み込み直し（load）で反映する。
+# スコアは、Neo4jのベクトルインデックス（cosine）と同じく、(1 + cos) / 2 とする。
+# dtypeがfloat16, int8の場合、行列のメモリは1/2, 1/4になるが、スコアは近似値になる（呼び出し側で、元のベクトルで再計算する）。
+PARTITION_SECONDS = 30 * 24 * 60 * 60   # 期間のパーティションの幅（30日）
+SCORE_BLOCK_ROWS = 65536                # 量子化した行列を、float32に変換して計算する行数
+SYNC_LAG_SECONDS = 60                   # catch_upで、前回の読み込みより前から読み込む秒数（コミットの遅れ、時計のずれ）
+# dtype -> (値の倍率, スコアの誤差の目安)
+DTYPES = {
+    "float32": (1.0, 0.0),
+    "float16": (1.0, 0.001),
+    "int8": (127.0, 0.01),
+}
+
+
+class _Rows:
+    """パーティションに属する行番号の、伸長可能な配列"""
+
+    def __init__(self):
+        self.size = 0
+        self._rows = np.zeros(16, dtype=np.int64)
+
+    def append(self, row: int):
+        if self.size == len(self._rows):
+            self._rows = np.resize(self._rows, len(self._rows) * 2)
+        self._rows[self.size] = row
+        self.size += 1
+
+    def extend(self, rows: np.ndarray):
+        for row in rows:
+            self.append(int(row))
+
+    def view(self) -> np.ndarray:
+        return self._rows[:self.size]
+
+
+class MessageVectorIndex:
+    def __init__(self, capacity: int = 1024, dtype: str = "float32"):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported dtype: {dtype}")
+        self.capacity = capacity
+        self.dtype = dtype
+        self.scale, self.error = DTYPES[dtype]
+        self._replay: list[tuple] | None = None    # 読み込み直しの間に追加されたMessage
+        self.clear()
+
+    @property
+    def quantized(self) -> bool:
+        return self.dtype != "float32"
+
+    def clear(self):
+        self.size = 0
+        self.dimensions: int | None = None
+        self.ready = False
+        self._ids = np.zeros(self.capacity, dtype=np.int64)
+        self._times = np.zeros(self.capacity, dtype=np.float64)   # create_time（UNIX時間）
+        self._matrix: np.ndarray | None = None
+        self._codes: dict[str, int] = {}         # title -> code
+        self._next_code = 0
+        self._positions: dict[int, int] = {}     # message_id -> 行
+        self._partitions: dict[tuple[int, int], _Rows] = {}    # (title code, 期間) -> 行
+        self._synced_until: float | None = None  # DBから読み込んだ、最新のcreate_time（UNIX時間）
+
+    def _reserve(self, n: int):
+        """n行を追加できるよう、容量を倍々に増やす"""
+        capacity = len(self._ids)
+        if self.size + n <= capacity and self._matrix is not None:
+            return
+        while self.size + n > capacity:
+            capacity *= 2
+        self._ids = np.resize(self._ids, capacity)
+        self._times = np.resize(self._times, capacity)
+        matrix = np.zeros((capacity, self.dimensions), dtype=self.dtype)
+        if self._matrix is not None:
+            matrix[:self.size] = self._matrix[:self.size]
+        self._matrix = matrix
+
+    def _title_code(self, title: str) -> int:
+        if title not in self._codes:
+            self._codes[title] = self._next_code
+            self._next_code += 1
+        return self._codes[title]
+
+    def add_many(self, message_ids: list[int], titles: list[str], create_times: list[datetime], vectors: list[list[float]]):
+        """Messageを追加する。追加済みのmessage_idは、ベクトルのみ置き換える。"""
+        if not message_ids:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        if self.dimensions is None:
+            self.dimensions = vectors.shape[1]
+        elif vectors.shape[1] != self.dimensions:
+            logger.error(f"Vector dimensions mismatch: {vectors.shape[1]} != {self.dimensions}. skipped.")
+            return
+        self._reserve(len(message_ids))
+        for message_id, title, create_time, vector in zip(message_ids, titles, create_times, vectors):
+            position = self._positions.get(message_id)
+            if position is None:
+                position = self.size
+                self._positions[message_id] = position
+                self.size += 1
+                self._ids[position] = message_id
+                self._times[position] = _timestamp(create_time)
+                key = (self._title_code(title), _partition(self._times[position]))
+                self._partitions.setdefault(key, _Rows()).append(position)
+            self._matrix[position] = self._quantize(vector)
+        if self._replay is not None:
+            self._replay.append((message_ids, titles, create_times, vectors))
+
+    def _quantize(self, vector: np.ndarray) -> np.ndarray:
+        if self.dtype == "int8":
+            return np.clip(np.rint(vector * self.scale), -127, 127).astype(np.int8)
+        return vector.astype(self.dtype)
+
+    def _scores(self, query: np.ndarray, rows: np.ndarray | None) -> np.ndarray:
+        """行（Noneはすべて）のスコアを求める。量子化した行列は、ブロックごとにfloat32に変換して計算する。"""
+        n = self.size if rows is None else len(rows)
+        if not self.quantized:
+            dots = self._matrix[:n] @ query if rows is None else self._matrix[rows] @ query
+        else:
+            dots = np.empty(n, dtype=np.float32)
+            for start in range(0, n, SCORE_BLOCK_ROWS):
+                end = min(start + SCORE_BLOCK_ROWS, n)
+                block = self._matrix[start:end] if rows is None else self._matrix[rows[start:end]]
+                dots[start:end] = block.astype(np.float32) @ query
+            dots /= self.scale
+        return (1.0 + dots) / 2.0
+
+    def add(self, message_id: int, title: str, create_time: datetime, vector: list[float]):
+        self.add_many([message_id], [title], [create_time], [vector])
+
+    def rename_title(self, title: str, new_title: str):
+        """Titleの名前を変更する（行列は変更しない）"""
+        if title == new_title or title not in self._codes:
+            return
+        code = self._codes.pop(title)
+        if new_title not in self._codes:
+            self._codes[new_title] = code
+            return
+        # 既存のTitleに合わせて、パーティションを統合する
+        new_code = self._codes[new_title]
+        for (c, bucket) in [key for key in self._partitions if key[0] == code]:
+            rows = self._partitions.pop((c, bucket))
+            self._partitions.setdefault((new_code, bucket), _Rows()).extend(rows.view())
+
+    def _select_rows(self, since: datetime | None, titles: list[str] | None) -> np.ndarray | None:
+        """Title、期間に該当する行を返す。絞り込まない場合はNone。"""
+        if since is None and titles is None:
+            return None
+        codes = None if titles is None else {self._codes[title] for title in titles if title in self._codes}
+        since_ts = None if since is None else _timestamp(since)
+        since_bucket = None if since_ts is None else _partition(since_ts)
+        parts = [
+            rows.view()
+            for (code, bucket), rows in self._partitions.items()
+            if (codes is None or code in codes) and (since_bucket is None or bucket >= since_bucket)
+        ]
+        if not parts:
+            return np.zeros(0, dtype=np.int64)
+        selected = np.concatenate(parts)
+        if since_ts is not None:
+            # 境界のパーティションには、期間外の行が含まれる
+            selected = selected[self._times[selected] > since_ts]
+        return selected
+
+    def search(
+        self,
+        vector: list[float],
+        k: int = 3,
+        threshold: float = 0.0,
+        since: datetime | None = None,
+        titles: list[str] | None = None,
+    ) -> list[tuple[int, float]]:
+        """スコアの高い順に、(message_id, score)をk件返す。Title、期間で絞り込んでからスコアを計算する。"""
+        if self.size == 0 or k <= 0:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        rows = self._select_rows(since, titles)
+        if rows is not None and len(rows) == 0:
+            return []
+        scores = self._scores(query, rows)
+
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        return [
+            (int(self._ids[i if rows is None else rows[i]]), float(scores[i]))
+            for i in top
+            if scores[i] > threshold
+        ]
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "size": self.size,
+            "titles": len(self._codes),
+            "partitions": len(self._partitions),
+            "dimensions": self.dimensions,
+            "dtype": self.dtype,
+            "bytes": self._matrix.nbytes if self._matrix is not None else 0,
+            "synced_until": (
+                datetime.fromtimestamp(self._synced_until, timezone.utc).isoformat()
+                if self._synced_until is not None else None
+            ),
+        }
+
+    def _swap(self, other: "MessageVectorIndex"):
+        """otherの内容に置き換える（awaitを挟まないため、検索、追加の途中で切り替わることはない）"""
+        for name in (
+            "size", "dimensions", "_ids", "_times", "_matrix", "_codes",
+            "_next_code", "_positions", "_partitions", "_synced_until",
+        ):
+            setattr(self, name, getattr(other, name))
+        self.ready = True
+
+    async def _fetch(self, name: str, query: str, batch_size: int, **params):
+        """Messageを、batch_size件ずつ読み込む"""
+        async with driver.session(fetch_size=batch_size, default_access_mode=neo4j.READ_ACCESS) as session:
+            async for records in stream_query(
+                session, name, query, batch_size=batch_size, embedding_property=config.EMBEDDING_PROPERTY, **params
+            ):
+                yield records
+
+    async def _ingest(self, batches) -> int:
+        """読み込んだMessageを追加し、件数を返す"""
+        count = 0
+        async for records in batches:
+            create_times = [_native(record["create_time"]) for record in records]
+            self.add_many(
+                [record["message_id"] for record in records],
+                [record["title"] for record in records],
+                create_times,
+                [record["embedding"] for record in records],
+            )
+            if create_times:
+                latest = max(_timestamp(create_time) for create_time in create_times)
+                self._synced_until = max(self._synced_until or latest, latest)
+            count += len(records)
+        return count
+
+    async def load(self, batch_size: int = 1000):
+        """Neo4jから、ベクトルを持つすべてのMessageを読み込む。
+        別のインデックスに読み込んでから置き換えるため、読み込みの間も、現在のインデックスで検索できる。
+        読み込みの間に追加されたMessageは、新しいインデックスにも追加する。
+        """
+        start = time.perf_counter()
+        fresh = MessageVectorIndex(self.capacity, self.dtype)
+        self._replay = []
+        try:
+            await fresh._ingest(self._fetch(
+                "vector_index.load",
+                """
+                MATCH (t:Title)-[:CONTAIN]->(m:Message)
+                WHERE m[$embedding_property] IS NOT NULL
+                RETURN id(m) AS message_id, t.title AS title, m.create_time AS create_time,
+                    m[$embedding_property] AS embedding
+                """,
+                batch_size,
+            ))
+            for args in self._replay:
+                fresh.add_many(*args)
+        finally:
+            self._replay = None
+        self._swap(fresh)
+        logger.info(f"Message vector index loaded: {self.size} messages in {time.perf_counter() - start:.1f}s.")
+
+    async def catch_up(self, batch_size: int = 1000) -> int:
+        """前回の読み込み以降に、他のプロセスで作成されたMessageを読み込み、件数を返す。
+        追加済みのMessageも読み込むが、add_manyで置き換えるため重複しない。
+        """
+        if not self.ready:
+            return 0
+        since = (self._synced_until or 0.0) - SYNC_LAG_SECONDS
+        count = await self._ingest(self._fetch(
+            "vector_index.catch_up",
+            """
+            MATCH (m:Message)
+            WHERE m.create_time > datetime({epochMillis: $since}) AND m[$embedding_property] IS NOT NULL
+            MATCH (t:Title)-[:CONTAIN]->(m)
+            RETURN id(m) AS message_id, t.title AS title, m.create_time AS create_time,
+                m[$embedding_property] AS embedding
+            """,
+            batch_size,
+            since=int(since * 1000),
+        ))
+        return count
+
+    async def keep_in_sync(self, interval: float, reload_interval: float):
+        """interval秒ごとにcatch_upし、reload_interval秒ごと（0は行わない）に、すべて読み込み直す"""
+        last_load = time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if reload_interval and time.monotonic() - last_load >= reload_interval:
+                    await self.load()
+                    last_load = time.monotonic()
+                else:
+                    await self.catch_up()
+            except Exception as e:
+                logger.error(f"Message vector index sync failed: {e}")
+
+
+def _partition(timestamp: float) -> int:
+    return int(timestamp // PARTITION_SECONDS)
+
+
+def _native(value) -> datetime:
+    """neo4j.time.DateTimeは、datetimeに変換する"""
+    return value.to_native() if hasattr(value, "to_native") else value
+
+
+def _timestamp(value: datetime) -> float:
+    """タイムゾーンのないdatetimeは、UTCとして扱う（Neo4jのdatetime()と同じ）"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def exact_scores(vector: list[float], vectors: list[list[float]]) -> list[float]:
+    """元のベクトルでのスコア（(1 + cos) / 2）。量子化したインデックスの候補を、並べ替えるために使う。"""
+    if not vectors:
+        return []
+    query = np.asarray(vector, dtype=np.float32)
+    query /= max(float(np.linalg.norm(query)), 1e-12)
+    matrix = np.asarray(vectors, dtype=np.float32)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    return ((1.0 + matrix @ query) / 2.0).tolist()
+
+
+message_vector_index = MessageVectorIndex(dtype=config.MESSAGE_VECTOR_INDEX_DTYPE)
@@ -1,10 +1,11 @@
 from logging import getLogger
-from chat_wb.neo4j.memory import (get_messages, get_titles, query_messages, create_and_update_title,
+from chat_wb.neo4j.memory import (get_messages, get_titles, get_titles_page, query_messages, create_and_update_title,
                                   get_latest_messages, pursue_node_update_history)
 from chat_wb.neo4j.triplet import TripletsConverter
 from chat_wb.models import remove_suffix
-from fastapi import APIRouter, Body
+from fastapi import APIRouter, Body, Query
 from chat_wb.neo4j.neo4j import get_node_relationships
+from chat_wb.neo4j.vector_index import message_vector_index
 from chat_wb.models import Triplets, ShortMemory, Relationships
 
 memory_router = APIRouter()
@@ -14,21 +15,28 @@ logger = getLogger(__name__)
 
 
 @memory_router.get("/get_messages", tags=["memory"])
-def get_messages_api(title: str, n: int = 100):
-    messages = get_messages(title, n)
+async def get_messages_api(title: str, n: int = 100):
+    messages = await get_messages(title, n)
     return messages
 
 
 @memory_router.get("/get_titles", tags=["memory"])
-def get_titles_api():
-    return get_titles()
+async def get_titles_api():
+    return await get_titles()
+
+
+@memory_router.get("/get_titles/page", tags=["memory"])
+async def get_titles_page_api(before: str | None = None, limit: int = Query(50, ge=1, le=1000)):
+    """更新が新しい順のタイトルを、limit件ずつ取得する。次のページは、返却したnext_cursorをbeforeに指定する。"""
+    titles, next_cursor = await get_titles_page(before, limit)
+    return {"titles": titles, "next_cursor": next_cursor}
 
 
 # [TODO] MessageからのContainリレーションシップを作成する
 @memory_router.get("/get_latest_messages/{title}/{n}", tags=["memory"])
-def get_latest_messages_api(title: str, n: int = 7) -> Triplets | None:
+async def get_latest_messages_api(title: str, n: int = 7) -> Triplets | None:
     """指定したタイトルの最新n件のメッセージを取得し、関連するEntityと閉じたリレーションシップを取得する。"""
-    return get_latest_messages(title, n)
+    return await get_latest_messages(title, n)
 
 
 @memory_router.post("/store_memory_from_triplet", tags=["memory"])
@@ -55,10 +63,32 @@ async def retrieve_entity_api(text: str):
 
 
 @memory_router.get("/query_messages", tags=["memory"])
-async def query_messages_api(query: str):
-    return await query_messages(query)
+async def query_messages_api(query: str, titles: list[str] | None = Query(None)):
+    return await query_messages(query, titles=titles)
+
+
+@memory_router.get("/vector_index", tags=["memory"])
+async def vector_index_stats_api():
+    """プロセス内のMessageのベクトルインデックスの件数、メモリ使用量を取得する。"""
+    return message_vector_index.stats()
+
+
+@memory_router.post("/vector_index/reload", tags=["memory"])
+async def reload_vector_index_api():
+    """プロセス内のMessageのベクトルインデックスを、Neo4jから読み込み直す（読み込みの間も、現在のインデックスで検索する）。"""
+    await message_vector_index.load()
+    return message_vector_index.stats()
 
 
 @memory_router.get("/pursue_node_update_history", tags=["memory"])
-async def pursue_node_update_history_api(label: str, name: str):
-    return await pursue_node_update_history(label, name)
+async def pursue_node_update_history_api(
+    label: str,
+    name: str,
+    limit: int = Query(50, ge=1, le=1000),
+    since: str | None = None,
+    until: str | None = None,
+    cursor: str | None = None,
+):
+    """Entityを含むMessageを、新しい順にlimit件取得する。since, untilはISO 8601。
+    次のページは、返却したnext_cursorをcursorに指定する。"""
+    return await pursue_node_update_history(label, name, limit, since, until, cursor)
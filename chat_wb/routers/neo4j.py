@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Body
+from fastapi import APIRouter, Body, Query
+from fastapi.responses import StreamingResponse
 from logging import getLogger
 import pandas as pd
 from chat_wb.cache import (
@@ -6,64 +7,132 @@ from chat_wb.cache import (
     fetch_node_names,
     fetch_relationships,
     fetch_label_and_relationship_type_sets,
+    invalidate_node_names,
 )
+from chat_wb.neo4j.driver import health_check
+from chat_wb.neo4j.profiler import get_query_stats, set_profile, reset_query_stats
 from chat_wb.neo4j.neo4j import (
     get_node,
     get_node_relationships,
     get_all_nodes,
     get_all_relationships,
+    get_nodes_page,
+    get_relationships_page,
+    stream_all_nodes,
+    stream_all_relationships,
     integrate_nodes,
+    merge_nodes,
     delete_node,
     create_update_node
 )
 
-from chat_wb.models import Node
+from chat_wb.models import Node, MergeGroup
 
 logger = getLogger(__name__)
 
 neo4j_router = APIRouter()
 
 
+# Neo4jの接続確認
+@neo4j_router.get("/health", tags=["health"])
+async def health_check_api():
+    """Neo4jへの接続とコネクションプールの設定を確認する。"""
+    return await health_check()
+
+
+# クエリごとの計測結果
+@neo4j_router.get("/query_stats", tags=["health"])
+async def get_query_stats_api():
+    """クエリ名ごとの実行時間のヒストグラム、返却行数、推定バイト数、PROFILEのdb hitsを取得する。"""
+    return get_query_stats()
+
+
+@neo4j_router.put("/query_stats/profile", tags=["health"])
+async def set_profile_api(names: list[str] = Body(...), enabled: bool = Body(True)):
+    """指定したクエリ名を、PROFILE付きで実行するかを切り替える。"*"はすべてのクエリ。"""
+    return {"profile": set_profile(names, enabled)}
+
+
+@neo4j_router.delete("/query_stats", tags=["health"])
+async def reset_query_stats_api():
+    """計測結果をリセットする。"""
+    reset_query_stats()
+    return {"status": True}
+
+
 # GET Label and Relationship　キャッシュから取得する
 @neo4j_router.get("/node_labels", tags=["label"])
-def get_node_labels_api():
-    labels = fetch_labels()
+async def get_node_labels_api():
+    labels = await fetch_labels()
     return labels
 
 
 @neo4j_router.get("/relationship_types", tags=["label"])
-def get_relationship_types_api():
-    relationship_types = fetch_relationships()
+async def get_relationship_types_api():
+    relationship_types = await fetch_relationships()
     return relationship_types
 
 
 @neo4j_router.get("/label_and_relationship_type_sets", tags=["label"])
-def get_label_and_relationship_type_sets_api():
-    label_and_relationship_type_sets = fetch_label_and_relationship_type_sets()
+async def get_label_and_relationship_type_sets_api():
+    label_and_relationship_type_sets = await fetch_label_and_relationship_type_sets()
     return label_and_relationship_type_sets
 
 
 @neo4j_router.get("/node_names/{label}", tags=["label"])
-def get_node_names_api(label: str):
+async def get_node_names_api(label: str):
     """すべてのノードの名前をリストとして取得する"""
-    nodes = fetch_node_names(label=label)
+    nodes = await fetch_node_names(label=label)
     return nodes
 
 
 @neo4j_router.get("/all_nodes", tags=["label"])
-def get_all_node_names_api():
+async def get_all_node_names_api():
     """すべてのノードのラベルと名前をリストとして取得する"""
-    nodes = get_all_nodes()
+    nodes = await get_all_nodes()
     return nodes
 
 
 @neo4j_router.get("/all_relationships", tags=["label"])
-def get_all_relationships_api():
+async def get_all_relationships_api():
     """すべてのノードのラベルと名前をリストとして取得する"""
-    relationships = get_all_relationships()
+    relationships = await get_all_relationships()
     return relationships
 
 
+# カーソルによるページング（next_cursorがNoneになるまで、cursorに渡して繰り返す）
+@neo4j_router.get("/all_nodes/page", tags=["label"])
+async def get_nodes_page_api(cursor: str | None = None, limit: int = Query(1000, ge=1, le=10000)):
+    """ノードのラベルと名前を、ラベル、名前の順にlimit件ずつ取得する"""
+    nodes, next_cursor = await get_nodes_page(cursor=cursor, limit=limit)
+    return {"items": nodes, "next_cursor": next_cursor}
+
+
+@neo4j_router.get("/all_relationships/page", tags=["label"])
+async def get_relationships_page_api(cursor: str | None = None, limit: int = Query(1000, ge=1, le=10000)):
+    """リレーションシップのタイプと始点・終点ノードの名前を、始点のラベル、名前の順にlimit件ずつ取得する"""
+    relationships, next_cursor = await get_relationships_page(cursor=cursor, limit=limit)
+    return {"items": relationships, "next_cursor": next_cursor}
+
+
+# NDJSON（1行1レコード）でのストリーミング
+async def _to_ndjson(batches):
+    async for batch in batches:
+        yield "".join(item.model_dump_json() + "\n" for item in batch)
+
+
+@neo4j_router.get("/all_nodes/stream", tags=["label"])
+async def stream_all_nodes_api(batch_size: int = Query(1000, ge=1, le=10000)):
+    """すべてのノードのラベルと名前を、NDJSONでストリーミングする"""
+    return StreamingResponse(_to_ndjson(stream_all_nodes(batch_size)), media_type="application/x-ndjson")
+
+
+@neo4j_router.get("/all_relationships/stream", tags=["label"])
+async def stream_all_relationships_api(batch_size: int = Query(1000, ge=1, le=10000)):
+    """すべてのリレーションシップを、NDJSONでストリーミングする"""
+    return StreamingResponse(_to_ndjson(stream_all_relationships(batch_size)), media_type="application/x-ndjson")
+
+
 # For Character Settings
 # get node
 @neo4j_router.get("/get_node/{label}/{name}", tags=["node"])
@@ -100,10 +169,20 @@ async def integrate_nodes_api(node1: Node = Body(...), node2: Node = Body(...)):
         return await integrate_nodes(node1, node2)
 
 
+@neo4j_router.put("/merge_nodes", tags=["node"])
+async def merge_nodes_api(groups: list[MergeGroup] = Body(...), dry_run: bool = False):
+    """グループごとに、重複ノードをtargetに統合して削除する。各グループは1つのトランザクションで処理する。
+    dry_runの場合、書き込みを行わずに、統合後の名前、プロパティと、移すリレーションシップの数を返す。"""
+    results = await merge_nodes(groups, dry_run)
+    if not dry_run:
+        invalidate_node_names([node.label for group in groups for node in [group.target, *group.duplicates]])
+    return results
+
+
 @neo4j_router.delete("/delete_node/{label}/{name}", tags=["node"])
 async def delete_node_api(label: str, name: str):
     """ノードを削除する。"""
-    return delete_node(label=label, name=name)
+    return await delete_node(label=label, name=name)
 
 
 # create node
@@ -119,7 +198,7 @@ async def create_update_node_api(node: Node = Body(...)):
 
     if all(not isinstance(v, list) for v in properties.values()):
         # propertiesにリスト要素がない場合
-        create_update_node(Node(label=label, name=name, properties=properties))
+        await create_update_node(Node(label=label, name=name, properties=properties))
     else:
         # propertiesのリスト要素を展開する
         df = pd.DataFrame({k: pd.Series(v) if isinstance(v, list) else v for k, v in properties.items()})
@@ -127,7 +206,7 @@ async def create_update_node_api(node: Node = Body(...)):
         expanded_properties = df.to_dict(orient='records')      # DataFrameの各行を辞書に変換してリストにまとめる
         # ノードを作成、更新する
         for prop in expanded_properties:
-            create_update_node(Node(label=label, name=name, properties=prop))
+            await create_update_node(Node(label=label, name=name, properties=prop))
 
     result = await get_node(label=label, name=name)
     return result[0] if result else None
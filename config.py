@@ -12,3 +12,59 @@ openai.api_key = openai_api_key
 
 # openai debug log
 os.environ["OPENAI_LOG"] = "debug"
+
+# Embedding
+# ベクトル化のモデルと次元数（text-embedding-3-*は、次元数を減らして保存サイズを小さくできる。ada-002は1536固定）
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "text-embedding-ada-002")
+EMBEDDING_DIMENSIONS = int(os.environ.get("EMBEDDING_DIMENSIONS", 1536))
+# ベクトルを保存するプロパティと、ベクトルインデックスの名前
+# モデルを変更する場合は、chat_wb.jobs.reembedで別のプロパティ、インデックスを作成してから、これらを切り替える
+EMBEDDING_PROPERTY = os.environ.get("EMBEDDING_PROPERTY", "embedding")
+MESSAGE_VECTOR_INDEX = os.environ.get("MESSAGE_VECTOR_INDEX", "Message")
+TITLE_VECTOR_INDEX = os.environ.get("TITLE_VECTOR_INDEX", "Title")
+# ベクトルインデックスの量子化（Neo4j 5.23以降。未対応のサーバーでは、falseにする）
+NEO4J_VECTOR_QUANTIZATION = os.environ.get("NEO4J_VECTOR_QUANTIZATION", "false").lower() == "true"
+# ベクトルのディスクキャッシュ（上限を超えた場合、最近使われていないものから削除する）
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "./cache/embeddings")
+EMBEDDING_CACHE_SIZE_LIMIT = int(os.environ.get("EMBEDDING_CACHE_SIZE_LIMIT", 1024 ** 3))
+# Messageのベクトルを、プロセス内のインデックス（NumPy）にも保持し、query_messagesをDBのベクトルインデックスを使わずに行う
+# メモリは、Message数 × 次元数 × 4バイト（float32。ada-002で、10万件あたり約600MB）
+MESSAGE_VECTOR_INDEX_ENABLED = os.environ.get("MESSAGE_VECTOR_INDEX_ENABLED", "false").lower() == "true"
+# プロセス内のインデックスの保持形式（float32, float16, int8）。float16は1/2、int8は1/4のメモリで、
+# 量子化したベクトルで候補を選び、DBから取得した元のベクトルで、スコアを計算し直す（MESSAGE_VECTOR_RERANK_FACTOR × k件）
+MESSAGE_VECTOR_INDEX_DTYPE = os.environ.get("MESSAGE_VECTOR_INDEX_DTYPE", "float32")
+MESSAGE_VECTOR_RERANK_FACTOR = int(os.environ.get("MESSAGE_VECTOR_RERANK_FACTOR", 4))
+# 他のプロセスで作成されたMessageを、プロセス内のインデックスに読み込む間隔（秒）と、
+# すべて読み込み直す間隔（秒。インポートした過去のMessage、削除を反映する。0は読み込み直さない）
+MESSAGE_VECTOR_INDEX_SYNC_SECONDS = float(os.environ.get("MESSAGE_VECTOR_INDEX_SYNC_SECONDS", 30))
+MESSAGE_VECTOR_INDEX_RELOAD_SECONDS = float(os.environ.get("MESSAGE_VECTOR_INDEX_RELOAD_SECONDS", 3600))
+# Neo4jのベクトルインデックスで検索する場合に、条件を満たすk件が見つかるまで増やす候補数の上限
+MESSAGE_SEARCH_CANDIDATE_BUDGET = int(os.environ.get("MESSAGE_SEARCH_CANDIDATE_BUDGET", 1000))
+# 会話中の記憶の検索で、ベクトル検索と全文検索（Messageの本文、Entityの名前）の順位を、Reciprocal Rank Fusionで統合する
+MESSAGE_HYBRID_SEARCH_ENABLED = os.environ.get("MESSAGE_HYBRID_SEARCH_ENABLED", "true").lower() == "true"
+# RRFの定数k（score = Σ 1 / (k + 順位)）。大きいほど、下位の順位との差が小さくなる
+MESSAGE_RRF_K = int(os.environ.get("MESSAGE_RRF_K", 60))
+# user_inputに含まれるEntity名が、全文検索でこの数以上見つかった場合、LLMによるEntityの抽出を省略する
+ENTITY_FULLTEXT_MIN_MATCHES = int(os.environ.get("ENTITY_FULLTEXT_MIN_MATCHES", 1))
+
+# Neo4j
+# クラスタでは、neo4j://またはneo4j+s://を指定すると、読み取りがリードレプリカにルーティングされる
+NEO4J_URI = os.environ.get("NEO4J_URI")
+NEO4J_USERNAME = os.environ.get("NEO4J_USERNAME", "neo4j")
+NEO4J_PASSWORD = os.environ.get("NEO4J_PASSWORD")
+# コネクションプールの設定（ワーカー数 × プールサイズが、サーバーの接続上限を超えないように設定する）
+NEO4J_MAX_CONNECTION_POOL_SIZE = int(os.environ.get("NEO4J_MAX_CONNECTION_POOL_SIZE", 50))
+NEO4J_CONNECTION_ACQUISITION_TIMEOUT = float(os.environ.get("NEO4J_CONNECTION_ACQUISITION_TIMEOUT", 60.0))
+NEO4J_MAX_CONNECTION_LIFETIME = float(os.environ.get("NEO4J_MAX_CONNECTION_LIFETIME", 3600.0))
+NEO4J_LIVENESS_CHECK_TIMEOUT = float(os.environ.get("NEO4J_LIVENESS_CHECK_TIMEOUT", 30.0))
+NEO4J_FETCH_SIZE = int(os.environ.get("NEO4J_FETCH_SIZE", 1000))
+# マネージドトランザクションの再試行時間（一時的なエラーは、ドライバがジッター付きの指数バックオフで再試行する）
+NEO4J_MAX_TRANSACTION_RETRY_TIME = float(os.environ.get("NEO4J_MAX_TRANSACTION_RETRY_TIME", 30.0))
+# 同じEntityへの同時書き込みを、プロセス内で直列化するロックの数
+NEO4J_ENTITY_LOCK_STRIPES = int(os.environ.get("NEO4J_ENTITY_LOCK_STRIPES", 64))
+# Entityのプロパティ1つあたりに保持する値の数の上限（古い値から、PropertyArchiveに移す。name_variationは除く）
+NEO4J_PROPERTY_VALUE_LIMIT = int(os.environ.get("NEO4J_PROPERTY_VALUE_LIMIT", 20))
+# 全文検索インデックス（Messageの本文、Aliasの名前）のアナライザ。cjkは、日本語をbigramに分割する
+NEO4J_FULLTEXT_ANALYZER = os.environ.get("NEO4J_FULLTEXT_ANALYZER", "cjk")
+# Entityの更新履歴の取得で、CONTAINの数がこれを超えるEntityは、contain_create_timeインデックスを新しい順にシークする
+NODE_HISTORY_INDEX_DEGREE = int(os.environ.get("NODE_HISTORY_INDEX_DEGREE", 1000))
@@ -1,8 +1,10 @@
+import asyncio
 import binascii
 
 # ロガーをuvicornのロガーに設定する
 import logging
 import os
+from contextlib import asynccontextmanager
 from logging import getLogger
 
 from fastapi import FastAPI
@@ -11,6 +13,11 @@ from fastapi.responses import HTMLResponse
 from starlette.middleware.sessions import SessionMiddleware
 
 import config
+from chat_wb.cache import load_cache
+from chat_wb.neo4j.driver import close_driver
+from chat_wb.neo4j.schema import ensure_schema
+from chat_wb.neo4j.memory import check_index
+from chat_wb.neo4j.vector_index import message_vector_index
 from chat_wb.neo4j.triplet import TripletsConverter
 from chat_wb.routers.memory import memory_router
 from chat_wb.routers.neo4j import neo4j_router
@@ -22,7 +29,27 @@ logging.basicConfig(
 )
 logger = getLogger(__name__)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 非同期ドライバを使用するため、インデックスの確認とキャッシュの読み込みは起動時に行う。
+    await ensure_schema()
+    await check_index()
+    await load_cache()
+    sync_task = None
+    if config.MESSAGE_VECTOR_INDEX_ENABLED:
+        await message_vector_index.load()
+        sync_task = asyncio.create_task(message_vector_index.keep_in_sync(
+            config.MESSAGE_VECTOR_INDEX_SYNC_SECONDS, config.MESSAGE_VECTOR_INDEX_RELOAD_SECONDS
+        ))
+    yield
+    if sync_task is not None:
+        sync_task.cancel()
+    # 終了時にコネクションプールを閉じる
+    await close_driver()
+
+
+app = FastAPI(lifespan=lifespan)
 # OpenAI Assistant Routers
 app.include_router(openai_api_router, prefix="")
 
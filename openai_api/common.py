@@ -1,11 +1,15 @@
-from openai import OpenAI
+import asyncio
+from openai import OpenAI, AsyncOpenAI
 import tiktoken
 import openai
 from logging import getLogger
+from openai_api.embedding_cache import embedding_cache, normalize_text
+import config
 
 logger = getLogger(__name__)
 
 client = OpenAI()
+async_client = AsyncOpenAI()
 
 # token数の算出
 def count_tokens(text: str, model="gpt-3.5-turbo-0613") -> int:
@@ -15,13 +19,131 @@ def count_tokens(text: str, model="gpt-3.5-turbo-0613") -> int:
     return tokens
 
 
+# モデルの既定の次元数。FIXED_DIMENSION_MODELSは、次元数を指定できない（指定しても、既定の次元数で返す）。
+MODEL_DIMENSIONS = {"text-embedding-ada-002": 1536, "text-embedding-3-small": 1536, "text-embedding-3-large": 3072}
+FIXED_DIMENSION_MODELS = ["text-embedding-ada-002"]
+
+
 # ベクトル化
-def get_embedding(text: str, model: str = "text-embedding-ada-002") -> list[float]:
-    text = text.replace("\n", " ")
-    result = client.embeddings.create(input=[text], model=model).data[0].embedding
+# モデル、次元数を省略した場合は、config.EMBEDDING_MODEL, config.EMBEDDING_DIMENSIONSを使用する。
+# 同じテキストは、ディスクキャッシュ（embedding_cache）から返し、APIを呼び出さない。
+# 非同期版では、キャッシュの読み書きをasyncio.to_threadで行い、イベントループをブロックしない。
+def embedding_dimensions(model: str | None = None, dimensions: int | None = None) -> int | None:
+    """APIが返すベクトルの次元数（ベクトルインデックスの次元数）。既定の次元数が不明なモデルで、省略した場合はNone。"""
+    if model is None:
+        model = config.EMBEDDING_MODEL
+        dimensions = dimensions or config.EMBEDDING_DIMENSIONS
+    if model in FIXED_DIMENSION_MODELS or not dimensions:
+        return MODEL_DIMENSIONS.get(model)
+    return dimensions
+
+
+def _embedding_options(model: str | None, dimensions: int | None) -> tuple[str, dict]:
+    """(キャッシュのキーに使うモデル名, embeddings.createの引数)を返す"""
+    if model is None:
+        model = config.EMBEDDING_MODEL
+        dimensions = dimensions or config.EMBEDDING_DIMENSIONS
+    if dimensions and model not in FIXED_DIMENSION_MODELS:
+        return f"{model}:{dimensions}", {"model": model, "dimensions": dimensions}
+    return model, {"model": model}
+
+
+def get_embedding(text: str, model: str | None = None, dimensions: int | None = None) -> list[float]:
+    cache_model, options = _embedding_options(model, dimensions)
+    text = normalize_text(text)
+    result = embedding_cache.get(cache_model, text)
+    if result is None:
+        result = client.embeddings.create(input=[text], **options).data[0].embedding
+        embedding_cache.set(cache_model, text, result)
     return result
 
 
+async def aget_embeddings(texts: list[str], model: str | None = None, dimensions: int | None = None) -> list[list[float]]:
+    """複数のtextを1リクエストでベクトル化する（キャッシュにないもののみ）。入力と同じ順序で返す。"""
+    cache_model, options = _embedding_options(model, dimensions)
+    texts = [normalize_text(text) for text in texts]
+    results = await asyncio.to_thread(embedding_cache.get_many, cache_model, texts)
+    misses = list(dict.fromkeys(text for text, result in zip(texts, results) if result is None))
+    if misses:
+        vector_by_text = dict(zip(misses, await _create_embeddings(misses, cache_model, options)))
+        results = [result if result is not None else vector_by_text[text] for text, result in zip(texts, results)]
+    return results
+
+
+async def _create_embeddings(texts: list[str], cache_model: str, options: dict) -> list[list[float]]:
+    """正規化済みのtextsをAPIでベクトル化し、キャッシュに保存する"""
+    response = await async_client.embeddings.create(input=texts, **options)
+    vectors = [data.embedding for data in sorted(response.data, key=lambda data: data.index)]
+    await asyncio.to_thread(embedding_cache.set_many, cache_model, texts, vectors)
+    return vectors
+
+
+class EmbeddingBatcher:
+    """並行するベクトル化の要求を、window秒の間まとめて、1回のembeddings APIの呼び出しにする。
+    max_batch_size件に達した場合は、待たずに送信する。同じテキストは1回だけベクトル化する。"""
+
+    def __init__(self, cache_model: str, options: dict, window: float = 0.01, max_batch_size: int = 256):
+        self.cache_model = cache_model
+        self.options = options
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()     # 送信中のタスクの参照を保持する（GCされないように）
+
+    async def embed(self, text: str) -> list[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: list[tuple[str, asyncio.Future]]):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = await _create_embeddings(texts, self.cache_model, self.options)
+        except Exception as e:
+            # 同じバッチのすべての要求に、エラーを返す
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        vector_by_text = dict(zip(texts, vectors))
+        for text, future in batch:
+            if not future.done():   # キャンセルされた要求は無視する
+                future.set_result(vector_by_text[text])
+        logger.debug(f"Embedding batch: {len(batch)} requests, {len(texts)} texts.")
+
+
+_batchers: dict[str, EmbeddingBatcher] = {}
+
+
+async def aget_embedding(text: str, model: str | None = None, dimensions: int | None = None) -> list[float]:
+    """get_embeddingの非同期版。同時に呼び出された要求は、モデル、次元数ごとにまとめてベクトル化する。"""
+    cache_model, options = _embedding_options(model, dimensions)
+    text = normalize_text(text)
+    # キャッシュにあれば、バッチを待たずに返す
+    result = await asyncio.to_thread(embedding_cache.get, cache_model, text)
+    if result is not None:
+        return result
+    if cache_model not in _batchers:
+        _batchers[cache_model] = EmbeddingBatcher(cache_model, options)
+    return await _batchers[cache_model].embed(text)
+
+
 # モデレーター
 async def moderation(text: str) -> dict:
     """Returns an object containing the moderation label and the moderation output.
@@ -0,0 +1,76 @@
+import hashlib
+import unicodedata
+from logging import getLogger
+import numpy as np
+from diskcache import Cache
+import config
+
+logger = getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """ベクトル化するテキストを正規化する（キャッシュのキーと、APIに送るテキストの両方に使う）"""
+    return unicodedata.normalize("NFC", text.replace("\n", " ")).strip()
+
+
+class EmbeddingCache:
+    """(モデル, 正規化したテキストのSHA-256)をキーに、ベクトルをfloat32のバイト列としてディスクに保存する。
+    size_limit（バイト）を超えた場合、最近使われていないものから削除する。
+    SQLiteとファイルの読み書きはブロッキングのため、イベントループからは、asyncio.to_threadで呼び出す。
+    ディレクトリは、最初に使われた時に作成する（モジュールの読み込みだけでは、ファイルを作成しない）。"""
+
+    def __init__(self, directory: str, size_limit: int):
+        self.directory = directory
+        self.size_limit = size_limit
+        self._cache: Cache | None = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self) -> Cache:
+        if self._cache is None:
+            self._cache = Cache(directory=self.directory, size_limit=self.size_limit, eviction_policy="least-recently-used")
+        return self._cache
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return f"{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def get(self, model: str, text: str) -> list[float] | None:
+        value = self.cache.get(self.key(model, text))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.frombuffer(value, dtype=np.float32).tolist()
+
+    def get_many(self, model: str, texts: list[str]) -> list[list[float] | None]:
+        return [self.get(model, text) for text in texts]
+
+    def set(self, model: str, text: str, vector: list[float]):
+        self.cache.set(self.key(model, text), np.asarray(vector, dtype=np.float32).tobytes())
+
+    def set_many(self, model: str, texts: list[str], vectors: list[list[float]]):
+        """1トランザクションでまとめて保存する"""
+        with self.cache.transact():
+            for text, vector in zip(texts, vectors):
+                self.set(model, text, vector)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+            "entries": len(self.cache),
+            "bytes": self.cache.volume(),
+            "size_limit": self.cache.size_limit,
+        }
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+embedding_cache = EmbeddingCache(config.EMBEDDING_CACHE_DIR, config.EMBEDDING_CACHE_SIZE_LIMIT)
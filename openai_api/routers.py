@@ -1,3 +1,4 @@
+import asyncio
 import uuid
 from logging import getLogger
 
@@ -6,6 +7,7 @@ from openai import AsyncOpenAI, OpenAI
 from pydantic import BaseModel
 
 from openai_api.chat import async_chat, chat
+from openai_api.embedding_cache import embedding_cache
 from openai_api.jsonmode import output_json, output_json_to_neo4j
 from openai_api.visual import gpt4v
 
@@ -102,3 +104,16 @@ async def gpt4v_api(
         base64_image_urls=base64_image_urls,
     )
     return result
+
+
+@openai_api_router.get("/embedding_cache")
+async def embedding_cache_stats_api():
+    """ベクトルのディスクキャッシュのヒット数、ミス数、エントリ数、使用バイト数を取得する。"""
+    return await asyncio.to_thread(embedding_cache.stats)
+
+
+@openai_api_router.delete("/embedding_cache")
+async def clear_embedding_cache_api():
+    """ベクトルのディスクキャッシュを削除する。"""
+    await asyncio.to_thread(embedding_cache.clear)
+    return {"status": True}
@@ -0,0 +1,20 @@
+import os
+import pytest
+
+# ドライバ、OpenAIクライアントはモジュールの読み込み時に作成されるため、接続しない値を設定しておく
+# （テストは、DB、APIに接続しない処理のみを対象とする）
+os.environ.setdefault("NEO4J_URI", "bolt://localhost:7687")
+os.environ.setdefault("NEO4J_PASSWORD", "password")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+
+from openai_api import common, embedding_cache  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def embedding_cache_in_tmp_path(tmp_path, monkeypatch):
+    """ベクトルのディスクキャッシュを、作業ディレクトリではなく、テストごとの一時ディレクトリに作成する"""
+    cache = embedding_cache.EmbeddingCache(str(tmp_path / "embeddings"), 10 ** 7)
+    monkeypatch.setattr(embedding_cache, "embedding_cache", cache)
+    monkeypatch.setattr(common, "embedding_cache", cache)
+    return cache
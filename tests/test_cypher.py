@@ -0,0 +1,48 @@
+import re
+import pytest
+from chat_wb.neo4j.cypher import fulltext_query, hybrid_query_messages_query, node_history_query
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("カレーが好き", "カレーが好き"),
+    ('a+b "c" (d)', r'a\+b \"c\" \(d\)'),
+    ("title: x*y?", r"title\: x\*y\?"),
+    ("a && b || !c", r"a \&\& b \|\| \!c"),
+    (r"path/to\file", r"path\/to\\file"),
+    ("[x]{y}^~-z", r"\[x\]\{y\}\^\~\-z"),
+    ("cats AND dogs OR NOT birds", "cats and dogs or not birds"),
+    ("ANDROID NOTE", "ANDROID NOTE"),
+    ("  ", ""),
+])
+def test_fulltext_query_escapes_lucene_syntax(text, expected):
+    assert fulltext_query(text) == expected
+
+
+@pytest.mark.parametrize("local_vector", [False, True])
+def test_hybrid_query_filters_only_on_projected_score(local_vector):
+    query = hybrid_query_messages_query(local_vector)
+    # WITHの後のWHEREでは、WITHで引き継いでいない変数は使えない
+    for match in re.finditer(r"WITH ([^\n]*?) WHERE ([^\n]*)", query):
+        projected = {item.strip().split(" AS ")[-1] for item in match.group(1).split(",")}
+        if "score" in re.findall(r"\bscore\b", match.group(2)):
+            assert "score" in projected
+    if not local_vector:
+        assert re.search(r"YIELD node, score\s+WHERE score > \$threshold", query)
+
+
+@pytest.mark.parametrize("since, until, cursor", [(False, False, False), (True, True, True), (False, False, True)])
+def test_node_history_query_seeks_the_contain_index_for_hub_entities(since, until, cursor):
+    query = node_history_query(since=since, until=until, cursor=cursor)
+    indexed, expanded = query.split("CALL {")[1:3]
+    # 次数が大きい場合のみ、インデックスを降順にシークして、limit件で打ち切る
+    assert "WITH nodes WHERE degree > $index_degree" in indexed
+    assert "USING INDEX r:CONTAIN(create_time)" in indexed
+    assert re.search(r"ORDER BY r\.create_time DESC, id\(r\) DESC\s+LIMIT \$limit", indexed)
+    assert "WITH nodes WHERE degree <= $index_degree" in expanded
+    assert "USING INDEX" not in expanded
+    for part in (indexed, expanded):
+        assert ("datetime($before)" in part) == cursor
+        assert ("datetime($since)" in part) == since
+        assert ("datetime($until)" in part) == until
+        # パラメータのNULL判定は、範囲シークを妨げる
+        assert "IS NULL" not in part
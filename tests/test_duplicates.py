@@ -0,0 +1,31 @@
+import numpy as np
+from chat_wb.jobs.duplicates import similar_pairs, to_candidate
+
+
+def normalized(rows):
+    matrix = np.array(rows, dtype=np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+def test_similar_pairs_matches_the_full_matrix_across_blocks():
+    rng = np.random.default_rng(0)
+    matrix = normalized(rng.normal(size=(37, 8)))
+    matrix[20] = matrix[3]
+    matrix[36] = matrix[35]
+    expected = {
+        (i, j) for i in range(len(matrix)) for j in range(i + 1, len(matrix)) if matrix[i] @ matrix[j] >= 0.9
+    }
+    for block_size in [1, 5, 64]:
+        pairs = similar_pairs(matrix, 0.9, block_size=block_size)
+        assert {(i, j) for i, j, _ in pairs} == expected
+        assert all(i < j for i, j, _ in pairs)
+    assert (3, 20) in expected and (35, 36) in expected
+
+
+def test_candidate_target_is_the_node_with_more_relationships():
+    a = {"id": 1, "name": "カレーライス", "degree": 2}
+    b = {"id": 2, "name": "カレー", "degree": 5}
+    candidate = to_candidate("Food", a, b, 0.93456)
+    assert candidate["target"] == {"label": "Food", "name": "カレー"}
+    assert candidate["duplicates"] == [{"label": "Food", "name": "カレーライス"}]
+    assert candidate["score"] == 0.9346
@@ -0,0 +1,45 @@
+import asyncio
+import pytest
+from openai_api import common
+from openai_api.common import EmbeddingBatcher
+
+
+@pytest.fixture
+def requests(monkeypatch):
+    calls = []
+
+    async def fake_create(texts, cache_model, options):
+        calls.append(list(texts))
+        if "error" in texts:
+            raise RuntimeError("api error")
+        return [[float(len(text))] for text in texts]
+
+    monkeypatch.setattr(common, "_create_embeddings", fake_create)
+    return calls
+
+
+def test_concurrent_requests_share_one_api_call(requests):
+    async def run():
+        batcher = EmbeddingBatcher("model", {"model": "model"}, window=0.01)
+        return await asyncio.gather(*[batcher.embed(text) for text in ["a", "bb", "a", "ccc"]])
+
+    assert asyncio.run(run()) == [[1.0], [2.0], [1.0], [3.0]]
+    assert requests == [["a", "bb", "ccc"]]
+
+
+def test_full_batch_is_sent_without_waiting(requests):
+    async def run():
+        batcher = EmbeddingBatcher("model", {"model": "model"}, window=60, max_batch_size=2)
+        return await asyncio.wait_for(asyncio.gather(batcher.embed("a"), batcher.embed("bb")), timeout=1)
+
+    assert asyncio.run(run()) == [[1.0], [2.0]]
+    assert requests == [["a", "bb"]]
+
+
+def test_error_is_returned_to_every_request_in_the_batch(requests):
+    async def run():
+        batcher = EmbeddingBatcher("model", {"model": "model"}, window=0.01)
+        return await asyncio.gather(batcher.embed("error"), batcher.embed("a"), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
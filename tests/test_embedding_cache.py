@@ -0,0 +1,61 @@
+import asyncio
+import numpy as np
+import pytest
+from openai_api import common
+from openai_api.embedding_cache import EmbeddingCache, normalize_text
+
+
+def test_vectors_round_trip_as_float32(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), 10 ** 7)
+    cache.set_many("model", ["a", "b"], [[0.1, 0.2], [0.3, 0.4]])
+    assert cache.get_many("model", ["a", "b", "c"]) == [
+        np.float32([0.1, 0.2]).tolist(),
+        np.float32([0.3, 0.4]).tolist(),
+        None,
+    ]
+    assert cache.get("other-model", "a") is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_normalize_text():
+    assert normalize_text(" ガレー\nです ") == "ガレー です"
+
+
+def test_aget_embeddings_calls_the_api_only_for_misses(tmp_path, monkeypatch):
+    cache = EmbeddingCache(str(tmp_path), 10 ** 7)
+    cache.set("text-embedding-3-small:2", "cached", [1.0, 0.0])
+    monkeypatch.setattr(common, "embedding_cache", cache)
+    requested = []
+
+    async def fake_create(texts, cache_model, options):
+        requested.append(list(texts))
+        vectors = [[float(len(text)), 1.0] for text in texts]
+        cache.set_many(cache_model, texts, vectors)
+        return vectors
+
+    monkeypatch.setattr(common, "_create_embeddings", fake_create)
+    vectors = asyncio.run(common.aget_embeddings(["abc", "cached", "abc"], "text-embedding-3-small", 2))
+    assert vectors == [[3.0, 1.0], [1.0, 0.0], [3.0, 1.0]]
+    assert requested == [["abc"]]
+
+
+def test_embedding_dimensions_follow_the_model(monkeypatch):
+    # ada-002は次元数を指定できないため、インデックスは常に1536次元
+    assert common.embedding_dimensions("text-embedding-ada-002", 512) == 1536
+    assert common.embedding_dimensions("text-embedding-3-small", 512) == 512
+    assert common.embedding_dimensions("text-embedding-3-large") == 3072
+    assert common.embedding_dimensions("unknown-model") is None
+    monkeypatch.setattr(common.config, "EMBEDDING_MODEL", "text-embedding-ada-002")
+    monkeypatch.setattr(common.config, "EMBEDDING_DIMENSIONS", 512)
+    assert common.embedding_dimensions() == 1536
+
+
+def test_reembed_rejects_dimensions_for_fixed_models():
+    from chat_wb.jobs.reembed import resolve_dimensions
+    assert resolve_dimensions("text-embedding-ada-002", None) == 1536
+    assert resolve_dimensions("text-embedding-ada-002", 1536) == 1536
+    assert resolve_dimensions("text-embedding-3-small", 512) == 512
+    with pytest.raises(ValueError):
+        resolve_dimensions("text-embedding-ada-002", 512)
+    with pytest.raises(ValueError):
+        resolve_dimensions("unknown-model", None)
@@ -0,0 +1,67 @@
+import asyncio
+from chat_wb.models import Node, Triplets
+from chat_wb.neo4j import memory, neo4j
+from chat_wb.neo4j.cypher import UPDATE_NODE
+from chat_wb.neo4j.id_cache import NodeIdCache
+
+
+def test_entity_link_rows():
+    triplets = Triplets(nodes=[Node(label="Person", name="alice", properties=None)], relationships=[])
+    assert memory.entity_link_rows(triplets) == [{"label": "Person", "name": "alice", "properties": {}}]
+    assert memory.entity_link_rows(None) == []
+
+
+def test_check_entity_links_refreshes_cache_and_reports_misses(monkeypatch, caplog):
+    cache = NodeIdCache()
+    cache.set("Person", "alice", [99])     # 他のワーカーで統合され、古くなったid
+    monkeypatch.setattr(memory, "node_id_cache", cache)
+    labels = memory.check_entity_links([
+        {"label": "Person", "name": "alice", "node_id": 1},
+        {"label": "Person", "name": "alice", "node_id": 1},
+        {"label": "Food", "name": "curry", "node_id": None},
+    ])
+    assert labels == {"Person"}
+    assert cache.get("Person", "alice") == [1]
+    assert cache.get("Food", "curry") is None
+    assert "(curry:Food)" in caplog.text
+
+
+def test_update_node_resolves_a_stale_cached_id_again(monkeypatch):
+    cache = NodeIdCache()
+    cache.set("Person", "alice", [99])     # 他のワーカーで統合され、別のノードに再利用されたid
+    calls = []
+
+    async def fake_write_query(query_name, query, **params):
+        calls.append((query_name, params))
+        return [{"node_id": 5}] if query_name == "update_node" else []
+
+    monkeypatch.setattr(neo4j, "node_id_cache", cache)
+    monkeypatch.setattr(neo4j, "write_query", fake_write_query)
+    result = asyncio.run(neo4j.create_update_node(Node(label="Person", name="alice", properties={"age": "20"})))
+
+    assert result["node_id"] == 5
+    assert [name for name, _ in calls] == ["update_node"]
+    assert calls[0][1]["label"] == "Person" and calls[0][1]["name"] == "alice" and calls[0][1]["node_id"] == 99
+    assert cache.get("Person", "alice") is None
+
+
+def test_update_node_creates_a_node_deleted_by_another_worker(monkeypatch):
+    cache = NodeIdCache()
+    cache.set("Person", "alice", [99])
+    calls = []
+
+    async def fake_write_query(query_name, query, **params):
+        calls.append(query_name)
+        return [{"node_id": 7}] if query_name == "create_node" else []
+
+    monkeypatch.setattr(neo4j, "node_id_cache", cache)
+    monkeypatch.setattr(neo4j, "write_query", fake_write_query)
+    asyncio.run(neo4j.create_update_node(Node(label="Person", name="alice", properties={"age": "20"})))
+
+    assert calls == ["update_node", "create_node"]
+    assert cache.get("Person", "alice") is None
+
+
+def test_update_node_matches_the_cached_id_through_the_alias():
+    assert "MATCH (:Alias {label: $label, name: $name})-[:ALIAS_OF]->(n)" in UPDATE_NODE
+    assert "ORDER BY id(n) = $node_id DESC" in UPDATE_NODE
@@ -0,0 +1,61 @@
+import asyncio
+import re
+import pytest
+from chat_wb.neo4j import neo4j
+from chat_wb.neo4j.cypher import nodes_page_query, relationships_page_query
+
+# ラベル -> (name, id)。Title, Message, Aliasは、ページに含まない
+NODES = {
+    "Person": [("alice", 3), ("bob", 1), ("bob", 2)],
+    "Food": [("curry", 5)],
+    "Title": [("t", 9)],
+}
+
+
+@pytest.fixture
+def graph(monkeypatch):
+    calls = []
+
+    async def fake_read_query(query_name, query, **params):
+        calls.append(query_name)
+        if query_name == "get_entity_labels":
+            return [{"label": label} for label in [*NODES, "Message", "Alias"]]
+        label = re.search(r"MATCH \(n:`?(\w+)`?\)", query).group(1)
+        rows = [
+            {"id": node_id, "label": [label], "name": name}
+            for name, node_id in sorted(NODES[label])
+            if (name, node_id) > (params["name"], params["node_id"])
+        ]
+        return rows[:params["limit"]]
+
+    monkeypatch.setattr(neo4j, "read_query", fake_read_query)
+    return calls
+
+
+def test_nodes_pages_walk_labels_and_names_in_order(graph):
+    pages = []
+    cursor = None
+    while True:
+        nodes, cursor = asyncio.run(neo4j.get_nodes_page(cursor=cursor, limit=2))
+        pages.append([(node.label, node.name) for node in nodes])
+        if cursor is None:
+            break
+    assert pages == [
+        [("Food", "curry"), ("Person", "alice")],
+        [("Person", "bob"), ("Person", "bob")],
+        [],
+    ]
+
+
+def test_nodes_page_cursor_keeps_the_position_within_a_label(graph):
+    nodes, cursor = asyncio.run(neo4j.get_nodes_page(cursor='["Person", "bob", 1]', limit=5))
+    assert [node.name for node in nodes] == ["bob"]
+    assert cursor is None
+
+
+@pytest.mark.parametrize("query", [nodes_page_query("Person"), relationships_page_query("Person")])
+def test_page_queries_seek_the_name_index(query):
+    # ラベルを指定し、nameの範囲でシークしてから、(name, id)の順にlimit件で打ち切る
+    assert "MATCH (n:`Person`)\n    WHERE n.name >= $name" in query
+    assert re.search(r"ORDER BY n\.name, id\(n\)(, id\(r\))?\s+LIMIT \$limit", query)
+    assert "IS NULL" not in query
@@ -0,0 +1,65 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+import config
+from chat_wb.main import wb
+from chat_wb.models import Triplets
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """DB、LLMに接続しないStreamChatClient"""
+    client = object.__new__(wb.StreamChatClient)
+    client.user_input = "ガレーの話"
+    client.character_name_lsit = ["user", "AI"]
+    client.short_memory_depth = 1
+    client.short_memory = SimpleNamespace(short_memory=[])
+    lookups = []
+
+    async def fake_get_node_relationships(names, depth):
+        lookups.append(sorted(names))
+        return Triplets(nodes=[], relationships=[])
+
+    monkeypatch.setattr(wb, "get_node_relationships", fake_get_node_relationships)
+    monkeypatch.setattr(config, "MESSAGE_HYBRID_SEARCH_ENABLED", True)
+    monkeypatch.setattr(config, "ENTITY_FULLTEXT_MIN_MATCHES", 1)
+    return client, lookups
+
+
+def test_hybrid_search_runs_once_alongside_both_retrievals(client, monkeypatch):
+    client, lookups = client
+    events = []
+
+    async def fake_hybrid_query_messages(query, exclude_names=None):
+        events.append("hybrid started")
+        await asyncio.sleep(0)
+        events.append("hybrid done")
+        return [], ["ガレー", "user"]
+
+    async def fake_extract(self, text):
+        raise AssertionError("entities found by the fulltext search should skip the LLM")
+
+    monkeypatch.setattr(wb, "hybrid_query_messages", fake_hybrid_query_messages)
+    monkeypatch.setattr(wb.TripletsConverter, "extract_entites", fake_extract)
+    asyncio.run(client.wb_get_memory())
+
+    assert events == ["hybrid started", "hybrid done"]
+    # 全文検索で見つかったEntity名（user, AIを除く）で、②を取得する
+    assert lookups == [[], ["ガレー"]]
+
+
+def test_too_few_fulltext_entities_fall_back_to_the_llm(client, monkeypatch):
+    client, lookups = client
+
+    async def fake_hybrid_query_messages(query, exclude_names=None):
+        return [], []
+
+    async def fake_extract(self, text):
+        return ["ガレー"]
+
+    monkeypatch.setattr(wb, "hybrid_query_messages", fake_hybrid_query_messages)
+    monkeypatch.setattr(wb.TripletsConverter, "__init__", lambda self, short_memory: None)
+    monkeypatch.setattr(wb.TripletsConverter, "extract_entites", fake_extract)
+    asyncio.run(client.wb_get_memory())
+
+    assert ["ガレー"] in lookups
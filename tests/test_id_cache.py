@@ -0,0 +1,59 @@
+from chat_wb.neo4j import id_cache
+from chat_wb.neo4j.id_cache import NodeIdCache
+
+
+def test_get_returns_cached_ids():
+    cache = NodeIdCache()
+    cache.set("Person", "alice", [1, 2])
+    assert cache.get("Person", "alice") == [1, 2]
+    assert cache.get(None, "alice") is None
+
+
+def test_empty_ids_are_not_cached():
+    cache = NodeIdCache()
+    cache.set("Person", "alice", [])
+    assert cache.get("Person", "alice") is None
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(id_cache.time, "monotonic", lambda: now[0])
+    cache = NodeIdCache(ttl=10.0)
+    cache.set("Person", "alice", [1])
+    now[0] = 109.0
+    assert cache.get("Person", "alice") == [1]
+    now[0] = 111.0
+    assert cache.get("Person", "alice") is None
+    assert cache._keys_by_id == {}
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = NodeIdCache(maxsize=2)
+    cache.set("Person", "alice", [1])
+    cache.set("Person", "bob", [2])
+    cache.get("Person", "alice")
+    cache.set("Person", "carol", [3])
+    assert cache.get("Person", "bob") is None
+    assert cache.get("Person", "alice") == [1]
+    assert cache.get("Person", "carol") == [3]
+
+
+def test_invalidate_ids_removes_every_key_for_the_node():
+    cache = NodeIdCache()
+    cache.set("Person", "alice", [1])
+    cache.set(None, "alice", [1])
+    cache.set("Person", "ali", [1])
+    cache.set("Person", "bob", [2])
+    cache.invalidate_ids([1])
+    assert cache.get("Person", "alice") is None
+    assert cache.get(None, "alice") is None
+    assert cache.get("Person", "ali") is None
+    assert cache.get("Person", "bob") == [2]
+
+
+def test_invalidate_name_also_removes_aliases_of_the_same_node():
+    cache = NodeIdCache()
+    cache.set("Person", "alice", [1])
+    cache.set("Person", "ali", [1])
+    cache.invalidate_name("alice")
+    assert cache.get("Person", "ali") is None
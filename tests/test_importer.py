@@ -0,0 +1,95 @@
+import asyncio
+import json
+import pytest
+from chat_wb.jobs.importer import read_batches
+from chat_wb.neo4j import memory
+
+
+def test_read_batches_keeps_line_numbers(tmp_path):
+    path = tmp_path / "archive.jsonl"
+    lines = [json.dumps({"n": 1}), "", "{broken", json.dumps({"n": 2}), json.dumps({"n": 3})]
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    assert list(read_batches(str(path), 2)) == [(4, [(1, {"n": 1}), (4, {"n": 2})]), (5, [(5, {"n": 3})])]
+    assert list(read_batches(str(path), 2, start_line=4)) == [(5, [(5, {"n": 3})])]
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """run_queryの代わりに、クエリ名とパラメータを記録する。neighborsは、既存のMessageの(title, id, create_time)。"""
+    calls = {}
+    neighbors = []
+
+    async def fake_run_query(tx, query_name, query, **params):
+        calls[query_name] = params
+        if query_name == "store_messages.imported":
+            return [{"import_key": "a.jsonl:1", "message_id": 101}]
+        if query_name == "store_messages":
+            return [
+                {"index": row["index"], "message_id": 200 + row["index"], "create_time": row["create_time"], "linked": []}
+                for row in params["rows"]
+            ]
+        if query_name == "store_messages.neighbors":
+            return [{"title": t, "message_id": m, "create_time": c} for t, m, c in neighbors]
+        return []
+
+    monkeypatch.setattr(memory, "run_query", fake_run_query)
+    return calls, neighbors
+
+
+def test_store_messages_skips_imported_rows(queries):
+    """コミット後に中断したバッチを再実行した場合、インポート済みの行は作成せず、続きの行だけを繋ぐ"""
+    calls, neighbors = queries
+    # 現在のLATEST（300）は、インポートするログより新しい
+    neighbors.extend([("t", 101, 10), ("t", 300, 50)])
+    rows = [
+        {"index": 0, "import_key": "a.jsonl:1", "title": "t", "create_time": 10},
+        {"index": 1, "import_key": "a.jsonl:2", "title": "t", "create_time": 20},
+    ]
+    message_ids, created, linked = asyncio.run(memory._store_messages(None, rows))
+    assert message_ids == [101, 201]
+    assert created == [1]
+    assert [row["index"] for row in calls["store_messages"]["rows"]] == [1]
+    assert calls["store_messages.neighbors"]["windows"] == [{"title": "t", "since": 20, "until": 20}]
+    assert calls["store_messages.neighbors"]["created_ids"] == [201]
+    # create_timeの順に、101と300の間に繋ぐ
+    assert calls["store_messages.unfollow"]["links"] == [{"message_id": 300, "former_node_id": 101}]
+    assert calls["store_messages.follow"]["links"] == [
+        {"message_id": 201, "former_node_id": 101},
+        {"message_id": 300, "former_node_id": 201},
+    ]
+    # 最新の会話より古いため、LATESTは変えない
+    assert "store_messages.latest_pointer" not in calls
+
+
+def test_store_messages_does_nothing_when_every_row_is_imported(queries):
+    calls, _ = queries
+    rows = [{"index": 0, "import_key": "a.jsonl:1", "title": "t", "create_time": 10}]
+    assert asyncio.run(memory._store_messages(None, rows)) == ([101], [], [])
+    assert list(calls) == ["store_messages.imported"]
+
+
+def test_store_messages_moves_latest_to_newer_rows(queries):
+    calls, neighbors = queries
+    neighbors.append(("t", 300, 5))
+    rows = [
+        {"index": 0, "import_key": "b.jsonl:1", "title": "t", "create_time": 30},
+        {"index": 1, "import_key": "b.jsonl:2", "title": "t", "create_time": 20},
+        {"index": 2, "import_key": "b.jsonl:3", "title": "u", "create_time": 1},
+    ]
+    asyncio.run(memory._store_messages(None, rows))
+    assert calls["store_messages.follow"]["links"] == [
+        {"message_id": 201, "former_node_id": 300},
+        {"message_id": 200, "former_node_id": 201},
+    ]
+    assert "store_messages.unfollow" not in calls
+    assert calls["store_messages.latest_pointer"]["latest"] == [
+        {"title": "t", "message_id": 200},
+        {"title": "u", "message_id": 202},
+    ]
+
+
+def test_chain_by_time_orders_ties_after_existing_messages():
+    links, unlinks, latest = memory.chain_by_time([(10, 1), (20, 2)], [(10, 0, 5), (10, 1, 6)])
+    assert [(link["former_node_id"], link["message_id"]) for link in links] == [(1, 5), (5, 6), (6, 2)]
+    assert unlinks == [{"message_id": 2, "former_node_id": 1}]
+    assert latest is None
@@ -0,0 +1,47 @@
+import asyncio
+from chat_wb.neo4j.locks import LockStripes
+
+
+def test_stripes_are_acquired_in_ascending_order_and_released():
+    async def run():
+        locks = LockStripes(stripes=8)
+        keys = ["alice", "bob", "carol", "dave", None, ""]
+        indices = sorted({locks._index(key) for key in keys if key})
+        async with locks.hold(keys):
+            held = [i for i, lock in enumerate(locks._locks) if lock.locked()]
+        assert held == indices
+        assert not any(lock.locked() for lock in locks._locks)
+
+    asyncio.run(run())
+
+
+def test_overlapping_keys_in_any_order_do_not_deadlock():
+    async def run():
+        locks = LockStripes(stripes=4)
+        order = []
+
+        async def worker(name, keys):
+            async with locks.hold(keys):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        await asyncio.wait_for(
+            asyncio.gather(*[worker(i, ["alice", "bob", "carol"][::1 if i % 2 else -1]) for i in range(10)]),
+            timeout=1,
+        )
+        assert sorted(order) == list(range(10))
+
+    asyncio.run(run())
+
+
+def test_lock_is_released_when_the_body_raises():
+    async def run():
+        locks = LockStripes(stripes=4)
+        try:
+            async with locks.hold(["alice"]):
+                raise ValueError
+        except ValueError:
+            pass
+        assert not any(lock.locked() for lock in locks._locks)
+
+    asyncio.run(run())
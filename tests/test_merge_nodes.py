@@ -0,0 +1,84 @@
+import asyncio
+import pytest
+from chat_wb.models import MergeGroup, Node
+from chat_wb.neo4j import neo4j
+from chat_wb.neo4j.cypher import MERGE_NODES
+from chat_wb.neo4j.id_cache import NodeIdCache
+
+
+def person(name):
+    return Node(label="Person", name=name, properties=None)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = NodeIdCache()
+    cache.set("Person", "alice", [3, 1])
+    cache.set("Person", "ally", [2])
+    cache.set(None, "ally", [2])
+    cache.set("Person", "al", [2])          # allyの別名
+    cache.set("Person", "bob", [9])         # 統合しないノード
+    monkeypatch.setattr(neo4j, "node_id_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    calls = []
+    result = [{
+        "merged": 2, "names": ["alice", "ally", "al"], "props": {}, "relationship_count": 4,
+        "label_triples": [["Person", "LIKES", "Food"]],
+    }]
+
+    async def fake_write_query(query_name, query, **params):
+        calls.append((query_name, params))
+        return result
+
+    async def fake_read_query(query_name, query, **params):
+        if query_name == "resolve_node_ids":
+            return []       # キャッシュにない名前は、DBにもない
+        calls.append((query_name, params))
+        return result
+
+    monkeypatch.setattr(neo4j, "write_query", fake_write_query)
+    monkeypatch.setattr(neo4j, "read_query", fake_read_query)
+    monkeypatch.setattr(neo4j, "register_relation_types", lambda triples: list(triples))
+    return calls
+
+
+def test_merge_into_the_oldest_target_and_invalidate_every_alias(cache, queries):
+    group = MergeGroup(target=person("alice"), duplicates=[person("ally"), person("nobody")])
+    result = asyncio.run(neo4j.merge_node_group(group))
+
+    assert queries == [("merge_nodes", {
+        "target_id": 1, "duplicate_ids": [2, 3], **neo4j.PROPERTY_LIMIT_PARAMS,
+    })]
+    assert result["status"] and result["merged"] == 2
+    assert result["missing"] == ["Person:nobody"]
+    # 統合したノードの名前、別名は、次の名前解決でtargetに解決し直す
+    for label, name in [("Person", "alice"), ("Person", "ally"), (None, "ally"), ("Person", "al")]:
+        assert cache.get(label, name) is None
+    assert cache.get("Person", "bob") == [9]
+
+
+def test_dry_run_does_not_write_or_invalidate(cache, queries):
+    group = MergeGroup(target=person("alice"), duplicates=[person("ally")])
+    result = asyncio.run(neo4j.merge_node_group(group, dry_run=True))
+    assert [name for name, _ in queries] == ["merge_nodes.preview"]
+    assert result["dry_run"]
+    assert cache.get("Person", "ally") == [2]
+
+
+def test_merge_without_duplicates_is_rejected(cache, queries):
+    result = asyncio.run(neo4j.merge_node_group(MergeGroup(target=person("bob"), duplicates=[person("nobody")])))
+    assert not result["status"]
+    assert queries == []
+
+
+def test_merge_query_moves_aliases_to_the_target():
+    # 重複ノードのAliasを外し、どこも指さなくなったAliasを削除してから、統合後の名前でAliasを作り直す
+    delete_aliases = MERGE_NODES.index("MATCH (a:Alias)-[s:ALIAS_OF]->(d)")
+    merge = MERGE_NODES.index("apoc.refactor.mergeNodes")
+    set_names = MERGE_NODES.index("SET n.name = name, n.name_variation = names")
+    sync = MERGE_NODES.index("MERGE (a:Alias {label: head(labels(n)), name: alias_name})")
+    assert delete_aliases < merge < set_names < sync
@@ -0,0 +1,47 @@
+import re
+from datetime import datetime, timezone
+import pytest
+import config
+from chat_wb.models import Triplets
+from chat_wb.neo4j import cypher
+from chat_wb.neo4j.neo4j import convert_neo4j_message_to_model
+
+
+class FakeDateTime:
+    def to_native(self):
+        return datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def test_projection_returns_message_fields_without_the_embedding():
+    projection = cypher.message_projection("m")
+    fields = re.findall(r"\.(\w+)", projection)
+    assert fields == ["source", "user_input", "user_input_entity", "AI", "ai_response", "create_time"]
+    assert "id: id(m)" in projection
+    assert config.EMBEDDING_PROPERTY not in fields
+    assert f"embedding: m.`{config.EMBEDDING_PROPERTY}`" in cypher.message_projection("m", with_embedding=True)
+
+
+@pytest.mark.parametrize("query", [
+    cypher.recent_messages_query(3),
+    cypher.RECENT_MESSAGES_BY_TIME,
+    cypher.node_history_query(),
+    cypher.hybrid_query_messages_query(False),
+    cypher.messages_by_ids_query(False),
+    cypher.QUERY_MESSAGE_CANDIDATES,
+])
+def test_message_queries_do_not_return_the_embedding(query):
+    assert "embedding:" not in query
+    assert "id: id(" in query
+
+
+def test_convert_projected_map_to_message_node():
+    entity = Triplets(nodes=[], relationships=[]).model_dump_json()
+    message = convert_neo4j_message_to_model({
+        "id": 7, "source": "user", "user_input": "q", "AI": "ai", "ai_response": "a",
+        "user_input_entity": entity, "create_time": FakeDateTime(),
+    })
+    assert message.id == 7
+    assert message.user_input_entity == Triplets(nodes=[], relationships=[])
+    assert message.create_time == datetime(2024, 1, 1, tzinfo=timezone.utc)
+    # 必須の値がない場合はNone
+    assert convert_neo4j_message_to_model({"id": 7}) is None
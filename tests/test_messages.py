@@ -0,0 +1,88 @@
+import asyncio
+from datetime import datetime, timezone
+import pytest
+from chat_wb.neo4j import memory
+from chat_wb.neo4j.cypher import recent_messages_query, latest_messages_query
+
+
+class FakeDateTime:
+    def __init__(self, value):
+        self.value = value
+
+    def to_native(self):
+        return self.value
+
+    def iso_format(self):
+        return self.value.isoformat()
+
+
+def message(message_id):
+    return {
+        "id": message_id, "source": "user", "user_input": f"q{message_id}", "AI": "ai", "ai_response": "a",
+        "create_time": FakeDateTime(datetime(2024, 1, 1, tzinfo=timezone.utc)),
+    }
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """read_queryの代わりに、クエリ名ごとの結果を返す"""
+    calls = []
+    responses = {}
+
+    async def fake_read_query(query_name, query, **params):
+        calls.append((query_name, params))
+        return responses.get(query_name, [])
+
+    monkeypatch.setattr(memory, "read_query", fake_read_query)
+    return calls, responses
+
+
+def test_recent_messages_walks_follow_from_latest():
+    query = recent_messages_query(5)
+    assert "-[:LATEST]->(latest:Message)" in query
+    assert "(latest)-[:FOLLOW*0..4]->(m:Message)" in query
+    assert "ORDER BY length(path)" in query
+    assert "(latest)-[:FOLLOW*0..0]->" in recent_messages_query(1)
+
+
+def test_get_messages_uses_the_latest_chain(queries):
+    calls, responses = queries
+    responses["get_messages"] = [{"m": message(3)}, {"m": message(2)}]
+    messages = asyncio.run(memory.get_messages("t", 2))
+    assert [m.id for m in messages] == [3, 2]
+    assert [name for name, _ in calls] == ["get_messages"]
+
+
+def test_get_messages_falls_back_to_create_time(queries):
+    calls, responses = queries
+    # LATESTがない、または途中で途切れている場合
+    responses["get_messages"] = [{"m": message(3)}]
+    responses["get_messages.by_time"] = [{"m": message(3)}, {"m": message(1)}]
+    messages = asyncio.run(memory.get_messages("t", 2))
+    assert [m.id for m in messages] == [3, 1]
+    assert calls[1] == ("get_messages.by_time", {"title": "t", "n": 2})
+    assert asyncio.run(memory.get_messages("t", 0)) == []
+
+
+def test_get_latest_messages_falls_back_to_create_time(queries):
+    calls, responses = queries
+    responses["get_latest_messages.by_time"] = [{"nodes": [], "relationships": []}]
+    assert asyncio.run(memory.get_latest_messages("t", 3)) is not None
+    assert [name for name, _ in calls] == ["get_latest_messages", "get_latest_messages.by_time"]
+    query = latest_messages_query(2, by_time=True)
+    assert "[:LATEST]" not in query
+    assert "ORDER BY m.create_time DESC, id(m) DESC" in query
+
+
+def test_titles_page_cursor_includes_the_id(queries):
+    calls, responses = queries
+    update_time = FakeDateTime(datetime(2024, 1, 1, tzinfo=timezone.utc))
+    responses["get_titles_page"] = [
+        {"title": "a", "update_time": update_time, "id": 7},
+        {"title": "b", "update_time": update_time, "id": 5},
+    ]
+    titles, cursor = asyncio.run(memory.get_titles_page(limit=2))
+    assert titles == ["a", "b"]
+    assert cursor == "2024-01-01T00:00:00+00:00|5"
+    asyncio.run(memory.get_titles_page(before=cursor, limit=2))
+    assert calls[1][1] == {"before": "2024-01-01T00:00:00+00:00", "before_id": 5, "limit": 2}
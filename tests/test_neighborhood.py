@@ -0,0 +1,102 @@
+import asyncio
+import pytest
+from chat_wb.neo4j import neo4j
+
+EXCLUDED = {"Message", "Title", "Alias", "PropertyArchive"}
+
+
+class FakeNode(dict):
+    def __init__(self, node_id, label, **properties):
+        super().__init__(properties)
+        self.id = node_id
+        self.labels = {label}
+
+
+class FakeRelationship(dict):
+    def __init__(self, relationship_id, start_node, end_node, type="KNOWS"):
+        super().__init__()
+        self.id = relationship_id
+        self.start_node = start_node
+        self.end_node = end_node
+        self.type = type
+
+
+def graph():
+    """a -1- b -3- d、a -2- c -4- (Message)、a -5- h（ハブ） -6- x, -7- y"""
+    nodes = {
+        name: FakeNode(i, "Message" if name == "m" else "Person", **({"user_input": name} if name == "m" else {"name": name}))
+        for i, name in enumerate(["a", "b", "c", "d", "m", "h", "x", "y"], start=100)
+    }
+    edges = [(1, "a", "b"), (2, "a", "c"), (3, "b", "d"), (4, "c", "m"), (5, "a", "h"), (6, "h", "x"), (7, "h", "y")]
+    return nodes, [FakeRelationship(i, nodes[s], nodes[e]) for i, s, e in edges]
+
+
+@pytest.fixture
+def traverse(monkeypatch):
+    nodes, relationships = graph()
+    by_id = {node.id: node for node in nodes.values()}
+
+    async def fake_run_query(tx, query_name, query, **params):
+        if query_name == "get_node_relationships.start":
+            return [{"n": by_id[node_id]} for node_id in params["start_ids"]]
+        # 1ホップ分の展開（除外ラベル、訪問済み、fan-out、全体の上限）
+        rows = []
+        for node_id in params["frontier"]:
+            n = by_id[node_id]
+            incident = [
+                (r, r.end_node if r.start_node is n else r.start_node)
+                for r in relationships
+                if n in (r.start_node, r.end_node) and r.id not in params["visited"]
+            ]
+            incident = [(r, m) for r, m in incident if not m.labels & EXCLUDED]
+            incident.sort(key=lambda item: -item[0].id)
+            for r, m in incident[:params["fanout"]]:
+                degree = sum(m in (other.start_node, other.end_node) for other in relationships)
+                rows.append({"n": n, "r": r, "m": m, "degree": degree})
+        return rows[:params["remaining"]]
+
+    async def fake_read_transaction(func, *args):
+        return await func(None, *args)
+
+    async def fake_resolve_node_ids(keys):
+        return {(label, name): [nodes[name].id] for label, name in keys if name in nodes}
+
+    monkeypatch.setattr(neo4j, "run_query", fake_run_query)
+    monkeypatch.setattr(neo4j, "read_transaction", fake_read_transaction)
+    monkeypatch.setattr(neo4j, "resolve_node_ids", fake_resolve_node_ids)
+
+    def run(**kwargs):
+        triplets = asyncio.run(neo4j.get_node_relationships(["a"], **kwargs))
+        return (
+            sorted(node.name for node in triplets.nodes),
+            sorted((r.start_node, r.end_node) for r in triplets.relationships),
+        )
+    return run
+
+
+def test_depth_limits_the_number_of_hops(traverse):
+    names, relationships = traverse(depth=1, hub_degree=10)
+    assert names == ["a", "b", "c", "h"]
+    assert relationships == [("a", "b"), ("a", "c"), ("a", "h")]
+    names, _ = traverse(depth=2, hub_degree=10)
+    assert names == ["a", "b", "c", "d", "h", "x", "y"]
+
+
+def test_messages_are_pruned_and_hubs_are_not_expanded(traverse):
+    names, relationships = traverse(depth=3, hub_degree=2)
+    assert "m" not in names
+    # hの次数（3）はhub_degreeを超えるため、hの先（x, y）は辿らない
+    assert names == ["a", "b", "c", "d", "h"]
+    assert ("c", "m") not in relationships
+
+
+def test_fanout_and_relationship_limit(traverse):
+    # 1ノードあたり、新しい（idの大きい）リレーションシップから1本だけ展開する
+    names, relationships = traverse(depth=2, fanout=1, hub_degree=10)
+    assert relationships == [("a", "h"), ("h", "y")]
+    _, relationships = traverse(depth=3, max_relationships=2, hub_degree=10)
+    assert len(relationships) == 2
+
+
+def test_unknown_start_returns_none(traverse):
+    assert asyncio.run(neo4j.get_node_relationships(["nobody"])) is None
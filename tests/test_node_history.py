@@ -0,0 +1,25 @@
+import asyncio
+import config
+from chat_wb.neo4j import memory
+
+
+def test_history_passes_cursor_and_index_degree(monkeypatch):
+    calls = []
+
+    async def fake_read_query(query_name, query, **params):
+        calls.append((query, params))
+        return [{"n": None, "history": []}]
+
+    monkeypatch.setattr(memory, "read_query", fake_read_query)
+    monkeypatch.setattr(config, "NODE_HISTORY_INDEX_DEGREE", 10)
+    result = asyncio.run(memory.pursue_node_update_history(
+        "Person", "alice", limit=5, cursor="2024-06-01T00:00:00+00:00|42"
+    ))
+
+    assert result is None
+    query, params = calls[0]
+    assert "datetime($before)" in query and "datetime($since)" not in query
+    assert params["before"] == "2024-06-01T00:00:00+00:00"
+    assert params["before_id"] == 42
+    assert params["index_degree"] == 10
+    assert params["limit"] == 5
@@ -0,0 +1,21 @@
+from chat_wb.neo4j import profiler
+
+
+class FakeRecord:
+    def __init__(self, *values):
+        self._values = values
+
+    def values(self):
+        return list(self._values)
+
+
+def test_records_size_is_extrapolated_from_a_sample(monkeypatch):
+    monkeypatch.setattr(profiler, "SIZE_SAMPLE_RECORDS", 2)
+    records = [FakeRecord("abcd", 1), FakeRecord("ab", 1)] + [FakeRecord("x" * 1000, 1)] * 8
+    # 先頭2件の平均（(4 + 8) + (2 + 8)）/ 2 = 11バイト × 10件
+    assert profiler._estimate_records_size(records) == 110
+    assert profiler._estimate_records_size([]) == 0
+
+
+def test_estimate_size_of_nested_values():
+    assert profiler._estimate_size({"name": "あ", "values": [1, 2.0, None, True]}) == 4 + 3 + 6 + 8 + 8 + 0 + 1
@@ -0,0 +1,25 @@
+from chat_wb.jobs.compact import select_archived
+from chat_wb.neo4j.cypher import UPDATE_NODE, UNWIND_UPDATE_NODES
+
+
+def test_recent_policy_keeps_the_newest_values():
+    assert select_archived(["a", "b", "c", "d"], 2) == ["a", "b"]
+    assert select_archived(["a", "b"], 2) == []
+    assert select_archived(["a", "b"], 0) == ["a", "b"]
+
+
+def test_frequent_policy_keeps_the_most_mentioned_values():
+    values = ["a", "b", "c", "d"]
+    frequencies = {"a": 5, "c": 1, "d": 1}
+    # aは言及回数で残り、c, dは同数のため新しいdが残る
+    assert select_archived(values, 2, frequencies) == ["b", "c"]
+
+
+def test_frequent_policy_compares_values_as_strings():
+    assert select_archived([1, 2, 3], 1, {"1": 3}) == [2, 3]
+
+
+def test_merged_values_are_computed_once_per_update():
+    for query in [UPDATE_NODE, UNWIND_UPDATE_NODES]:
+        assert query.count("apoc.coll.flatten") == 1
+        assert query.count("AS merged") == 1
@@ -0,0 +1,65 @@
+import asyncio
+import pytest
+import config
+from chat_wb.neo4j import memory
+
+
+def hits(n, score=0.95):
+    return [{"node": f"m{i}", "score": score} for i in range(n)]
+
+
+@pytest.fixture
+def searches(monkeypatch):
+    """read_queryの代わりに、候補数ごとの結果を返す"""
+    calls = []
+    responses = {}
+
+    async def fake_read_query(name, query, **params):
+        calls.append(params["candidates"])
+        return [responses[params["candidates"]]]
+
+    monkeypatch.setattr(memory, "read_query", fake_read_query)
+    monkeypatch.setattr(config, "MESSAGE_SEARCH_CANDIDATE_BUDGET", 200)
+    return calls, responses
+
+
+def search(k=3, threshold=0.9):
+    return asyncio.run(memory._query_message_candidates([1.0], k, threshold, 365, None))
+
+
+def test_stops_when_k_hits_are_found(searches):
+    calls, responses = searches
+    responses[12] = {"hits": hits(3), "fetched": 12, "min_score": 0.95}
+    assert search() == [(f"m{i}", 0.95) for i in range(3)]
+    assert calls == [12]
+
+
+def test_widens_candidates_until_k_hits(searches):
+    calls, responses = searches
+    responses[12] = {"hits": hits(1), "fetched": 12, "min_score": 0.95}
+    responses[48] = {"hits": hits(2), "fetched": 48, "min_score": 0.93}
+    responses[192] = {"hits": hits(3), "fetched": 192, "min_score": 0.92}
+    assert len(search()) == 3
+    assert calls == [12, 48, 192]
+
+
+def test_stops_at_the_candidate_budget(searches):
+    calls, responses = searches
+    for candidates in [12, 48, 192, 200]:
+        responses[candidates] = {"hits": hits(1), "fetched": candidates, "min_score": 0.95}
+    assert len(search()) == 1
+    assert calls == [12, 48, 192, 200]
+
+
+def test_stops_when_scores_fall_below_threshold(searches):
+    calls, responses = searches
+    responses[12] = {"hits": hits(1), "fetched": 12, "min_score": 0.85}
+    assert len(search()) == 1
+    assert calls == [12]
+
+
+def test_stops_when_the_index_has_fewer_candidates(searches):
+    calls, responses = searches
+    responses[12] = {"hits": hits(1), "fetched": 5, "min_score": None}
+    assert len(search()) == 1
+    assert calls == [12]
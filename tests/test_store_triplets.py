@@ -0,0 +1,77 @@
+import asyncio
+import pytest
+from chat_wb.models import Node, Relationships, Triplets
+from chat_wb.neo4j import neo4j
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """run_queryの代わりに、クエリ名とパラメータを記録する。existingの名前は既存のノードとして扱う。"""
+    calls = []
+    existing = set()
+
+    async def fake_run_query(tx, query_name, query, **params):
+        calls.append((query_name, params))
+        if query_name == "store_triplets.update_nodes":
+            return [{"names": [row["name"] for row in params["rows"] if row["name"] in existing]}]
+        if query_name == "store_triplets.merge_relationships":
+            return [{"count": len(params["rows"]), "label_pairs": [["Person", "Food"]]}]
+        return []
+
+    monkeypatch.setattr(neo4j, "run_query", fake_run_query)
+    return calls, existing
+
+
+def store(triplets):
+    return asyncio.run(neo4j._store_triplets(None, triplets))
+
+
+def test_nodes_and_relationships_are_batched_by_label_and_type(queries):
+    calls, existing = queries
+    existing.add("alice")
+    relation_types = store(Triplets(
+        nodes=[
+            Node(label="Person", name="alice", properties={"age": 20}),
+            Node(label="Person", name="bob", properties=None),
+            Node(label="Food", name="curry", properties={"taste": "spicy"}),
+        ],
+        relationships=[
+            Relationships(type="LIKES", start_node="alice", end_node="curry", properties=None,
+                          start_node_label="Person", end_node_label="Food"),
+            Relationships(type="LIKES", start_node="bob", end_node="curry", properties={"since": "2020"},
+                          start_node_label="Person", end_node_label="Food"),
+        ],
+    ))
+
+    names = [name for name, _ in calls]
+    assert names == [
+        "store_triplets.update_nodes", "store_triplets.create_nodes",
+        "store_triplets.update_nodes", "store_triplets.create_nodes",
+        "store_triplets.merge_relationships",
+    ]
+    assert calls[0][1]["label"] == "Person"
+    assert calls[0][1]["rows"][0]["properties"] == {"age": ["20"]}
+    # 既存のaliceは更新のみ、bobは作成する
+    assert [row["name"] for row in calls[1][1]["rows"]] == ["bob"]
+    assert [row["start_node"] for row in calls[4][1]["rows"]] == ["alice", "bob"]
+    assert relation_types == [("Person", "LIKES", "Food")]
+
+
+def test_duplicate_new_nodes_in_one_batch_keep_every_property(queries):
+    calls, _ = queries
+    store(Triplets(nodes=[
+        Node(label="Person", name="alice", properties={"hobby": "tennis", "age": "20"}),
+        Node(label="Person", name="alice", properties={"hobby": ["golf", "tennis"], "job": "engineer", "age": "20"}),
+        Node(label="Person", name="bob", properties={"hobby": "chess"}),
+    ]))
+
+    update_rows = calls[0][1]["rows"]
+    create_rows = calls[1][1]["rows"]
+    assert [row["name"] for row in update_rows] == ["alice", "bob"]
+    assert [row["name"] for row in create_rows] == ["alice", "bob"]
+    alice = create_rows[0]
+    # 後の行で追加した値を末尾に移す（UNWIND_UPDATE_NODESで順に追加した場合と同じ）
+    assert alice["properties"] == {"hobby": ["golf", "tennis"], "age": ["20"], "job": ["engineer"]}
+    # 値が異なるキーはリスト、同じキーはそのまま
+    assert alice["create_properties"] == {"hobby": ["golf", "tennis"], "age": "20", "job": "engineer"}
+    assert create_rows[1]["create_properties"] == {"hobby": "chess"}
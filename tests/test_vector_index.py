@@ -0,0 +1,165 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pytest
+from chat_wb.neo4j.vector_index import MessageVectorIndex, PARTITION_SECONDS, exact_scores
+
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+OLD = NOW - timedelta(seconds=PARTITION_SECONDS * 3)
+
+
+def record(message_id, title, create_time, embedding):
+    return {"message_id": message_id, "title": title, "create_time": create_time, "embedding": embedding}
+
+
+@pytest.fixture
+def index():
+    index = MessageVectorIndex(capacity=2)
+    index.add_many(
+        [1, 2, 3, 4],
+        ["a", "a", "b", "b"],
+        [OLD, NOW, OLD, NOW],
+        [[1.0, 0.0], [0.8, 0.6], [0.0, 1.0], [0.6, 0.8]],
+    )
+    return index
+
+
+def test_search_returns_top_k_by_score(index):
+    results = index.search([1.0, 0.0], k=2)
+    assert [message_id for message_id, _ in results] == [1, 2]
+    assert results[0][1] == pytest.approx(1.0)
+    assert results[1][1] == pytest.approx(0.9)
+
+
+def test_search_filters_by_title_and_since(index):
+    assert [m for m, _ in index.search([1.0, 0.0], k=4, titles=["b"])] == [4, 3]
+    assert [m for m, _ in index.search([1.0, 0.0], k=4, since=NOW - timedelta(days=1))] == [2, 4]
+    assert index.search([1.0, 0.0], k=4, titles=["missing"]) == []
+
+
+def test_since_excludes_rows_in_the_boundary_partition():
+    index = MessageVectorIndex()
+    index.add_many([1, 2], ["a", "a"], [NOW, NOW + timedelta(seconds=10)], [[1.0, 0.0], [1.0, 0.0]])
+    assert [m for m, _ in index.search([1.0, 0.0], k=2, since=NOW)] == [2]
+
+
+def test_add_replaces_vector_of_existing_message(index):
+    index.add(1, "a", OLD, [0.0, 1.0])
+    assert index.size == 4
+    assert index.search([0.0, 1.0], k=1, titles=["a"])[0][0] == 1
+
+
+def test_rename_title_merges_partitions(index):
+    index.rename_title("b", "a")
+    assert index.stats()["titles"] == 1
+    assert index.stats()["partitions"] == 2
+    assert sorted(m for m, _ in index.search([1.0, 0.0], k=4, titles=["a"])) == [1, 2, 3, 4]
+
+
+def test_load_keeps_serving_and_replays_adds_during_the_build(index, monkeypatch):
+    async def fetch(self, name, query, batch_size, **params):
+        # 読み込みの途中で、現在のインデックスを検索、追加する
+        assert index.ready
+        assert index.size == 4
+        index.add(10, "c", NOW, [1.0, 0.0])
+        yield [record(1, "a", OLD, [1.0, 0.0]), record(2, "a", NOW, [0.8, 0.6])]
+
+    monkeypatch.setattr(MessageVectorIndex, "_fetch", fetch)
+    index.ready = True
+    asyncio.run(index.load())
+
+    assert index.ready
+    assert index.size == 3
+    assert sorted(m for m, _ in index.search([1.0, 0.0], k=5)) == [1, 2, 10]
+    # 読み込み後の追加は、置き換えたインデックスに対して行う
+    index.add(11, "c", NOW, [0.0, 1.0])
+    assert index.search([0.0, 1.0], k=1)[0][0] == 11
+
+
+def test_failed_load_keeps_the_current_index(index, monkeypatch):
+    async def fetch(self, name, query, batch_size, **params):
+        raise RuntimeError("db error")
+        yield
+
+    monkeypatch.setattr(MessageVectorIndex, "_fetch", fetch)
+    index.ready = True
+    with pytest.raises(RuntimeError):
+        asyncio.run(index.load())
+    assert index.ready
+    assert index.size == 4
+    index.add(5, "a", NOW, [1.0, 0.0])
+    assert index._replay is None
+
+
+def test_catch_up_reads_from_the_latest_loaded_create_time(monkeypatch):
+    calls = []
+    batches = [
+        [record(1, "a", OLD, [1.0, 0.0]), record(2, "a", NOW, [0.0, 1.0])],
+        [record(2, "a", NOW, [0.0, 1.0]), record(3, "b", NOW + timedelta(minutes=5), [1.0, 1.0])],
+    ]
+
+    async def fetch(self, name, query, batch_size, **params):
+        calls.append(params)
+        yield batches[len(calls) - 1]
+
+    monkeypatch.setattr(MessageVectorIndex, "_fetch", fetch)
+    index = MessageVectorIndex()
+    asyncio.run(index.load())
+    assert asyncio.run(index.catch_up()) == 2
+
+    assert calls[1]["since"] == int(NOW.timestamp() * 1000) - 60 * 1000
+    assert index.size == 3
+    assert index.stats()["synced_until"] == (NOW + timedelta(minutes=5)).isoformat()
+
+
+def test_catch_up_does_nothing_before_load(monkeypatch):
+    async def fetch(self, name, query, batch_size, **params):
+        raise AssertionError("should not query")
+        yield
+
+    monkeypatch.setattr(MessageVectorIndex, "_fetch", fetch)
+    assert asyncio.run(MessageVectorIndex().catch_up()) == 0
+
+
+def test_select_rows_reads_only_matching_partitions(index):
+    assert index._select_rows(None, None) is None
+    assert sorted(index._ids[index._select_rows(None, ["a"])]) == [1, 2]
+    assert sorted(index._ids[index._select_rows(NOW - timedelta(days=1), ["a", "b"])]) == [2, 4]
+    assert len(index._select_rows(NOW + timedelta(days=1), None)) == 0
+    assert len(index._select_rows(None, [])) == 0
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantized_scores_are_within_the_error_bound(dtype):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(200, 64))
+    query = rng.normal(size=64)
+    exact = MessageVectorIndex()
+    quantized = MessageVectorIndex(dtype=dtype)
+    for index in (exact, quantized):
+        index.add_many(list(range(200)), ["a"] * 200, [NOW] * 200, vectors.tolist())
+
+    assert quantized.quantized
+    assert quantized._matrix.dtype == np.dtype(dtype)
+    assert quantized.stats()["bytes"] < exact.stats()["bytes"]
+    expected = dict(exact.search(query.tolist(), k=200))
+    for message_id, score in quantized.search(query.tolist(), k=200):
+        assert abs(score - expected[message_id]) <= quantized.error
+
+
+def test_exact_scores_rerank_quantized_candidates():
+    # int8では区別できない差も、元のベクトルでは並べ替えられる
+    vectors = [[1.0, 0.001], [1.0, 0.0]]
+    index = MessageVectorIndex(dtype="int8")
+    index.add_many([1, 2], ["a", "a"], [NOW, NOW], vectors)
+    candidates = index.search([1.0, 0.0], k=2)
+    scores = exact_scores([1.0, 0.0], [vectors[message_id - 1] for message_id, _ in candidates])
+    reranked = sorted(zip([m for m, _ in candidates], scores), key=lambda x: -x[1])
+    assert [m for m, _ in reranked] == [2, 1]
+    assert scores == pytest.approx([1.0, 1.0])
+    assert exact_scores([1.0, 0.0], []) == []
+
+
+def test_unsupported_dtype_is_rejected():
+    with pytest.raises(ValueError):
+        MessageVectorIndex(dtype="int4")